@@ -0,0 +1,164 @@
+"""
+Outbound mail queue for OTP emails.
+
+Views render a message and hand it to ``mail_queue``, so a request never
+waits on an SMTP round trip. A single background thread delivers queued
+messages over one reused connection (closed again after a quiet period)
+and retries failed sends with exponential backoff. Bodies come from the
+``accounts/emails/otp.html`` template, which the template engine compiles
+once per process.
+
+Tests and local development can point ``EMAIL_BACKEND`` at the locmem or
+console backend, or ``EMAIL_HOST`` at a local SMTP server like the one in
+accounts/tests.py; ``mail_queue.flush()`` waits until everything queued
+has been delivered or given up on.
+"""
+
+import atexit
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 5
+RETRY_BACKOFF = 2  # seconds before the first retry, doubled after each failure
+IDLE_TIMEOUT = 30  # seconds an unused SMTP connection stays open
+SHUTDOWN_TIMEOUT = 10
+
+OTP_EMAILS = {
+    'registration': {
+        'subject': 'Welcome! Verify Your Email - Complete Auth',
+        'text': 'Welcome {username}! Your email verification OTP is: {otp}. Valid for 10 minutes.',
+        'brand': 'Complete Auth',
+        'heading': 'Welcome to Complete Auth!',
+        'intro': 'Thank you for registering! Please use the OTP below to verify your email address:',
+        'note': 'You must verify your email before you can sign in to your account.',
+    },
+    'email_verification': {
+        'subject': 'Email Verification - Complete Auth',
+        'text': 'Your email verification OTP is: {otp}. Valid for 10 minutes.',
+        'brand': 'Complete Auth',
+        'heading': 'Email Verification',
+        'intro': 'Please use the OTP below to verify your email address:',
+        'note': 'If you did not request this verification, please ignore this email.',
+    },
+    'password_reset': {
+        'subject': 'Password Reset OTP',
+        'text': 'Your OTP for password reset is: {otp}. Valid for 10 minutes.',
+        'brand': 'K9TXCHAT',
+        'heading': 'K9TXCHAT Password Reset',
+        'intro': 'You requested to reset your password. Please use the OTP below to proceed:',
+        'note': 'If you did not request this, please ignore this email.',
+    },
+}
+
+
+def build_otp_email(kind, email, otp, username=None):
+    """Render one of the ``OTP_EMAILS`` for a recipient."""
+    spec = OTP_EMAILS[kind]
+    html_content = get_template('accounts/emails/otp.html').render({
+        'heading': spec['heading'],
+        'name': username or 'user',
+        'intro': spec['intro'],
+        'otp': otp,
+        'note': spec['note'],
+        'brand': spec['brand'],
+    })
+    message = EmailMultiAlternatives(
+        spec['subject'],
+        spec['text'].format(username=username, otp=otp),
+        settings.DEFAULT_FROM_EMAIL,
+        [email],
+    )
+    message.attach_alternative(html_content, "text/html")
+    return message
+
+
+class MailQueue:
+    """Delivers queued messages on a background thread."""
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, backoff=RETRY_BACKOFF, idle_timeout=IDLE_TIMEOUT):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue()
+        self.retries = []  # heap of (due, tiebreak, attempt, message), worker thread only
+        self.counter = itertools.count()
+        self.connection = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.idle = threading.Condition(self.lock)
+
+    def send(self, message):
+        with self.lock:
+            self.pending += 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='mail-queue', daemon=True)
+                self.thread.start()
+        self.queue.put((1, message))
+
+    def send_otp(self, kind, email, otp, username=None):
+        self.send(build_otp_email(kind, email, otp, username=username))
+
+    def flush(self, timeout=None):
+        """Block until every queued message was sent or given up on."""
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout)
+
+    def run(self):
+        while True:
+            if self.retries and self.retries[0][0] <= time.monotonic():
+                _, _, attempt, message = heapq.heappop(self.retries)
+            else:
+                timeout = self.idle_timeout
+                if self.retries:
+                    timeout = max(0, self.retries[0][0] - time.monotonic())
+                try:
+                    attempt, message = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    if not self.retries:
+                        self.close_connection()
+                    continue
+            self.deliver(attempt, message)
+
+    def deliver(self, attempt, message):
+        try:
+            if self.connection is None:
+                self.connection = get_connection(fail_silently=False)
+                self.connection.open()
+            self.connection.send_messages([message])
+        except Exception:
+            # The connection may be broken, start the next attempt on a new one
+            self.close_connection()
+            if attempt < self.max_attempts:
+                due = time.monotonic() + self.backoff * 2 ** (attempt - 1)
+                heapq.heappush(self.retries, (due, next(self.counter), attempt + 1, message))
+                return
+            logger.exception('Giving up on email to %s after %s attempts', ', '.join(message.to), attempt)
+        self.done()
+
+    def done(self):
+        with self.idle:
+            self.pending -= 1
+            self.idle.notify_all()
+
+    def close_connection(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+
+mail_queue = MailQueue()
+# Give queued mail a chance to go out before the process exits
+atexit.register(mail_queue.flush, SHUTDOWN_TIMEOUT)
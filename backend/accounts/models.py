@@ -45,6 +45,13 @@ class User(AbstractUser):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username']
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Prefix user search (username is already indexed as unique)
+            models.Index(fields=['first_name'], name='accounts_user_first_idx'),
+            models.Index(fields=['last_name'], name='accounts_user_last_idx'),
+        ]
+
     def __str__(self):
         return self.email
 
@@ -1,3 +1,144 @@
-from django.test import TestCase
+import socketserver
+import threading
+import time
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend as LocmemEmailBackend
+from django.test import SimpleTestCase, override_settings
+from .mail import MailQueue, build_otp_email
 
-# Create your tests here.
+class FlakyEmailBackend(LocmemEmailBackend):
+    """The locmem outbox, plus connection counts and scripted failures."""
+    opened = 0
+    failures = 0
+    
+    def open(self):
+        FlakyEmailBackend.opened += 1
+        return True
+    
+    def send_messages(self, messages):
+        if FlakyEmailBackend.failures:
+            FlakyEmailBackend.failures -= 1
+            raise OSError('SMTP server unavailable')
+        return super().send_messages(messages)
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept mail: no extensions, no authentication."""
+    
+    def reply(self, line):
+        self.wfile.write(f'{line}\r\n'.encode())
+    
+    def handle(self):
+        server = self.server
+        server.sessions.append([])
+        self.reply('220 localhost ready')
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command.startswith('DATA'):
+                self.reply('354 end with <CRLF>.<CRLF>')
+                data = []
+                for line in self.rfile:
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(line)
+                server.sessions[-1].append(b''.join(data))
+                self.reply('250 queued')
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                break
+            else:
+                # HELO/EHLO, MAIL FROM, RCPT TO, RSET, NOOP
+                self.reply('250 ok')
+        server.closed += 1
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.sessions = []  # messages received on each connection
+        self.closed = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+@override_settings(EMAIL_BACKEND='accounts.tests.FlakyEmailBackend')
+class MailQueueTests(SimpleTestCase):
+    def setUp(self):
+        FlakyEmailBackend.opened = 0
+        FlakyEmailBackend.failures = 0
+        self.queue = MailQueue(max_attempts=3, backoff=0.01)
+    
+    def otp_email(self, email='alice@example.com'):
+        return build_otp_email('email_verification', email, '123456')
+    
+    def test_messages_share_one_connection(self):
+        for i in range(3):
+            self.queue.send(self.otp_email(f'user{i}@example.com'))
+        self.assertTrue(self.queue.flush(5))
+        
+        self.assertEqual([message.to for message in mail.outbox], [[f'user{i}@example.com'] for i in range(3)])
+        self.assertEqual(FlakyEmailBackend.opened, 1)
+    
+    def test_failed_send_is_retried_on_a_new_connection(self):
+        FlakyEmailBackend.failures = 2
+        self.queue.send(self.otp_email())
+        self.assertTrue(self.queue.flush(5))
+        
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(FlakyEmailBackend.opened, 3)
+    
+    def test_gives_up_after_max_attempts(self):
+        FlakyEmailBackend.failures = 3
+        with self.assertLogs('accounts.mail', 'ERROR') as logs:
+            self.queue.send(self.otp_email())
+            self.assertTrue(self.queue.flush(5))
+        
+        self.assertEqual(mail.outbox, [])
+        self.assertIn('alice@example.com', logs.output[0])
+    
+    def test_otp_email_renders_template(self):
+        message = build_otp_email('registration', 'alice@example.com', '654321', username='alice')
+        html, mimetype = message.alternatives[0]
+        
+        self.assertEqual(mimetype, 'text/html')
+        self.assertIn('654321', html)
+        self.assertIn('alice', message.body)
+
+class MailQueueSMTPTests(SimpleTestCase):
+    def setUp(self):
+        self.server = SMTPServer()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings = override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=self.server.server_address[1],
+            EMAIL_USE_TLS=False,
+            EMAIL_HOST_USER='',
+            EMAIL_HOST_PASSWORD='',
+            DEFAULT_FROM_EMAIL='noreply@example.com',
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.queue = MailQueue(max_attempts=2, backoff=0.01, idle_timeout=0.2)
+    
+    def test_messages_share_one_smtp_session(self):
+        for i in range(3):
+            self.queue.send(build_otp_email('email_verification', f'user{i}@example.com', '123456'))
+        self.assertTrue(self.queue.flush(5))
+        
+        self.assertEqual(len(self.server.sessions), 1)
+        self.assertEqual(len(self.server.sessions[0]), 3)
+        self.assertIn(b'user2@example.com', self.server.sessions[0][2])
+    
+    def test_connection_is_closed_after_idle_timeout(self):
+        self.queue.send(build_otp_email('email_verification', 'alice@example.com', '123456'))
+        self.assertTrue(self.queue.flush(5))
+        
+        deadline = time.monotonic() + 5
+        while not self.server.closed and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.server.closed, 1)
+        
+        # The next message opens a new session
+        self.queue.send(build_otp_email('email_verification', 'bob@example.com', '123456'))
+        self.assertTrue(self.queue.flush(5))
+        self.assertEqual([len(messages) for messages in self.server.sessions], [1, 1])
@@ -6,17 +6,16 @@ from rest_framework.views import APIView
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
-from django.core.mail import EmailMultiAlternatives
-from django.conf import settings
 from .serializers import (
     UserSerializer, LoginSerializer, PasswordResetRequestSerializer,
     OTPVerificationSerializer, ChangePasswordSerializer, EmailVerificationSerializer,
     SendVerificationSerializer, GoogleLoginSerializer, UpdateUsernameSerializer,
     ProfileImageUploadSerializer
 )
+from .mail import mail_queue
 from .models import User, OTP
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from chat.events import build_event
+from chat.middleware import invalidate_cached_user
 
 class RegisterView(generics.CreateAPIView):
     queryset = User.objects.all()
@@ -37,42 +36,8 @@ class RegisterView(generics.CreateAPIView):
             expires_at=expires_at
         )
         
-        # Send verification email
-        subject = 'Welcome! Verify Your Email - Complete Auth'
-        text_content = f'Welcome {user.username}! Your email verification OTP is: {otp}. Valid for 10 minutes.'
-        html_content = f"""
-        <html>
-          <body style="font-family: Arial, sans-serif; background-color: #f4f4f4; padding: 30px;">
-            <div style="max-width: 500px; margin: auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #e0e0e0; padding: 30px;">
-              <h2 style="color: #2d7ff9; text-align: center;">Welcome to Complete Auth!</h2>
-              <p>Dear {user.username},</p>
-              <p>Thank you for registering! Please use the OTP below to verify your email address:</p>
-              <div style="text-align: center; margin: 30px 0;">
-                <span style="display: inline-block; background: #2d7ff9; color: #fff; font-size: 2em; letter-spacing: 8px; padding: 12px 32px; border-radius: 6px;">
-                  {otp}
-                </span>
-              </div>
-              <p style="text-align: center; color: #888;">This OTP is valid for 10 minutes.</p>
-              <p>You must verify your email before you can sign in to your account.</p>
-              <hr style="margin: 30px 0;">
-              <p style="font-size: 0.9em; color: #aaa; text-align: center;">&copy; {datetime.now().year} Complete Auth. All rights reserved.</p>
-            </div>
-          </body>
-        </html>
-        """
-
-        try:
-            email_msg = EmailMultiAlternatives(
-                subject,
-                text_content,
-                settings.DEFAULT_FROM_EMAIL,
-                [user.email],
-            )
-            email_msg.attach_alternative(html_content, "text/html")
-            email_msg.send(fail_silently=False)
-        except Exception as e:
-            # Log the error but don't fail registration
-            pass
+        # Queue the verification email, delivery happens in the background
+        mail_queue.send_otp('registration', user.email, otp, username=user.username)
     
     def create(self, request, *args, **kwargs):
         response = super().create(request, *args, **kwargs)
@@ -128,38 +93,8 @@ class PasswordResetRequestView(APIView):
                     expires_at=expires_at
                 )
                 
-                # Send OTP via email with HTML template
-                subject = 'Password Reset OTP'
-                text_content = f'Your OTP for password reset is: {otp}. Valid for 10 minutes.'
-                html_content = f"""
-                <html>
-                  <body style="font-family: Arial, sans-serif; background-color: #f4f4f4; padding: 30px;">
-                    <div style="max-width: 500px; margin: auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #e0e0e0; padding: 30px;">
-                      <h2 style="color: #2d7ff9; text-align: center;">K9TXCHAT Password Reset</h2>
-                      <p>Dear user,</p>
-                      <p>You requested to reset your password. Please use the OTP below to proceed:</p>
-                      <div style="text-align: center; margin: 30px 0;">
-                        <span style="display: inline-block; background: #2d7ff9; color: #fff; font-size: 2em; letter-spacing: 8px; padding: 12px 32px; border-radius: 6px;">
-                          {otp}
-                        </span>
-                      </div>
-                      <p style="text-align: center; color: #888;">This OTP is valid for 10 minutes.</p>
-                      <p>If you did not request this, please ignore this email.</p>
-                      <hr style="margin: 30px 0;">
-                      <p style="font-size: 0.9em; color: #aaa; text-align: center;">&copy; {datetime.now().year} K9TXCHAT. All rights reserved.</p>
-                    </div>
-                  </body>
-                </html>
-                """
-
-                email = EmailMultiAlternatives(
-                    subject,
-                    text_content,
-                    settings.DEFAULT_FROM_EMAIL,
-                    [email],
-                )
-                email.attach_alternative(html_content, "text/html")
-                email.send(fail_silently=False)
+                # Queue the OTP email, delivery happens in the background
+                mail_queue.send_otp('password_reset', email, otp)
                 
                 return Response({'message': 'OTP sent successfully to your email'})
             except User.DoesNotExist:
@@ -234,38 +169,8 @@ class SendVerificationView(APIView):
                     expires_at=expires_at
                 )
                 
-                # Send verification email
-                subject = 'Email Verification - Complete Auth'
-                text_content = f'Your email verification OTP is: {otp}. Valid for 10 minutes.'
-                html_content = f"""
-                <html>
-                  <body style="font-family: Arial, sans-serif; background-color: #f4f4f4; padding: 30px;">
-                    <div style="max-width: 500px; margin: auto; background: #fff; border-radius: 8px; box-shadow: 0 2px 8px #e0e0e0; padding: 30px;">
-                      <h2 style="color: #2d7ff9; text-align: center;">Email Verification</h2>
-                      <p>Dear {user.username},</p>
-                      <p>Please use the OTP below to verify your email address:</p>
-                      <div style="text-align: center; margin: 30px 0;">
-                        <span style="display: inline-block; background: #2d7ff9; color: #fff; font-size: 2em; letter-spacing: 8px; padding: 12px 32px; border-radius: 6px;">
-                          {otp}
-                        </span>
-                      </div>
-                      <p style="text-align: center; color: #888;">This OTP is valid for 10 minutes.</p>
-                      <p>If you did not request this verification, please ignore this email.</p>
-                      <hr style="margin: 30px 0;">
-                      <p style="font-size: 0.9em; color: #aaa; text-align: center;">&copy; {datetime.now().year} Complete Auth. All rights reserved.</p>
-                    </div>
-                  </body>
-                </html>
-                """
-
-                email_msg = EmailMultiAlternatives(
-                    subject,
-                    text_content,
-                    settings.DEFAULT_FROM_EMAIL,
-                    [email],
-                )
-                email_msg.attach_alternative(html_content, "text/html")
-                email_msg.send(fail_silently=False)
+                # Queue the verification email, delivery happens in the background
+                mail_queue.send_otp('email_verification', email, otp, username=user.username)
                 
                 return Response({'message': 'Verification OTP sent successfully to your email'})
             except User.DoesNotExist:
@@ -391,6 +296,7 @@ class UpdateUsernameView(APIView):
         serializer = UpdateUsernameSerializer(instance=request.user, data=request.data)
         if serializer.is_valid():
             updated_user = serializer.save()
+            invalidate_cached_user(updated_user.id)
             
             # Broadcast username change to all chat rooms where user is a participant
             self.broadcast_user_update(updated_user, old_username)
@@ -402,46 +308,49 @@ class UpdateUsernameView(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     def broadcast_user_update(self, user, old_username):
-        """Broadcast user update to all chat rooms where user participates"""
+        """Post a system message in every room of the user and notify everyone in them"""
+        from chat.fanout import fanout_queue, room_contacts
         from chat.models import ChatRoom, Message
         
-        channel_layer = get_channel_layer()
-        if not channel_layer:
+        room_ids = list(
+            ChatRoom.objects.filter(participants=user, is_active=True).values_list('id', flat=True)
+        )
+        if not room_ids:
             return
         
-        # Get all chat rooms where user is a participant
-        user_rooms = ChatRoom.objects.filter(participants=user, is_active=True)
+        # One INSERT for the system messages of all rooms
+        content = f'{old_username} is now known as {user.username}'
+        system_messages = {
+            message.room_id: {
+                'id': message.id,
+                'room_id': message.room_id,
+                'content': message.content,
+                'timestamp': message.timestamp.isoformat(),
+                'seq': message.seq,
+                'message_type': 'system'
+            }
+            for message in Message.create_in_rooms(room_ids, user, content)
+        }
         
-        for room in user_rooms:
-            # Create a system message about username change
-            system_message = Message.objects.create(
-                room=room,
-                sender=user,
-                content=f'{old_username} is now known as {user.username}',
-                message_type='system'
+        # One event per contact, covering every room they share with the user
+        user_data = {
+            'id': user.id,
+            'username': user.username,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'email': user.email
+        }
+        fanout_queue.submit({
+            contact_id: build_event(
+                'user_update',
+                user=user_data,
+                old_username=old_username,
+                message=content,
+                room_ids=shared_room_ids,
+                system_messages=[system_messages[room_id] for room_id in shared_room_ids]
             )
-            
-            group_name = f'chat_{room.id}'
-            
-            # Send user update message to the room group
-            async_to_sync(channel_layer.group_send)(group_name, {
-                'type': 'user_update',
-                'user': {
-                    'id': user.id,
-                    'username': user.username,
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                    'email': user.email
-                },
-                'old_username': old_username,
-                'message': f'{old_username} is now known as {user.username}',
-                'system_message': {
-                    'id': system_message.id,
-                    'content': system_message.content,
-                    'timestamp': system_message.timestamp.isoformat(),
-                    'message_type': 'system'
-                }
-            })
+            for contact_id, shared_room_ids in room_contacts(room_ids).items()
+        })
     
     def get(self, request):
         """Get current user profile"""
@@ -464,6 +373,7 @@ class ProfileImageUploadView(APIView):
                     pass  # Ignore errors if file doesn't exist
             
             updated_user = serializer.save()
+            invalidate_cached_user(updated_user.id)
             
             # Broadcast user update to all chat rooms where user participates
             self.broadcast_user_update(updated_user)
@@ -481,6 +391,7 @@ class ProfileImageUploadView(APIView):
                 request.user.profile_image.delete(save=False)
                 request.user.profile_image = None
                 request.user.save()
+                invalidate_cached_user(request.user.id)
                 
                 # Broadcast user update to all chat rooms
                 self.broadcast_user_update(request.user)
@@ -499,28 +410,21 @@ class ProfileImageUploadView(APIView):
             })
     
     def broadcast_user_update(self, user):
-        """Broadcast user profile update to all chat rooms where user participates"""
+        """Notify everyone who shares a chat room with the user about their new profile"""
+        from chat.fanout import fanout_queue, room_contacts
         from chat.models import ChatRoom
         
-        channel_layer = get_channel_layer()
-        if not channel_layer:
-            return
-        
-        # Get all chat rooms where user is a participant
-        user_rooms = ChatRoom.objects.filter(participants=user, is_active=True)
+        room_ids = ChatRoom.objects.filter(participants=user, is_active=True).values_list('id', flat=True)
         
-        for room in user_rooms:
-            group_name = f'chat_{room.id}'
-            
-            # Send user profile update message to the room group
-            async_to_sync(channel_layer.group_send)(group_name, {
-                'type': 'user_profile_update',
-                'user': {
-                    'id': user.id,
-                    'username': user.username,
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                    'email': user.email,
-                    'profile_image': user.profile_image.url if user.profile_image else None
-                }
-            })
+        user_data = {
+            'id': user.id,
+            'username': user.username,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'email': user.email,
+            'profile_image': user.profile_image.url if user.profile_image else None
+        }
+        fanout_queue.submit({
+            contact_id: build_event('user_profile_update', user=user_data, room_ids=shared_room_ids)
+            for contact_id, shared_room_ids in room_contacts(room_ids).items()
+        })
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+    
+    def ready(self):
+        from core import metrics
+        metrics.install()
@@ -0,0 +1,67 @@
+"""
+Helpers shared by the chat benchmark management commands.
+"""
+
+import contextlib
+import statistics
+from channels.testing import WebsocketCommunicator
+from django.test.utils import (
+    setup_databases, setup_test_environment,
+    teardown_databases, teardown_test_environment
+)
+from rest_framework_simplejwt.tokens import AccessToken
+from accounts.models import User
+from .models import ChatRoom
+
+
+@contextlib.contextmanager
+def benchmark_database(verbosity=0):
+    """Run the enclosed block against a throwaway test database."""
+    setup_test_environment()
+    old_config = setup_databases(verbosity=verbosity, interactive=False)
+    try:
+        yield
+    finally:
+        teardown_databases(old_config, verbosity=verbosity)
+        teardown_test_environment()
+
+
+def create_users(count, prefix='bench'):
+    """Create benchmark users and return them with an access token each."""
+    users = User.objects.bulk_create([
+        User(username=f'{prefix}{i}', email=f'{prefix}{i}@bench.local', is_verified=True)
+        for i in range(count)
+    ])
+    # bulk_create does not return primary keys on every backend
+    users = list(User.objects.filter(username__startswith=prefix).order_by('id'))
+    return [(user, str(AccessToken.for_user(user))) for user in users]
+
+
+def create_room(users, name='bench'):
+    """Create a group room with ``users`` as participants."""
+    room = ChatRoom.objects.create(name=name, room_type='group', created_by=users[0])
+    room.add_participants(*users)
+    return room
+
+
+def room_communicator(application, room_id, token):
+    """An in-process client for a room socket, as a browser on localhost would open it."""
+    return WebsocketCommunicator(
+        application,
+        f'/ws/chat/{room_id}/?token={token}',
+        headers=[(b'origin', b'http://localhost')]
+    )
+
+
+def summarize(samples):
+    """Latency percentiles in milliseconds of ``samples`` given in seconds."""
+    samples = sorted(sample * 1000 for sample in samples)
+    cuts = statistics.quantiles(samples, n=100, method='inclusive') if len(samples) > 1 else samples * 99
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.fmean(samples), 3),
+        'p50_ms': round(cuts[49], 3),
+        'p95_ms': round(cuts[94], 3),
+        'p99_ms': round(cuts[98], 3),
+        'max_ms': round(samples[-1], 3),
+    }
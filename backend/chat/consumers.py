@@ -1,254 +1,686 @@
 import json
+import time
 import base64
+import asyncio
+import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.utils import timezone
+from django.core.files import File
 from django.core.files.base import ContentFile
-from .models import ChatRoom, Message, FileAttachment, UserStatus
+from django.db import IntegrityError
+from .models import ChatRoom, Message, FileAttachment, RoomReadState
+from .events import build_event, event_text
+from .fanout import fanout_queue
+from .outbound import SLOW_CONSUMER_CLOSE_CODE, OutboundQueue, server_transport
+from .storage import run_in_storage_executor, store_attachment_file
+from .presence import presence
+from .resume import RESUME_BATCH_SIZE, RESUME_MAX_MESSAGES, messages_after
+from .search import search_index_queue
+from .touches import room_touches
+from .typing_indicators import typing_tracker
+from .uploads import MAX_UPLOAD_SIZE, UploadError, discard_uploads, upload_registry
+from .writebehind import message_buffer, seq_reservations
 from accounts.models import User
+from core import metrics
+
+logger = logging.getLogger(__name__)
+
+# Frame types handled by handle_room_action, used as metric labels
+ROOM_ACTIONS = {
+    'chat_message', 'file_message', 'file_start', 'file_chunk', 'file_end',
+    'file_cancel', 'typing_start', 'typing_stop', 'mark_read', 'resume',
+}
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    One socket per room (``ws/chat/<room_id>/``).
+    
+    Room actions take the cached room they apply to, so the same handlers
+    also serve MultiplexChatConsumer. Every event broadcast to a room group
+    carries its ``room_id``; events about users (``user_update``,
+    ``user_profile_update``) arrive once on the ``user_<id>`` group with
+    the ``room_ids`` they concern.
+    
+    Everything sent to the client goes through a bounded per-connection
+    queue (see chat/outbound.py), so a slow client never holds up the
+    consumer.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound = OutboundQueue(self.write_frame)
+    
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
+        self.pending_uploads = set()
+        self.upload_ids = set()
+        self.room = None
         
         # Check if user is authenticated
         if self.scope['user'] == AnonymousUser():
             await self.close()
             return
         
+        # Load room metadata and membership once for the whole connection
+        self.room = await self.load_room(self.room_id)
+        if self.room is None:
+            await self.close(code=4003)
+            return
+        
         # Join room group
         await self.channel_layer.group_add(
-            self.room_group_name,
+            self.room['group_name'],
             self.channel_name
         )
         
-        await self.accept()
+        # Join user's personal group for user and chat list updates
+        self.user_group_name = f'user_{self.scope["user"].id}'
+        await self.channel_layer.group_add(
+            self.user_group_name,
+            self.channel_name
+        )
+        fanout_queue.bind()
+        search_index_queue.bind()
         
-        # Update user status to online
-        await self.update_user_status('online')
+        await self.accept()
+        if metrics.enabled:
+            metrics.ROOM_CONNECTIONS.inc(consumer='chat')
         
-        # Notify others that user joined
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'user_status',
-                'user_id': self.scope['user'].id,
-                'username': self.scope['user'].username,
-                'status': 'online'
-            }
-        )
+        # Count this socket towards the user's presence and announce them here
+        await presence.connect(self.scope['user'], self.channel_name)
+        await presence.join(self.scope['user'], self.room)
     
     async def disconnect(self, close_code):
-        # Update user status to offline
-        if hasattr(self, 'scope') and self.scope['user'] != AnonymousUser():
-            await self.update_user_status('offline')
-            
-            # Notify others that user left
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_status',
-                    'user_id': self.scope['user'].id,
-                    'username': self.scope['user'].username,
-                    'status': 'offline'
-                }
-            )
+        self.outbound.close()
+        await self.discard_uploads()
+        if getattr(self, 'room', None) is None:
+            return
+        
+        typing_tracker.stop(self.room['id'], self.scope['user'])
+        if metrics.enabled:
+            metrics.ROOM_CONNECTIONS.dec(consumer='chat')
+        
+        # Goes offline (and notifies others) only when the last socket closes
+        await presence.disconnect(self.scope['user'].id, self.channel_name)
         
         # Leave room group
-        if hasattr(self, 'room_group_name'):
-            await self.channel_layer.group_discard(
-                self.room_group_name,
-                self.channel_name
-            )
+        await self.channel_layer.group_discard(
+            self.room['group_name'],
+            self.channel_name
+        )
+        await self.channel_layer.group_discard(
+            self.user_group_name,
+            self.channel_name
+        )
     
     async def receive(self, text_data):
+        # Any frame, including an explicit heartbeat, keeps the socket alive
+        presence.heartbeat(self.scope['user'].id, self.channel_name)
         try:
             data = json.loads(text_data)
-            message_type = data.get('type')
-            
-            if message_type == 'chat_message':
-                await self.handle_chat_message(data)
-            elif message_type == 'file_message':
-                await self.handle_file_message(data)
-            elif message_type == 'typing_start':
-                await self.handle_typing_indicator(data, True)
-            elif message_type == 'typing_stop':
-                await self.handle_typing_indicator(data, False)
-            elif message_type == 'mark_read':
-                await self.handle_mark_read(data)
         except json.JSONDecodeError:
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': 'Invalid JSON format'
-            }))
+            await self.send_error('Invalid JSON format')
+            return
+        
+        if data.get('type') != 'heartbeat':
+            await self.handle_room_action(self.room, data)
+    
+    async def handle_room_action(self, room, data):
+        if not metrics.enabled:
+            await self.dispatch_room_action(room, data)
+            return
+        
+        started = time.perf_counter()
+        try:
+            await self.dispatch_room_action(room, data)
+        finally:
+            metrics.EVENT_SECONDS.observe(
+                time.perf_counter() - started,
+                event=data.get('type') if data.get('type') in ROOM_ACTIONS else 'unknown'
+            )
+    
+    async def dispatch_room_action(self, room, data):
+        message_type = data.get('type')
+        
+        if message_type == 'chat_message':
+            await self.handle_chat_message(room, data)
+        elif message_type == 'file_message':
+            await self.handle_file_message(room, data)
+        elif message_type == 'file_start':
+            await self.handle_file_start(data)
+        elif message_type == 'file_chunk':
+            await self.handle_file_chunk(data)
+        elif message_type == 'file_end':
+            await self.handle_file_end(room, data)
+        elif message_type == 'file_cancel':
+            await self.discard_uploads([data.get('upload_id')])
+        elif message_type == 'typing_start':
+            await self.handle_typing_indicator(room, data, True)
+        elif message_type == 'typing_stop':
+            await self.handle_typing_indicator(room, data, False)
+        elif message_type == 'mark_read':
+            await self.handle_mark_read(room, data)
+        elif message_type == 'resume':
+            await self.handle_resume(room, data)
+    
+    async def enqueue_send(self, text_data, kind=None):
+        """
+        Queue a frame for the writer task; ``kind`` marks low-priority frames.
+        Frames to the client go through here rather than ``send``, which
+        writes straight away.
+        """
+        if not self.outbound.put(text_data, kind):
+            await self.close_slow_consumer()
+    
+    async def write_frame(self, text):
+        await super().send(text_data=text)
+    
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        # The writer holds back while the server's write buffer is full
+        self.outbound.attach(server_transport(self.base_send))
+    
+    async def close_slow_consumer(self):
+        # Hopelessly behind: stop writing, the client reconnects and resumes
+        self.outbound.close()
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+    
+    async def send_error(self, message, **extra):
+        await self.enqueue_send(json.dumps({
+            'type': 'error',
+            'message': message,
+            **extra
+        }))
     
-    async def handle_chat_message(self, data):
+    async def handle_chat_message(self, room, data):
         message_content = data['message']
         
-        # Save message to database
-        message = await self.save_message(
-            content=message_content,
-            message_type='text'
-        )
+        if settings.CHAT_WRITE_BEHIND:
+            # Broadcast now, the buffer inserts it with the next batch
+            seq = await seq_reservations.reserve(room['id'])
+            if seq is None:
+                return
+            message = message_buffer.add(room['id'], self.scope['user'], message_content, seq)
+        else:
+            # Save message to database
+            message = await self.save_message(
+                room,
+                content=message_content,
+                message_type='text'
+            )
         
         if message:
             # Send message to room group
             await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat_message',
-                    'message_id': message.id,
-                    'message': message_content,
-                    'sender': self.scope['user'].username,
-                    'sender_id': self.scope['user'].id,
-                    'timestamp': message.timestamp.isoformat(),
-                    'message_type': 'text'
-                }
+                room['group_name'],
+                build_event(
+                    'chat_message',
+                    room_id=room['id'],
+                    message_id=message.id,
+                    message=message_content,
+                    sender=self.scope['user'].username,
+                    sender_id=self.scope['user'].id,
+                    timestamp=message.timestamp.isoformat(),
+                    seq=message.seq,
+                    message_type='text'
+                )
             )
     
-    async def handle_file_message(self, data):
+    async def handle_file_message(self, room, data):
+        """Accept a whole file in one base64 frame (small files, legacy clients)."""
         try:
             file_data = data['file_data']  # base64 encoded file
             file_name = data['file_name']
             file_type = data.get('file_type', 'application/octet-stream')
             
+            # Check file size (10MB limit) before decoding anything
+            if len(file_data) * 3 // 4 > MAX_UPLOAD_SIZE:
+                await self.send_error('File size exceeds 10MB limit')
+                return
+            
             # Decode base64 file
             file_content = base64.b64decode(file_data)
             
-            # Check file size (10MB limit)
-            if len(file_content) > 10 * 1024 * 1024:
-                await self.send(text_data=json.dumps({
-                    'type': 'error',
-                    'message': 'File size exceeds 10MB limit'
-                }))
-                return
-            
-            # Save message and file
-            message = await self.save_message(
-                content=f"Shared a file: {file_name}",
-                message_type='file'
+            await self.share_file(room, ContentFile(file_content, name=file_name), file_name, file_type)
+        except Exception as e:
+            await self.send_error(f'Error processing file: {str(e)}')
+    
+    async def handle_file_start(self, data):
+        expired = upload_registry.purge_expired()
+        if expired:
+            await run_in_storage_executor(discard_uploads, expired)
+        
+        try:
+            upload = upload_registry.start(
+                self.scope['user'].id,
+                data.get('upload_id'),
+                data.get('file_name'),
+                data.get('file_type'),
+                data.get('file_size')
             )
-            
-            if message:
-                # Save file attachment
-                file_attachment = await self.save_file_attachment(
-                    message, file_content, file_name, file_type
-                )
-                
-                # Send file message to room group
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'file_message',
-                        'message_id': message.id,
-                        'message': message.content,
-                        'sender': self.scope['user'].username,
-                        'sender_id': self.scope['user'].id,
-                        'timestamp': message.timestamp.isoformat(),
-                        'file_name': file_name,
-                        'file_size': len(file_content),
-                        'file_type': file_type,
-                        'file_url': file_attachment.file.url if file_attachment else None,
-                        'message_type': 'file'
-                    }
-                )
+        except UploadError as e:
+            await self.send_error(str(e), upload_id=data.get('upload_id'))
+            return
+        
+        self.upload_ids.add(upload.upload_id)
+        # The acknowledged offset tells resuming clients where to continue
+        await self.send_upload_ack(upload)
+    
+    async def handle_file_chunk(self, data):
+        upload_id = data.get('upload_id')
+        try:
+            upload = upload_registry.get(self.scope['user'].id, upload_id)
+            # Frames are handled one at a time, so chunks still land in order
+            await run_in_storage_executor(upload.write_chunk, data.get('offset'), data.get('data', ''))
+        except UploadError as e:
+            await self.send_error(str(e), upload_id=upload_id)
+            return
+        
+        await self.send_upload_ack(upload)
+    
+    async def handle_file_end(self, room, data):
+        upload_id = data.get('upload_id')
+        try:
+            upload = upload_registry.pop(self.scope['user'].id, upload_id)
+        except UploadError as e:
+            await self.send_error(str(e), upload_id=upload_id)
+            return
+        self.upload_ids.discard(upload_id)
+        
+        def open_upload():
+            return File(open(upload.finish(), 'rb'), name=upload.file_name)
+        
+        try:
+            django_file = await run_in_storage_executor(open_upload)
+        except UploadError as e:
+            await run_in_storage_executor(upload.discard)
+            await self.send_error(str(e), upload_id=upload_id)
+            return
+        
+        def cleanup():
+            django_file.close()
+            upload.discard()
+        
+        try:
+            await self.share_file(room, django_file, upload.file_name, upload.file_type, cleanup=cleanup)
         except Exception as e:
-            await self.send(text_data=json.dumps({
-                'type': 'error',
-                'message': f'Error processing file: {str(e)}'
-            }))
+            await run_in_storage_executor(cleanup)
+            await self.send_error(f'Error processing file: {str(e)}', upload_id=upload_id)
+    
+    async def discard_uploads(self, upload_ids=None):
+        """Drop this connection's unfinished uploads (all of them by default) and their temp files."""
+        if upload_ids is None:
+            upload_ids = list(self.upload_ids)
+        self.upload_ids.difference_update(upload_ids)
+        uploads = upload_registry.release(self.scope['user'].id, upload_ids)
+        if uploads:
+            await run_in_storage_executor(discard_uploads, uploads)
+    
+    async def send_upload_ack(self, upload):
+        await self.enqueue_send(json.dumps({
+            'type': 'file_ack',
+            'upload_id': upload.upload_id,
+            'offset': upload.received,
+            'file_size': upload.file_size
+        }))
+    
+    async def share_file(self, room, django_file, file_name, file_type, cleanup=None):
+        """
+        Broadcast a file message straight away as 'uploading', then commit the
+        attachment in the background and follow up with a file_message_update.
+        """
+        file_size = django_file.size
+        
+        # Save message and file
+        message = await self.save_message(
+            room,
+            content=f"Shared a file: {file_name}",
+            message_type='file'
+        )
+        
+        if not message:
+            if cleanup:
+                await run_in_storage_executor(cleanup)
+            return
+        
+        # Send file message to room group
+        await self.channel_layer.group_send(
+            room['group_name'],
+            build_event(
+                'file_message',
+                room_id=room['id'],
+                message_id=message.id,
+                message=message.content,
+                sender=self.scope['user'].username,
+                sender_id=self.scope['user'].id,
+                timestamp=message.timestamp.isoformat(),
+                seq=message.seq,
+                file_name=file_name,
+                file_size=file_size,
+                file_type=file_type,
+                file_url=None,
+                upload_status='uploading',
+                message_type='file'
+            )
+        )
+        
+        # Keep a reference so the task is not garbage collected mid-write
+        task = asyncio.ensure_future(
+            self.commit_file_attachment(room, message, django_file, file_name, file_type, cleanup)
+        )
+        self.pending_uploads.add(task)
+        task.add_done_callback(self.pending_uploads.discard)
     
-    async def handle_typing_indicator(self, data, is_typing):
+    async def commit_file_attachment(self, room, message, django_file, file_name, file_type, cleanup=None):
+        file_attachment = None
+        try:
+            stored_name = await run_in_storage_executor(
+                store_attachment_file, message, django_file, file_name
+            )
+            file_attachment = await self.save_file_attachment(
+                message, stored_name, file_name, django_file.size, file_type
+            )
+        except Exception:
+            logger.exception('Error saving file of message %s', message.id)
+        finally:
+            if cleanup:
+                await run_in_storage_executor(cleanup)
+        
         await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'typing_indicator',
-                'user_id': self.scope['user'].id,
-                'username': self.scope['user'].username,
-                'is_typing': is_typing
-            }
+            room['group_name'],
+            build_event(
+                'file_message_update',
+                room_id=room['id'],
+                message_id=message.id,
+                attachment_id=file_attachment.id if file_attachment else None,
+                file_url=file_attachment.file.url if file_attachment else None,
+                upload_status='complete' if file_attachment else 'failed'
+            )
         )
     
-    async def handle_mark_read(self, data):
+    async def handle_typing_indicator(self, room, data, is_typing):
+        # Coalesced into a periodic typing_digest for the room
+        if is_typing:
+            typing_tracker.start(room['id'], self.scope['user'])
+        else:
+            typing_tracker.stop(room['id'], self.scope['user'])
+    
+    async def handle_mark_read(self, room, data):
         message_id = data.get('message_id')
         if message_id:
-            await self.mark_message_as_read(message_id)
+            await self.mark_message_as_read(room, message_id)
     
-    # Event handlers for group messages
+    async def handle_resume(self, room, data):
+        """Send the messages after the client's ``last_seq`` in bounded batches."""
+        try:
+            after_seq = int(data.get('last_seq'))
+        except (TypeError, ValueError):
+            await self.send_error('Invalid last_seq', room_id=room['id'])
+            return
+        
+        sent = 0
+        complete = True
+        while True:
+            messages = await database_sync_to_async(messages_after)(
+                room['id'],
+                after_seq,
+                self.scope['user'],
+                RESUME_BATCH_SIZE,
+                message_buffer.buffered(room['id'])
+            )
+            if messages:
+                await self.enqueue_send(json.dumps({
+                    'type': 'resume_batch',
+                    'room_id': room['id'],
+                    'messages': messages
+                }))
+                after_seq = messages[-1]['seq']
+                sent += len(messages)
+            if len(messages) < RESUME_BATCH_SIZE:
+                break
+            if sent >= RESUME_MAX_MESSAGES:
+                # Too far behind, the client reloads the history instead
+                complete = False
+                break
+        
+        await self.enqueue_send(json.dumps({
+            'type': 'resume_done',
+            'room_id': room['id'],
+            'last_seq': after_seq,
+            'complete': complete
+        }))
+    
+    # Event handlers for group messages; the frame was encoded once by the sender
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.enqueue_send(event_text(event))
     
     async def file_message(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.enqueue_send(event_text(event))
+    
+    async def file_message_update(self, event):
+        await self.enqueue_send(event_text(event))
     
     async def user_status(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.enqueue_send(event_text(event), kind='user_status')
     
-    async def typing_indicator(self, event):
-        # Don't send typing indicator back to the sender
-        if event['user_id'] != self.scope['user'].id:
-            await self.send(text_data=json.dumps(event))
+    async def typing_digest(self, event):
+        # Clients skip their own entry in the digest
+        await self.enqueue_send(event_text(event), kind='typing_digest')
     
     async def user_update(self, event):
         # Send user update to all participants
-        await self.send(text_data=json.dumps(event))
+        await self.enqueue_send(event_text(event))
     
     async def user_profile_update(self, event):
         # Send user profile update to all participants
-        await self.send(text_data=json.dumps(event))
+        await self.enqueue_send(event_text(event))
+    
+    async def chat_list_update(self, event):
+        await self.enqueue_send(event_text(event))
+    
+    async def room_invalidate(self, event):
+        # Room settings or membership changed, refresh the cached copy
+        self.room = await self.load_room(self.room_id)
+        if self.room is None:
+            await self.close(code=4003)
+    
+    async def presence_expired(self, event):
+        # Missed heartbeats; the client reconnects and resumes
+        await self.close()
     
     # Database operations
     @database_sync_to_async
-    def save_message(self, content, message_type):
+    def load_room(self, room_id):
+        """Load the room if it is active and the user is one of its participants."""
+        try:
+            room = ChatRoom.objects.only('id', 'name', 'room_type').get(
+                id=room_id,
+                is_active=True
+            )
+        except (ChatRoom.DoesNotExist, ValueError, TypeError):
+            return None
+        
+        participant_ids = set(room.participants.values_list('id', flat=True))
+        if self.scope['user'].id not in participant_ids:
+            return None
+        
+        return {
+            'id': room.id,
+            'name': room.name,
+            'room_type': room.room_type,
+            'group_name': f'chat_{room.id}',
+            'participant_ids': participant_ids,
+        }
+    
+    async def save_message(self, room, content, message_type):
+        message = await self.create_message(room, content, message_type)
+        # Writes room bumps that create_message deferred
+        room_touches.ensure_flusher()
+        return message
+    
+    @database_sync_to_async
+    def create_message(self, room, content, message_type):
         try:
-            room = ChatRoom.objects.get(id=self.room_id)
             message = Message.objects.create(
-                room=room,
+                room_id=room['id'],
                 sender=self.scope['user'],
                 content=content,
                 message_type=message_type
             )
-            # Update room's updated_at timestamp
-            room.save()
-            return message
-        except ChatRoom.DoesNotExist:
+        except IntegrityError:
+            # Room was deleted after the connection cached it
             return None
+        
+        # Update room's updated_at timestamp
+        room_touches.touch(room['id'], message.timestamp)
+        return message
     
     @database_sync_to_async
-    def save_file_attachment(self, message, file_content, file_name, file_type):
-        try:
-            # Create ContentFile from binary data
-            django_file = ContentFile(file_content, name=file_name)
-            
-            file_attachment = FileAttachment(
-                message=message,
-                file_type=file_type
-            )
-            file_attachment.file.save(file_name, django_file, save=True)
-            return file_attachment
-        except Exception as e:
-            print(f"Error saving file: {e}")
-            return None
+    def save_file_attachment(self, message, stored_name, file_name, file_size, file_type):
+        # The content is already in storage, only the row is written here
+        return FileAttachment.objects.create(
+            message=message,
+            file=stored_name,
+            file_name=file_name,
+            file_size=file_size,
+            file_type=file_type
+        )
     
     @database_sync_to_async
-    def mark_message_as_read(self, message_id):
+    def mark_message_as_read(self, room, message_id):
         try:
-            message = Message.objects.get(id=message_id)
-            message.mark_as_read(self.scope['user'])
-        except Message.DoesNotExist:
+            RoomReadState.mark_read(
+                room['id'],
+                self.scope['user'].id,
+                int(message_id),
+                buffered=message_buffer.buffered(room['id'])
+            )
+        except (TypeError, ValueError):
             pass
+
+
+class MultiplexChatConsumer(ChatConsumer):
+    """
+    One socket for all of a user's rooms (``ws/multiplex/``).
     
-    @database_sync_to_async
-    def update_user_status(self, status):
-        user_status, created = UserStatus.objects.get_or_create(
-            user=self.scope['user'],
-            defaults={'status': status}
+    Clients send ``subscribe``/``unsubscribe`` frames with a ``room_id`` and
+    tag every room action with the ``room_id`` it applies to. Room events come
+    back with their ``room_id``, and chat list updates arrive on the same
+    socket, so a user needs one connection and one handshake in total.
+    """
+    
+    # Upper bound on rooms a single socket may follow
+    max_rooms = 200
+    
+    async def connect(self):
+        self.rooms = {}
+        self.pending_uploads = set()
+        self.upload_ids = set()
+        
+        if self.scope['user'] == AnonymousUser():
+            await self.close()
+            return
+        
+        self.user_group_name = f'user_{self.scope["user"].id}'
+        await self.channel_layer.group_add(
+            self.user_group_name,
+            self.channel_name
         )
-        if not created:
-            user_status.status = status
-            user_status.save()
+        fanout_queue.bind()
+        search_index_queue.bind()
+        
+        await self.accept()
+        await presence.connect(self.scope['user'], self.channel_name)
+    
+    async def disconnect(self, close_code):
+        self.outbound.close()
+        await self.discard_uploads()
+        if not hasattr(self, 'user_group_name'):
+            return
+        
+        await presence.disconnect(self.scope['user'].id, self.channel_name)
+        for room_id in list(self.rooms):
+            await self.leave_room(room_id)
+        
+        await self.channel_layer.group_discard(
+            self.user_group_name,
+            self.channel_name
+        )
+    
+    async def receive(self, text_data):
+        presence.heartbeat(self.scope['user'].id, self.channel_name)
+        try:
+            data = json.loads(text_data)
+        except json.JSONDecodeError:
+            await self.send_error('Invalid JSON format')
+            return
+        
+        message_type = data.get('type')
+        room_id = data.get('room_id')
+        
+        if message_type == 'heartbeat':
+            return
+        elif message_type == 'subscribe':
+            await self.subscribe(room_id)
+        elif message_type == 'unsubscribe':
+            await self.leave_room(self.normalize_room_id(room_id))
+            await self.enqueue_send(json.dumps({'type': 'unsubscribed', 'room_id': room_id}))
+        else:
+            room = self.rooms.get(self.normalize_room_id(room_id))
+            if room is None:
+                await self.send_error('Not subscribed to room', room_id=room_id)
+                return
+            await self.handle_room_action(room, data)
+    
+    def normalize_room_id(self, room_id):
+        try:
+            return int(room_id)
+        except (TypeError, ValueError):
+            return None
+    
+    async def subscribe(self, room_id):
+        room_id = self.normalize_room_id(room_id)
+        if room_id in self.rooms:
+            await self.enqueue_send(json.dumps({'type': 'subscribed', 'room_id': room_id}))
+            return
+        if len(self.rooms) >= self.max_rooms:
+            await self.send_error('Too many rooms on one connection', room_id=room_id)
+            return
+        
+        room = await self.load_room(room_id)
+        if room is None:
+            await self.send_error('Room not found', room_id=room_id)
+            return
+        
+        self.rooms[room_id] = room
+        await self.channel_layer.group_add(room['group_name'], self.channel_name)
+        if metrics.enabled:
+            metrics.ROOM_CONNECTIONS.inc(consumer='multiplex')
+        await self.enqueue_send(json.dumps({'type': 'subscribed', 'room_id': room_id}))
+        await presence.join(self.scope['user'], room)
+    
+    async def leave_room(self, room_id):
+        room = self.rooms.pop(room_id, None)
+        if room is None:
+            return
+        typing_tracker.stop(room_id, self.scope['user'])
+        if metrics.enabled:
+            metrics.ROOM_CONNECTIONS.dec(consumer='multiplex')
+        await self.channel_layer.group_discard(room['group_name'], self.channel_name)
+    
+    async def room_invalidate(self, event):
+        room_id = event['room_id']
+        if room_id not in self.rooms:
+            return
+        room = await self.load_room(room_id)
+        if room is None:
+            await self.leave_room(room_id)
+            await self.enqueue_send(json.dumps({'type': 'unsubscribed', 'room_id': room_id}))
+        else:
+            self.rooms[room_id] = room
 
 
 class ChatListConsumer(AsyncWebsocketConsumer):
@@ -266,6 +698,7 @@ class ChatListConsumer(AsyncWebsocketConsumer):
             self.user_group_name,
             self.channel_name
         )
+        fanout_queue.bind()
         
         await self.accept()
     
@@ -282,4 +715,11 @@ class ChatListConsumer(AsyncWebsocketConsumer):
     
     # Event handlers
     async def chat_list_update(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send(text_data=event_text(event))
+    
+    async def user_update(self, event):
+        # Renamed contact, lists show the new name
+        await self.send(text_data=event_text(event))
+    
+    async def user_profile_update(self, event):
+        await self.send(text_data=event_text(event))
@@ -0,0 +1,91 @@
+"""
+Background fan-out of per-user events.
+
+Profile and username changes concern everyone who shares a room with the
+user. Instead of one broadcast per room from inside the HTTP request, the
+view resolves the recipients with a couple of queries and queues one event
+per recipient for their ``user_<id>`` group. A task on the server's event
+loop sends each job's events concurrently, so the request returns as soon
+as the job is queued.
+
+The jobs have to run on the loop the consumers live on: the in-memory
+channel layer only wakes a receiver when the event is put from its own
+loop. Consumers bind that loop when they join a user group. A process that
+serves no sockets (a management command, a WSGI worker) sends right away.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from .models import ChatRoom
+
+logger = logging.getLogger(__name__)
+
+# group_send calls in flight at once for a single job
+SEND_CONCURRENCY = 100
+
+
+def room_contacts(room_ids):
+    """Map every participant of the given rooms to the room ids they are in."""
+    Participant = ChatRoom.participants.through
+    contacts = {}
+    memberships = Participant.objects.filter(
+        chatroom_id__in=room_ids
+    ).values_list('user_id', 'chatroom_id')
+    for user_id, room_id in memberships:
+        contacts.setdefault(user_id, []).append(room_id)
+    return contacts
+
+
+async def send_to_users(events):
+    """Send each user (``{user_id: event}``) their event on the user group."""
+    channel_layer = get_channel_layer()
+    items = list(events.items())
+    for start in range(0, len(items), SEND_CONCURRENCY):
+        await asyncio.gather(*(
+            channel_layer.group_send(f'user_{user_id}', event)
+            for user_id, event in items[start:start + SEND_CONCURRENCY]
+        ))
+
+
+class FanoutQueue:
+    """Runs queued fan-out jobs one after another on the server's event loop."""
+
+    def __init__(self):
+        self.jobs = deque()
+        self.loop = None
+        self.task = None
+
+    def bind(self):
+        """Send future jobs on the running loop; called by consumers on connect."""
+        self.loop = asyncio.get_running_loop()
+
+    def submit(self, events):
+        """Queue a job from synchronous code, e.g. a view running in a worker thread."""
+        if not events:
+            return
+        loop = self.loop
+        if loop is None or not loop.is_running():
+            async_to_sync(self.send)(events)
+            return
+        loop.call_soon_threadsafe(self.enqueue, events)
+
+    def enqueue(self, events):
+        self.jobs.append(events)
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def send(self, events):
+        try:
+            await send_to_users(events)
+        except Exception:
+            logger.exception('Error fanning out user events')
+
+    async def run(self):
+        while self.jobs:
+            await self.send(self.jobs.popleft())
+
+
+fanout_queue = FanoutQueue()
@@ -0,0 +1,69 @@
+"""
+Time-ordered message ids assigned by the application.
+
+Layout (most significant first): 40 bits of milliseconds since ``EPOCH``,
+6 bits of worker id and 7 bits of sequence. Ids from one worker are
+strictly increasing, and ids from different workers sort by creation time
+to within clock skew, so they keep working as the tie-breaker of the
+``(timestamp, id)`` history ordering. They are always larger than the
+auto-increment ids issued before the generator was switched on.
+
+Ids stay below 2**53 until 2058, so JavaScript clients read them as exact
+numbers.
+"""
+
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+EPOCH_MS = 1704067200000  # 2024-01-01T00:00:00Z
+WORKER_BITS = 6
+SEQUENCE_BITS = 7
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class MessageIdGenerator:
+    """Snowflake-style id source, safe to share between threads."""
+
+    def __init__(self, worker_id=0):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f'worker_id must be between 0 and {MAX_WORKER_ID}')
+        self.worker_id = worker_id
+        self.last_ms = 0
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            # Never step back in time, even if the system clock does
+            now_ms = max(int(time.time() * 1000) - EPOCH_MS, self.last_ms)
+            if now_ms == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # Sequence exhausted for this millisecond, borrow the next one
+                    now_ms += 1
+            else:
+                self.sequence = 0
+            self.last_ms = now_ms
+            return (now_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+
+def configured_worker_id():
+    """
+    The worker id from settings. Two processes with the same id would hand
+    out the same message ids, so write-behind refuses to guess one.
+    """
+    if settings.CHAT_WORKER_ID is None:
+        if settings.CHAT_WRITE_BEHIND:
+            raise ImproperlyConfigured(
+                f'CHAT_WRITE_BEHIND needs CHAT_WORKER_ID (0-{MAX_WORKER_ID}), '
+                'set to a different value for every worker process'
+            )
+        # Ids are only generated with write-behind on
+        return 0
+    return settings.CHAT_WORKER_ID
+
+
+message_ids = MessageIdGenerator(configured_worker_id())
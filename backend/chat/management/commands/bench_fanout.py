@@ -0,0 +1,68 @@
+import json
+import time
+import msgpack
+from django.core.management.base import BaseCommand
+from chat import events
+
+
+def sample_payload(i):
+    return {
+        'room_id': 1,
+        'message_id': i,
+        'message': 'The quick brown fox jumps over the lazy dog. ' * 4,
+        'sender': 'bench_sender',
+        'sender_id': 42,
+        'timestamp': '2024-01-01T12:00:00.000000+00:00',
+        'message_type': 'text',
+    }
+
+
+def per_recipient_encode(i, recipients):
+    """Old path: the bare event crosses the layer, every consumer encodes it."""
+    packed = msgpack.packb({'type': 'chat_message', **sample_payload(i)})
+    for _ in range(recipients):
+        event = msgpack.unpackb(packed)
+        json.dumps(event)
+
+
+def encode_once(i, recipients):
+    """New path: the sender encodes the frame, consumers forward it."""
+    packed = msgpack.packb(events.build_event('chat_message', **sample_payload(i)))
+    for _ in range(recipients):
+        event = msgpack.unpackb(packed)
+        events.event_text(event)
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure CPU spent fanning one chat message out to a room, with the '
+        'channel layer hop simulated by msgpack like channels_redis does.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200)
+        parser.add_argument('--recipients', type=int, nargs='+', default=[10, 100, 1000])
+
+    def handle(self, *args, **options):
+        variants = [
+            ('per-recipient json', per_recipient_encode, None),
+            ('encode-once json', encode_once, None),
+        ]
+        if events.orjson is not None:
+            variants.append(('encode-once orjson', encode_once, events.orjson))
+
+        original_orjson = events.orjson
+        try:
+            for recipients in options['recipients']:
+                for label, fan_out, encoder in variants:
+                    events.orjson = encoder
+                    started = time.process_time()
+                    for i in range(options['messages']):
+                        fan_out(i, recipients)
+                    elapsed = time.process_time() - started
+                    per_message = elapsed / options['messages'] * 1e6
+                    self.stdout.write(
+                        f'{recipients:>5} recipients  {label:<20} {per_message:>10,.0f} us CPU/message'
+                    )
+        finally:
+            events.orjson = original_orjson
@@ -0,0 +1,47 @@
+import time
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from chat.benchmarks import benchmark_database, create_users
+from chat.middleware import JWTAuthMiddleware, user_cache
+
+
+async def accept(scope, receive, send):
+    """Stand-in for the URL router: the handshake ends once auth is done."""
+    return scope['user']
+
+
+async def run_handshakes(tokens, connects):
+    middleware = JWTAuthMiddleware(accept)
+    started = time.perf_counter()
+    for i in range(connects):
+        scope = {
+            'type': 'websocket',
+            'query_string': f'token={tokens[i % len(tokens)]}'.encode(),
+        }
+        user = await middleware(scope, None, None)
+        assert user.is_authenticated
+    return connects / (time.perf_counter() - started)
+
+
+class Command(BaseCommand):
+    help = 'Measure WebSocket JWT handshakes per second with and without the user cache.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connects', type=int, default=2000)
+        parser.add_argument('--users', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            tokens = [token for _, token in create_users(options['users'])]
+            original_ttl = user_cache.ttl
+
+            try:
+                for label, ttl in (('uncached', 0), ('cached', settings.WS_USER_CACHE_TTL or 30)):
+                    user_cache.ttl = ttl
+                    user_cache.clear()
+                    rate = async_to_sync(run_handshakes)(tokens, options['connects'])
+                    self.stdout.write(f'{label:>9}: {rate:,.0f} connects/s')
+            finally:
+                user_cache.ttl = original_ttl
+                user_cache.clear()
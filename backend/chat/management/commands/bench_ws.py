@@ -0,0 +1,279 @@
+import asyncio
+import itertools
+import json
+import platform
+import subprocess
+import time
+import django
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+from chat.benchmarks import benchmark_database, create_room, create_users, room_communicator, summarize
+
+IN_MEMORY_LAYER = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+markers = itertools.count()
+
+# Seconds between client heartbeats, as in the frontend
+HEARTBEAT_INTERVAL = 25
+
+
+async def receive_message(client, content, timeout):
+    """Wait for the chat_message carrying ``content``, skipping presence and typing frames."""
+    while True:
+        frame = await client.receive_json_from(timeout=timeout)
+        if frame.get('type') == 'chat_message' and frame.get('message') == content:
+            return
+
+
+async def settle(sender, clients, timeout):
+    """Send a marker and wait until every client saw it, draining earlier frames."""
+    content = f'marker {next(markers)}'
+    await sender.send_json_to({'type': 'chat_message', 'message': content})
+    await asyncio.gather(*(receive_message(client, content, timeout) for client in clients))
+
+
+async def keep_alive(client):
+    """Heartbeat like a browser would, so presence does not reap clients that only listen."""
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        await client.send_json_to({'type': 'heartbeat'})
+
+
+async def connect_clients(application, room_id, tokens):
+    clients = []
+    durations = []
+    for token in tokens:
+        client = room_communicator(application, room_id, token)
+        started = time.perf_counter()
+        connected, _ = await client.connect()
+        durations.append(time.perf_counter() - started)
+        if not connected:
+            raise CommandError(f'WebSocket connection to room {room_id} was refused')
+        client.heartbeat_task = asyncio.create_task(keep_alive(client))
+        clients.append(client)
+    return clients, durations
+
+
+async def disconnect_clients(clients):
+    durations = []
+    for client in clients:
+        client.heartbeat_task.cancel()
+        started = time.perf_counter()
+        await client.disconnect()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+async def bench_connect(application, room_id, tokens):
+    clients, connect_times = await connect_clients(application, room_id, tokens)
+    disconnect_times = await disconnect_clients(clients)
+    return {'connect': summarize(connect_times), 'disconnect': summarize(disconnect_times)}
+
+
+async def bench_round_trip(application, room_id, token, messages, timeout):
+    """Time from sending a message to receiving its broadcast back."""
+    (client,), _ = await connect_clients(application, room_id, [token])
+    await settle(client, [client], timeout)
+
+    samples = []
+    for i in range(messages):
+        content = f'round trip {i}'
+        started = time.perf_counter()
+        await client.send_json_to({'type': 'chat_message', 'message': content})
+        await receive_message(client, content, timeout)
+        samples.append(time.perf_counter() - started)
+
+    await disconnect_clients([client])
+    return summarize(samples)
+
+
+async def bench_throughput(application, rooms, messages, timeout):
+    """Senders in rooms of their own, each sending without waiting for echoes."""
+    clients = []
+    for room_id, token in rooms:
+        (client,), _ = await connect_clients(application, room_id, [token])
+        await settle(client, [client], timeout)
+        clients.append(client)
+
+    async def send_all(index, client):
+        for i in range(messages):
+            await client.send_json_to({'type': 'chat_message', 'message': f'throughput {index} {i}'})
+        # A room's messages arrive in order, so the last echo covers them all
+        await receive_message(client, f'throughput {index} {messages - 1}', timeout)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send_all(index, client) for index, client in enumerate(clients)))
+    elapsed = time.perf_counter() - started
+
+    await disconnect_clients(clients)
+    total = messages * len(clients)
+    return {
+        'senders': len(clients),
+        'messages': total,
+        'seconds': round(elapsed, 3),
+        'messages_per_second': round(total / elapsed, 1),
+    }
+
+
+async def bench_fanout(application, room_id, tokens, messages, timeout):
+    """Time until every member of a room received a message."""
+    clients, _ = await connect_clients(application, room_id, tokens)
+    sender = clients[0]
+    await settle(sender, clients, timeout)
+
+    samples = []
+    for i in range(messages):
+        content = f'fanout {i}'
+        started = time.perf_counter()
+        await sender.send_json_to({'type': 'chat_message', 'message': content})
+        await asyncio.gather(*(receive_message(client, content, timeout) for client in clients))
+        samples.append(time.perf_counter() - started)
+
+    await disconnect_clients(clients)
+    result = summarize(samples)
+    result['per_recipient_us'] = round(result['mean_ms'] * 1000 / len(clients), 1)
+    return result
+
+
+def git_commit():
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+# Scenario sizes, not measurements
+NOT_COMPARED = ('count', 'senders', 'messages')
+
+
+def flatten(results, prefix=''):
+    """Numeric leaves of a result tree keyed by their dotted path."""
+    flat = {}
+    for key, value in results.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{path}.'))
+        elif isinstance(value, (int, float)):
+            flat[path] = value
+    return flat
+
+
+class Command(BaseCommand):
+    help = (
+        'Drive core.asgi.application in-process with many WebsocketCommunicator '
+        'clients on SQLite and the in-memory channel layer. Measures round-trip '
+        'latency percentiles, messages per second, connect/disconnect cost and '
+        'fan-out cost per room size, and writes the results as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connects', type=int, default=200)
+        parser.add_argument('--round-trips', type=int, default=500)
+        parser.add_argument('--senders', type=int, default=8)
+        parser.add_argument('--messages', type=int, default=200, help='Messages per sender for throughput.')
+        parser.add_argument('--room-sizes', type=int, nargs='+', default=[10, 100, 500])
+        parser.add_argument('--fanout-messages', type=int, default=20)
+        parser.add_argument('--timeout', type=float, default=10)
+        parser.add_argument('--output', default='bench_ws.json', help='Where to write the JSON results.')
+        parser.add_argument('--baseline', help='Earlier results file to compare against.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError(
+                'The WebSocket benchmarks run on SQLite so results are comparable, e.g. '
+                'DB_ENGINE=django.db.backends.sqlite3 python manage.py bench_ws'
+            )
+        from core.asgi import application
+
+        timeout = options['timeout']
+        results = {}
+        with override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER), benchmark_database():
+            users = create_users(max(options['connects'], options['senders'], *options['room_sizes']))
+            tokens = [token for _, token in users]
+            user_list = [user for user, _ in users]
+
+            room = create_room(user_list[:options['connects']], 'connect')
+            results.update(async_to_sync(bench_connect)(
+                application, room.id, tokens[:options['connects']]
+            ))
+            self.report('connect', results['connect'])
+            self.report('disconnect', results['disconnect'])
+
+            room = create_room(user_list[:1], 'round trip')
+            results['round_trip'] = async_to_sync(bench_round_trip)(
+                application, room.id, tokens[0], options['round_trips'], timeout
+            )
+            self.report('round trip', results['round_trip'])
+
+            rooms = [
+                (create_room([user_list[i]], f'throughput {i}').id, tokens[i])
+                for i in range(options['senders'])
+            ]
+            results['throughput'] = async_to_sync(bench_throughput)(
+                application, rooms, options['messages'], timeout
+            )
+            self.stdout.write(
+                f'{"throughput":<16} {results["throughput"]["messages_per_second"]:>10,.0f} messages/s '
+                f'({results["throughput"]["senders"]} senders)'
+            )
+
+            results['fanout'] = {}
+            for size in options['room_sizes']:
+                room = create_room(user_list[:size], f'fanout {size}')
+                result = async_to_sync(bench_fanout)(
+                    application, room.id, tokens[:size], options['fanout_messages'], timeout
+                )
+                results['fanout'][str(size)] = result
+                self.report(f'fanout {size}', result, f'  {result["per_recipient_us"]:,.1f} us/recipient')
+
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'created_at': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'database': connection.vendor,
+                'channel_layer': IN_MEMORY_LAYER['default']['BACKEND'],
+                'write_behind': settings.CHAT_WRITE_BEHIND,
+                'options': {
+                    key: options[key] for key in (
+                        'connects', 'round_trips', 'senders', 'messages', 'room_sizes', 'fanout_messages'
+                    )
+                },
+            },
+            'results': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+        self.stdout.write(f'Results written to {options["output"]}')
+
+        if options['baseline']:
+            self.compare(options['baseline'], report)
+
+    def report(self, label, result, extra=''):
+        self.stdout.write(
+            f'{label:<16} p50 {result["p50_ms"]:>8.2f} ms  p95 {result["p95_ms"]:>8.2f} ms  '
+            f'p99 {result["p99_ms"]:>8.2f} ms{extra}'
+        )
+
+    def compare(self, path, report):
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        self.stdout.write(f'Compared with {path} (commit {baseline["meta"].get("commit")}):')
+        if baseline['meta'].get('options') != report['meta']['options']:
+            self.stdout.write(self.style.WARNING('  The runs used different options, numbers may not be comparable'))
+        
+        before = flatten(baseline['results'])
+        for metric, value in flatten(report['results']).items():
+            if metric.rsplit('.', 1)[-1] in NOT_COMPARED or not before.get(metric):
+                continue
+            change = (value - before[metric]) / before[metric] * 100
+            self.stdout.write(f'  {metric:<36} {before[metric]:>12,.2f} -> {value:>12,.2f}  {change:+6.1f}%')
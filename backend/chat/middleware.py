@@ -2,8 +2,12 @@
 JWT Authentication Middleware for WebSocket connections.
 """
 
+import threading
+import time
+from collections import OrderedDict
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.contrib.auth import get_user_model
 from rest_framework_simplejwt.tokens import AccessToken
@@ -13,14 +17,86 @@ from urllib.parse import parse_qs
 User = get_user_model()
 
 
+class UserCache:
+    """
+    Short-lived LRU of authenticated users keyed by ``(user_id, token jti)``.
+
+    Clients reconnect with the same token, so a reconnect storm is served from
+    memory instead of querying the user table on every handshake. Views
+    invalidate entries from their worker threads while handshakes use the
+    cache on the event loop, so every access holds ``lock``.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.maxsize > 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return user
+
+    def set(self, key, user):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.entries[key] = (user, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == user_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+user_cache = UserCache(
+    maxsize=settings.WS_USER_CACHE_SIZE,
+    ttl=settings.WS_USER_CACHE_TTL
+)
+
+
+def invalidate_cached_user(user_id):
+    """Drop cached copies of a user after their profile changed."""
+    user_cache.invalidate_user(user_id)
+
+
 @database_sync_to_async
-def get_user(user_id):
+def fetch_user(user_id):
     try:
         return User.objects.get(id=user_id)
     except User.DoesNotExist:
         return AnonymousUser()
 
 
+async def get_user(user_id, jti=None):
+    key = (user_id, jti)
+    user = user_cache.get(key)
+    if user is None:
+        user = await fetch_user(user_id)
+        if user.is_authenticated:
+            user_cache.set(key, user)
+    return user
+
+
 class JWTAuthMiddleware(BaseMiddleware):
     """
     Custom middleware that takes JWT token from query string and authenticates user.
@@ -39,7 +115,7 @@ class JWTAuthMiddleware(BaseMiddleware):
             try:
                 # Get the first token from the list
                 access_token = AccessToken(token[0])
-                user = await get_user(access_token['user_id'])
+                user = await get_user(access_token['user_id'], access_token.get('jti'))
                 scope['user'] = user
             except (InvalidToken, TokenError, KeyError):
                 scope['user'] = AnonymousUser()
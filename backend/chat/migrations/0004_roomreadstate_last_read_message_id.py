@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:42
+
+from django.db import migrations, models
+
+
+def backfill_watermarks(apps, schema_editor):
+    MessageRead = apps.get_model('chat', 'MessageRead')
+    RoomReadState = apps.get_model('chat', 'RoomReadState')
+
+    # Seed each watermark from the newest message the user had a receipt for
+    watermarks = MessageRead.objects.values(
+        'user_id', 'message__room_id'
+    ).annotate(last_read_message_id=models.Max('message_id'))
+    for watermark in watermarks.iterator():
+        RoomReadState.objects.filter(
+            room_id=watermark['message__room_id'],
+            user_id=watermark['user_id']
+        ).update(last_read_message_id=watermark['last_read_message_id'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_roomreadstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='roomreadstate',
+            name='last_read_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_watermarks, migrations.RunPython.noop),
+    ]
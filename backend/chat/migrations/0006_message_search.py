@@ -0,0 +1,82 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:02
+
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Frozen copy of chat.search.tokenize as of this migration, so later changes
+# to the live tokenizer do not change what old databases were backfilled with
+TOKEN_RE = re.compile(r'\w+')
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 64
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_RE.findall((text or '').lower()):
+        token = token[:MAX_TOKEN_LENGTH]
+        if len(token) >= MIN_TOKEN_LENGTH and token not in tokens:
+            tokens.append(token)
+    return tokens
+
+
+def add_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute(
+            'ALTER TABLE chat_message ADD FULLTEXT INDEX chat_msg_content_ft (content)'
+        )
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'mysql':
+        schema_editor.execute('ALTER TABLE chat_message DROP INDEX chat_msg_content_ft')
+
+
+def backfill_search_tokens(apps, schema_editor):
+    backend = settings.CHAT_SEARCH_BACKEND
+    if backend == 'auto':
+        backend = 'fulltext' if schema_editor.connection.vendor == 'mysql' else 'index'
+    if backend != 'index':
+        return
+
+    Message = apps.get_model('chat', 'Message')
+    MessageSearchToken = apps.get_model('chat', 'MessageSearchToken')
+
+    tokens = []
+    messages = Message.objects.only('id', 'room_id', 'content').order_by()
+    for message in messages.iterator(chunk_size=2000):
+        tokens.extend(
+            MessageSearchToken(room_id=message.room_id, message_id=message.id, token=token)
+            for token in tokenize(message.content)
+        )
+        if len(tokens) >= 5000:
+            MessageSearchToken.objects.bulk_create(tokens, ignore_conflicts=True)
+            tokens = []
+    MessageSearchToken.objects.bulk_create(tokens, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='chat.message')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatroom')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['room', 'token', 'message'], name='chat_search_room_token_idx')],
+                'unique_together': {('message', 'token')},
+            },
+        ),
+        migrations.RunPython(add_fulltext_index, drop_fulltext_index),
+        migrations.RunPython(backfill_search_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:06
+
+from django.db import migrations, models
+
+
+def backfill_pair_keys(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Participant = ChatRoom.participants.through
+
+    members = {}
+    private_rooms = Participant.objects.filter(
+        chatroom__room_type='private'
+    ).order_by('chatroom_id').values_list('chatroom_id', 'user_id')
+    for room_id, user_id in private_rooms.iterator():
+        members.setdefault(room_id, set()).add(user_id)
+
+    # The oldest room of a pair keeps the key, later duplicates stay unkeyed
+    claimed = set()
+    for room_id, user_ids in members.items():
+        if len(user_ids) != 2:
+            continue
+        low, high = sorted(user_ids)
+        pair_key = f'{low}:{high}'
+        if pair_key in claimed:
+            continue
+        claimed.add(pair_key)
+        ChatRoom.objects.filter(pk=room_id).update(pair_key=pair_key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='pair_key',
+            field=models.CharField(blank=True, editable=False, max_length=41, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_pair_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:14
+
+from django.db import migrations, models
+
+
+def backfill_seqs(apps, schema_editor):
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Message = apps.get_model('chat', 'Message')
+
+    # Existing history is numbered in the order it is displayed
+    for room_id in ChatRoom.objects.values_list('id', flat=True).iterator():
+        message_ids = Message.objects.filter(
+            room_id=room_id
+        ).order_by('timestamp', 'id').values_list('id', flat=True)
+        messages = [
+            Message(id=message_id, seq=seq)
+            for seq, message_id in enumerate(message_ids.iterator(), start=1)
+        ]
+        Message.objects.bulk_update(messages, ['seq'], batch_size=500)
+        ChatRoom.objects.filter(pk=room_id).update(last_seq=len(messages))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatroom_pair_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_seqs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chat_msg_room_seq_uniq'),
+        ),
+    ]
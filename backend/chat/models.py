@@ -1,12 +1,14 @@
 import os
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.utils import timezone
 from django.core.validators import FileExtensionValidator
+from .ids import message_ids
 
 def upload_to_chat(instance, filename):
     """Upload chat files to organized directory structure."""
-    return f'chat_files/{instance.message.room.id}/{timezone.now().strftime("%Y/%m/%d")}/{filename}'
+    return f'chat_files/{instance.message.room_id}/{timezone.now().strftime("%Y/%m/%d")}/{filename}'
 
 class ChatRoom(models.Model):
     ROOM_TYPES = (
@@ -25,6 +27,11 @@ class ChatRoom(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
+    # "<lower user id>:<higher user id>" for private chats, unique so each
+    # pair of users has exactly one room
+    pair_key = models.CharField(max_length=41, unique=True, null=True, blank=True, editable=False)
+    # Highest message sequence number handed out in this room
+    last_seq = models.PositiveBigIntegerField(default=0, editable=False)
     
     class Meta:
         ordering = ['-updated_at']
@@ -40,12 +47,106 @@ class ChatRoom(models.Model):
     
     @property
     def last_message(self):
+        # Room lists resolve every room's last message in bulk up front
+        if hasattr(self, '_last_message'):
+            return self._last_message
         return self.messages.first()
     
+    def add_participants(self, *users):
+        """Add users to the room along with their unread counters."""
+        self.participants.add(*users)
+        RoomReadState.objects.bulk_create(
+            [RoomReadState(room=self, user=user) for user in users],
+            ignore_conflicts=True
+        )
+    
+    @classmethod
+    def reserve_seqs(cls, room_ids, count=1):
+        """
+        Reserve the next ``count`` message sequence numbers of each room and
+        map room ids to the first one. ``room_ids`` may also map each room id
+        to its own count.
+        
+        Inside a transaction the room rows stay locked until it commits, so
+        messages of a room commit in sequence order.
+        """
+        counts = room_ids if isinstance(room_ids, dict) else dict.fromkeys(room_ids, count)
+        rooms_by_count = {}
+        for room_id, room_count in counts.items():
+            rooms_by_count.setdefault(room_count, []).append(room_id)
+        
+        # No savepoint, a failure rolls back the caller's transaction anyway
+        with transaction.atomic(savepoint=False):
+            for room_count, ids in rooms_by_count.items():
+                cls.objects.filter(pk__in=ids).update(last_seq=models.F('last_seq') + room_count)
+            return {
+                room_id: last_seq - counts[room_id] + 1
+                for room_id, last_seq in cls.objects.filter(
+                    pk__in=counts
+                ).order_by().values_list('id', 'last_seq')
+            }
+    
+    @classmethod
+    def next_seq(cls, room_id):
+        """
+        Reserve the next message sequence number of a room with a single
+        statement, or return None if the room does not exist.
+        """
+        table = connection.ops.quote_name(cls._meta.db_table)
+        if connection.vendor == 'mysql':
+            # LAST_INSERT_ID(expr) hands the new value back with the UPDATE
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {table} SET last_seq = LAST_INSERT_ID(last_seq + 1) WHERE id = %s',
+                    [room_id]
+                )
+                return cursor.lastrowid if cursor.rowcount else None
+        if not connection.features.can_return_columns_from_insert:
+            # No RETURNING (SQLite before 3.35)
+            return cls.reserve_seqs([room_id]).get(room_id)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET last_seq = last_seq + 1 WHERE id = %s RETURNING last_seq',
+                [room_id]
+            )
+            row = cursor.fetchone()
+        return row[0] if row else None
+    
+    @staticmethod
+    def pair_key_for(user_id, other_user_id):
+        low, high = sorted((int(user_id), int(other_user_id)))
+        return f"{low}:{high}"
+    
+    @classmethod
+    def get_or_create_private(cls, user, other_user):
+        """Return the active private room of two users, creating it if needed."""
+        pair_key = cls.pair_key_for(user.id, other_user.id)
+        room = cls.objects.filter(pair_key=pair_key, is_active=True).first()
+        if room:
+            return room, False
+        
+        try:
+            with transaction.atomic():
+                # A deactivated room stays hidden and gives the pair up
+                cls.objects.filter(pair_key=pair_key, is_active=False).update(pair_key=None)
+                room = cls.objects.create(
+                    room_type='private',
+                    created_by=user,
+                    pair_key=pair_key
+                )
+                room.add_participants(user, other_user)
+        except IntegrityError:
+            # A concurrent request created the room first
+            return cls.objects.get(pair_key=pair_key), False
+        return room, True
+    
     def get_other_participant(self, user):
         """Get the other participant in a private chat."""
         if self.room_type == 'private':
-            return self.participants.exclude(id=user.id).first()
+            # Served from prefetched participants when the room list loaded them
+            for participant in self.participants.all():
+                if participant.id != user.id:
+                    return participant
         return None
 
 class Message(models.Model):
@@ -64,7 +165,10 @@ class Message(models.Model):
     )
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='text')
     content = models.TextField(blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add, so write-behind batches keep the broadcast timestamp
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Position within the room; reconnecting clients resume after the last one they saw
+    seq = models.PositiveBigIntegerField(null=True, editable=False)
     is_edited = models.BooleanField(default=False)
     edited_at = models.DateTimeField(null=True, blank=True)
     
@@ -78,10 +182,83 @@ class Message(models.Model):
     
     class Meta:
         ordering = ['-timestamp']
+        indexes = [
+            # Backs keyset pagination of a room's history on (timestamp, id)
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_msg_room_ts_id_idx'),
+        ]
+        constraints = [
+            # Also serves the reconnect catch-up scan of a room after a seq
+            models.UniqueConstraint(fields=['room', 'seq'], name='chat_msg_room_seq_uniq'),
+        ]
     
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}..."
     
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        if is_new and self.pk is None and settings.CHAT_WRITE_BEHIND:
+            # Share the id sequence of buffered messages instead of auto-increment
+            self.pk = message_ids.next_id()
+            kwargs['force_insert'] = True
+        
+        # Seq, insert and unread counters are the only writes; new messages are
+        # indexed for search in batches by search_index_queue
+        with transaction.atomic():
+            if is_new and self.seq is None:
+                self.seq = ChatRoom.next_seq(self.room_id)
+            super().save(*args, **kwargs)
+            if is_new:
+                RoomReadState.increment_unread(self.room_id, self.sender_id)
+                from .search import search_index_queue
+                search_index_queue.add([self])
+            elif kwargs.get('update_fields') is None or 'content' in kwargs['update_fields']:
+                from .search import index_messages
+                index_messages([self], replace=True)
+    
+    @classmethod
+    def create_in_rooms(cls, room_ids, sender, content, message_type='system'):
+        """
+        Post the same message to many rooms with one INSERT, doing what
+        save() does per message (ids, sequence numbers, unread counters,
+        search index) in bulk.
+        """
+        timestamp = timezone.now()
+        with transaction.atomic():
+            seqs = ChatRoom.reserve_seqs(room_ids)
+            messages = [
+                cls(
+                    room_id=room_id,
+                    sender=sender,
+                    content=content,
+                    message_type=message_type,
+                    timestamp=timestamp,
+                    seq=seqs.get(room_id)
+                )
+                for room_id in room_ids
+            ]
+            if settings.CHAT_WRITE_BEHIND:
+                for message in messages:
+                    message.pk = message_ids.next_id()
+            
+            cls.objects.bulk_create(messages, batch_size=500)
+            if messages and messages[0].pk is None:
+                # MySQL does not return ids from a bulk insert, read them back
+                ids = dict(cls.objects.filter(
+                    room_id__in=room_ids,
+                    sender=sender,
+                    message_type=message_type,
+                    timestamp=timestamp
+                ).values_list('room_id', 'id'))
+                for message in messages:
+                    message.pk = ids[message.room_id]
+            
+            RoomReadState.objects.filter(room_id__in=room_ids).exclude(user_id=sender.id).update(
+                unread_count=models.F('unread_count') + 1
+            )
+            from .search import index_messages
+            index_messages(messages)
+        return messages
+    
     def mark_as_read(self, user):
         """Mark message as read by a specific user."""
         MessageRead.objects.get_or_create(
@@ -99,6 +276,119 @@ class MessageRead(models.Model):
     class Meta:
         unique_together = ('message', 'user')
 
+class RoomReadState(models.Model):
+    """Per-user read watermark and maintained unread counter for a chat room."""
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='read_states')
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='room_read_states'
+    )
+    # Every message in the room up to and including this id has been read
+    last_read_message_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ('room', 'user')
+    
+    def __str__(self):
+        return f"{self.user.username} in room {self.room_id}: {self.unread_count} unread"
+    
+    @classmethod
+    def increment_unread(cls, room_id, sender_id, count=1, read_below=None):
+        """
+        Bump the counter of every participant except the sender, or only of
+        those whose watermark is below ``read_below``.
+        """
+        states = cls.objects.filter(room_id=room_id).exclude(user_id=sender_id)
+        if read_below is not None:
+            states = states.filter(last_read_message_id__lt=read_below)
+        states.update(unread_count=models.F('unread_count') + count)
+    
+    @classmethod
+    def recount_unread(cls, room_id, read_from):
+        """Recount the unread messages of participants whose watermark is at least ``read_from``."""
+        unread = Message.objects.filter(
+            room_id=models.OuterRef('room_id'),
+            id__gt=models.OuterRef('last_read_message_id')
+        ).exclude(
+            sender_id=models.OuterRef('user_id')
+        ).order_by().values('room_id').annotate(count=models.Count('id')).values('count')
+        cls.objects.filter(room_id=room_id, last_read_message_id__gte=read_from).update(
+            unread_count=Coalesce(models.Subquery(unread), 0)
+        )
+    
+    @classmethod
+    def watermarks_for(cls, user_id, room_ids=None):
+        """Map room ids to a participant's read watermark in a single query."""
+        states = cls.objects.filter(user_id=user_id)
+        if room_ids is not None:
+            states = states.filter(room_id__in=room_ids)
+        return dict(states.values_list('room_id', 'last_read_message_id'))
+    
+    @classmethod
+    def mark_read(cls, room_id, user_id, message_id=None, buffered=()):
+        """
+        Advance a participant's read watermark up to ``message_id``, or to the
+        newest message in the room, and recompute their unread counter.
+        
+        ``buffered`` are the room's write-behind messages that were broadcast
+        but are not in the table yet. They count as existing messages, and
+        their unread increments are reconciled with the watermark when the
+        buffer writes them (see chat/writebehind.py).
+        """
+        state, _ = cls.objects.get_or_create(room_id=room_id, user_id=user_id)
+        
+        latest_id = Message.objects.filter(room_id=room_id).aggregate(
+            latest_id=models.Max('id')
+        )['latest_id'] or 0
+        latest_id = max([latest_id] + [message.id for message in buffered])
+        if message_id is None or message_id > latest_id:
+            message_id = latest_id
+        
+        # The watermark only moves forward
+        if message_id <= state.last_read_message_id:
+            return state
+        
+        unread_count = 0
+        if message_id < latest_id:
+            unread_count = Message.objects.filter(
+                room_id=room_id,
+                id__gt=message_id
+            ).exclude(sender_id=user_id).count()
+        
+        cls.objects.filter(
+            pk=state.pk,
+            last_read_message_id__lt=message_id
+        ).update(
+            last_read_message_id=message_id,
+            unread_count=unread_count,
+            updated_at=timezone.now()
+        )
+        state.last_read_message_id = message_id
+        state.unread_count = unread_count
+        return state
+
+class MessageSearchToken(models.Model):
+    """
+    Inverted index of message words, used for search on databases without a
+    FULLTEXT index (see chat/search.py).
+    """
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='+')
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='search_tokens')
+    token = models.CharField(max_length=64)
+    
+    class Meta:
+        unique_together = ['message', 'token']
+        indexes = [
+            # Serves "messages of this room containing this word"
+            models.Index(fields=['room', 'token', 'message'], name='chat_search_room_token_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.token} -> {self.message_id}"
+
 class FileAttachment(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='attachments')
     file = models.FileField(
@@ -0,0 +1,254 @@
+"""
+Bounded outbound queues for WebSocket connections.
+
+Event handlers used to ``await`` the socket write, so a client on a slow
+link held up its consumer while events for it piled up in the channel layer
+and in worker memory. Frames now go into the connection's ``OutboundQueue``
+and a writer task sends them in order.
+
+Handing a frame to the server returns at once, so the writer watches the
+real backlog instead: under Daphne it holds back while the bytes Twisted
+buffers for the socket are over the transport's ``bufferSize`` (64 KiB),
+the point where Twisted itself would pause a producer. Frames then wait
+here, where the limits below apply. Other servers expose no such count;
+there the queue only holds what the consumer produces faster than it can
+hand over.
+
+A queue holds at most ``CHAT_OUTBOUND_QUEUE_LIMIT`` frames:
+
+* Low-priority frames (typing digests, presence) are coalesced with a
+  pending frame about the same room or user, and dropped when the queue is
+  full.
+* Any other frame first evicts a pending low-priority one. When there is
+  none, or the oldest frame has waited more than ``CHAT_OUTBOUND_MAX_LAG``
+  seconds, the client is considered hopeless. Its socket is closed with
+  ``SLOW_CONSUMER_CLOSE_CODE`` and the client reconnects and catches up
+  with a ``resume`` frame (see chat/resume.py).
+
+``outbound_stats()`` reports queue depths and policy counters of the process.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import weakref
+from collections import Counter, deque
+from functools import partial
+from django.conf import settings
+from core import metrics
+from .events import dumps
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks of a full transport for drained bytes
+DRAIN_POLL_INTERVAL = 0.05
+
+# Tells the client to reconnect straight away and resume from its last seq
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+counters = Counter()
+live_queues = weakref.WeakSet()
+
+
+def merge_typing_digests(older, newer):
+    """Combine two typing digest deltas of a room as if applied in order."""
+    older, newer = json.loads(older), json.loads(newer)
+    typing = {entry['user_id']: entry for entry in older['typing']}
+    stopped = {entry['user_id']: entry for entry in older['stopped']}
+    for entry in newer['stopped']:
+        typing.pop(entry['user_id'], None)
+        stopped[entry['user_id']] = entry
+    for entry in newer['typing']:
+        stopped.pop(entry['user_id'], None)
+        typing[entry['user_id']] = entry
+    newer['typing'] = list(typing.values())
+    newer['stopped'] = list(stopped.values())
+    return dumps(newer)
+
+
+def replace_frame(older, newer):
+    return newer
+
+
+# Low-priority kinds: what makes two frames about the same thing, and how to coalesce them
+LOW_PRIORITY = {
+    'typing_digest': (lambda data: data.get('room_id'), merge_typing_digests),
+    'user_status': (lambda data: (data.get('room_id'), data.get('user_id')), replace_frame),
+}
+
+
+def server_transport(send):
+    """
+    The Twisted transport behind a consumer's ASGI ``send`` callable under
+    Daphne, or None under other servers and in tests.
+    """
+    protocol = send.args[0] if isinstance(send, partial) and send.args else None
+    transport = getattr(protocol, 'transport', None)
+    # Under TLS the bytes wait in the TCP transport below the TLS wrapper
+    while transport is not None and not hasattr(transport, 'dataBuffer'):
+        transport = getattr(transport, 'transport', None)
+    return transport
+
+
+def write_backlog(transport):
+    """
+    Bytes a Twisted transport holds that the kernel did not take yet.
+
+    Twisted has no public accessor for this. ``dataBuffer`` is a documented
+    attribute of ``FileDescriptor``, but writes since the last flush sit in
+    the private ``_tempDataLen`` counter, which ``_isSendBufferFull`` reads
+    too. If a Twisted release renames it, only ``dataBuffer`` is counted and
+    backpressure starts later instead of failing.
+    """
+    return len(getattr(transport, 'dataBuffer', b'')) + getattr(transport, '_tempDataLen', 0)
+
+
+class Frame:
+    __slots__ = ('text', 'kind', 'queued_at', '_key')
+
+    def __init__(self, text, kind=None):
+        self.text = text
+        self.kind = kind
+        self.queued_at = time.monotonic()
+        self._key = None
+
+    @property
+    def key(self):
+        # Only decoded when a later frame of the same kind needs to compare
+        if self._key is None:
+            self._key = LOW_PRIORITY[self.kind][0](json.loads(self.text))
+        return self._key
+
+
+class OutboundQueue:
+    """Frames waiting to be written to one client, sent by a writer task."""
+
+    def __init__(self, send, limit=None, max_lag=None):
+        self.send = send
+        self.limit = limit or settings.CHAT_OUTBOUND_QUEUE_LIMIT
+        self.max_lag = max_lag or settings.CHAT_OUTBOUND_MAX_LAG
+        self.frames = deque()
+        self.task = None
+        self.closed = False
+        self.transport = None
+        live_queues.add(self)
+
+    def attach(self, transport):
+        """Hold frames back while ``transport`` (see server_transport) is backed up."""
+        self.transport = transport
+
+    def transport_full(self):
+        transport = self.transport
+        return transport is not None and write_backlog(transport) > transport.bufferSize
+
+    def put(self, text, kind=None):
+        """
+        Queue a frame, ``kind`` naming a low-priority kind from
+        ``LOW_PRIORITY``. Returns False when the client is too far behind
+        to keep up.
+        """
+        if self.closed:
+            return True
+
+        frame = Frame(text, kind)
+        if kind is not None and self.frames:
+            if self.coalesce(frame):
+                counters['coalesced'] += 1
+                return True
+
+        if len(self.frames) >= self.limit:
+            if kind is not None:
+                counters['dropped'] += 1
+                return True
+            if not self.evict_low_priority():
+                counters['slow_disconnects'] += 1
+                return False
+
+        if self.frames and time.monotonic() - self.frames[0].queued_at > self.max_lag:
+            counters['slow_disconnects'] += 1
+            return False
+
+        self.frames.append(frame)
+        self.ensure_writer()
+        return True
+
+    def coalesce(self, frame):
+        merge = LOW_PRIORITY[frame.kind][1]
+        for pending in self.frames:
+            if pending.kind == frame.kind and pending.key == frame.key:
+                pending.text = merge(pending.text, frame.text)
+                return True
+        return False
+
+    def evict_low_priority(self):
+        for pending in self.frames:
+            if pending.kind is not None:
+                self.frames.remove(pending)
+                counters['dropped'] += 1
+                return True
+        return False
+
+    def close(self):
+        """Discard everything still queued and stop the writer."""
+        self.closed = True
+        self.frames.clear()
+        live_queues.discard(self)
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.transport = None
+
+    def ensure_writer(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while self.frames:
+            while self.transport_full():
+                await asyncio.sleep(DRAIN_POLL_INTERVAL)
+            frame = self.frames.popleft()
+            try:
+                await self.send(frame.text)
+            except Exception:
+                logger.exception('Error sending WebSocket frame')
+                self.close()
+
+
+QUEUED_FRAMES = metrics.registry.gauge(
+    'chat_outbound_queued_frames',
+    'Frames waiting in WebSocket send queues.'
+)
+MAX_QUEUE_DEPTH = metrics.registry.gauge(
+    'chat_outbound_max_queue_depth',
+    'Frames waiting in the longest WebSocket send queue.'
+)
+OUTBOUND_FRAMES = metrics.registry.counter(
+    'chat_outbound_frames_total',
+    'Low-priority frames coalesced or dropped, and frames that closed a slow socket.',
+    ['outcome']
+)
+
+
+def collect_metrics():
+    stats = outbound_stats()
+    QUEUED_FRAMES.set(stats['queued_frames'])
+    MAX_QUEUE_DEPTH.set(stats['max_queue_depth'])
+    for outcome in ('coalesced', 'dropped', 'slow_disconnects'):
+        OUTBOUND_FRAMES.set_total(stats[outcome], outcome=outcome)
+
+
+metrics.registry.collectors.append(collect_metrics)
+
+
+def outbound_stats():
+    """Queue depths over the open connections of this process, and policy counters."""
+    depths = [len(queue.frames) for queue in list(live_queues)]
+    return {
+        'connections': len(depths),
+        'queued_frames': sum(depths),
+        'max_queue_depth': max(depths, default=0),
+        'coalesced': counters['coalesced'],
+        'dropped': counters['dropped'],
+        'slow_disconnects': counters['slow_disconnects'],
+    }
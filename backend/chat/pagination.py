@@ -0,0 +1,123 @@
+"""
+Keyset (cursor) pagination for chat message history.
+"""
+
+import base64
+from collections import OrderedDict
+from datetime import datetime
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Paginate messages on ``(timestamp, id)`` with ``before``/``after`` cursors.
+
+    Each page is a bounded range scan on the ``(room, timestamp, id)`` index,
+    so scrolling back through a long history costs the same as the first page.
+    Results are always returned newest first.
+    """
+    page_size = 50
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        self.after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        if self.after is not None:
+            timestamp, pk = self.after
+            queryset = queryset.filter(
+                Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=pk)
+            ).order_by('timestamp', 'id')
+        else:
+            if self.before is not None:
+                timestamp, pk = self.before
+                queryset = queryset.filter(
+                    Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk)
+                )
+            queryset = queryset.order_by('-timestamp', '-id')
+
+        # Fetch one extra row to know whether another page exists
+        results = list(queryset[:self.page_size + 1])
+        self.has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+
+        if self.after is not None:
+            results.reverse()
+
+        self.newest = results[0] if results else None
+        self.oldest = results[-1] if results else None
+        return results
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_next_link(self):
+        """Link to the page of older messages."""
+        if self.oldest is None:
+            return None
+        # Paging forward always leaves older messages behind the cursor
+        if self.after is None and not self.has_more:
+            return None
+        return self.build_link(self.before_query_param, self.after_query_param, self.oldest)
+
+    def get_previous_link(self):
+        """Link to the page of newer messages."""
+        if self.newest is None:
+            return None
+        if self.after is not None:
+            if not self.has_more:
+                return None
+        elif self.before is None:
+            return None
+        return self.build_link(self.after_query_param, self.before_query_param, self.newest)
+
+    def build_link(self, param, other_param, message):
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, other_param)
+        return replace_query_param(url, param, self.encode_cursor(message))
+
+    def encode_cursor(self, message):
+        raw = f'{message.timestamp.isoformat()}|{message.id}'
+        return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            timestamp, pk = raw.rsplit('|', 1)
+            return datetime.fromisoformat(timestamp), int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
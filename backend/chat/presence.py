@@ -0,0 +1,330 @@
+"""
+Presence registry with per-user connection refcounts and heartbeats.
+
+A user counts as online while any of their sockets is open, on any worker,
+so several tabs, rooms or workers no longer make them flap between online
+and offline. Only real transitions are published, and ``UserStatus`` rows
+are written in bulk on a fixed interval instead of on every connect.
+
+The sockets and announced rooms of every user live in a shared store. With
+the Redis channel layer that is a hash and a set per user on the layer's
+shard for that user, changed by Lua scripts so concurrent connects and
+disconnects on different workers see each other. Each worker refreshes the
+deadlines of its own sockets, so the sockets of a worker that died without
+disconnecting stop counting after ``HEARTBEAT_TIMEOUT``. The in-memory layer
+only serves a single worker, so it gets an in-process store.
+
+Heartbeats and reaping stay per worker: a socket's heartbeats only ever
+reach the worker serving it.
+"""
+
+import asyncio
+import logging
+import time
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.db import DatabaseError
+from django.utils import timezone
+from .events import build_event
+from .models import UserStatus
+
+logger = logging.getLogger(__name__)
+
+# Seconds of silence after which a socket is considered gone
+HEARTBEAT_TIMEOUT = 90
+# Seconds between bulk writes of status transitions
+FLUSH_INTERVAL = 5
+
+# KEYS: sockets hash, rooms set. ARGV: channel, deadline, now, ttl.
+# Returns 1 when no other live socket existed, i.e. the user came online.
+ADD_SOCKET_SCRIPT = """
+local online = 0
+local stale = {}
+local entries = redis.call('HGETALL', KEYS[1])
+for i = 1, #entries, 2 do
+    if entries[i] ~= ARGV[1] then
+        if tonumber(entries[i + 1]) > tonumber(ARGV[3]) then
+            online = 1
+        else
+            table.insert(stale, entries[i])
+        end
+    end
+end
+if online == 0 then
+    -- Left over by a dead worker: forget its sockets and announced rooms
+    for _, channel in ipairs(stale) do
+        redis.call('HDEL', KEYS[1], channel)
+    end
+    redis.call('DEL', KEYS[2])
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1 - online
+"""
+
+# KEYS: sockets hash, rooms set. ARGV: channel, now.
+# Returns the announced rooms when the last live socket is gone, else nil.
+REMOVE_SOCKET_SCRIPT = """
+redis.call('HDEL', KEYS[1], ARGV[1])
+local entries = redis.call('HGETALL', KEYS[1])
+for i = 2, #entries, 2 do
+    if tonumber(entries[i]) > tonumber(ARGV[2]) then
+        return false
+    end
+end
+local rooms = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[1], KEYS[2])
+return rooms
+"""
+
+# KEYS: sockets hash, rooms set. ARGV: deadline, ttl, channels...
+# Only extends sockets still present, so a disconnect racing the refresh wins.
+REFRESH_SOCKETS_SCRIPT = """
+for i = 3, #ARGV do
+    if redis.call('HEXISTS', KEYS[1], ARGV[i]) == 1 then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[1])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+"""
+
+
+class LocalPresenceStore:
+    """Sockets and announced rooms per user, for a single worker process."""
+
+    def __init__(self):
+        self.users = {}  # user_id -> {'channels': set(), 'rooms': set()}
+
+    async def add_socket(self, user_id, channel_name, deadline):
+        entry = self.users.setdefault(user_id, {'channels': set(), 'rooms': set()})
+        came_online = not entry['channels']
+        entry['channels'].add(channel_name)
+        return came_online
+
+    async def add_room(self, user_id, room_id, deadline):
+        entry = self.users.get(user_id)
+        if entry is None or room_id in entry['rooms']:
+            return False
+        entry['rooms'].add(room_id)
+        return True
+
+    async def remove_socket(self, user_id, channel_name):
+        entry = self.users.get(user_id)
+        if entry is None:
+            return None
+        entry['channels'].discard(channel_name)
+        if entry['channels']:
+            return None
+        del self.users[user_id]
+        return entry['rooms']
+
+    async def refresh(self, sockets, deadline):
+        pass
+
+
+class RedisPresenceStore:
+    """Sockets (with deadlines) and announced rooms per user in the Redis channel layer."""
+
+    def __init__(self, layer, ttl=HEARTBEAT_TIMEOUT):
+        self.layer = layer
+        self.ttl = ttl
+
+    def keys(self, user_id):
+        key = f'{self.layer.prefix}:presence:{user_id}'
+        return key, f'{key}:rooms'
+
+    def connection(self, user_id):
+        return self.layer.connection(self.layer.consistent_hash(f'presence:{user_id}'))
+
+    async def add_socket(self, user_id, channel_name, deadline):
+        came_online = await self.connection(user_id).eval(
+            ADD_SOCKET_SCRIPT, 2, *self.keys(user_id),
+            channel_name, deadline, time.time(), self.ttl
+        )
+        return came_online == 1
+
+    async def add_room(self, user_id, room_id, deadline):
+        _, rooms_key = self.keys(user_id)
+        async with self.connection(user_id).pipeline(transaction=True) as pipe:
+            pipe.sadd(rooms_key, room_id)
+            pipe.expire(rooms_key, self.ttl)
+            added, _ = await pipe.execute()
+        return added == 1
+
+    async def remove_socket(self, user_id, channel_name):
+        rooms = await self.connection(user_id).eval(
+            REMOVE_SOCKET_SCRIPT, 2, *self.keys(user_id),
+            channel_name, time.time()
+        )
+        if rooms is None:
+            return None
+        return {int(room_id) for room_id in rooms}
+
+    async def refresh(self, sockets, deadline):
+        """Extend the deadlines of this worker's sockets, ``{user_id: [channel_name]}``."""
+        for user_id, channel_names in sockets.items():
+            await self.connection(user_id).eval(
+                REFRESH_SOCKETS_SCRIPT, 2, *self.keys(user_id),
+                deadline, self.ttl, *channel_names
+            )
+
+
+def presence_store():
+    """The shared store matching the configured channel layer."""
+    layer = get_channel_layer()
+    try:
+        from channels_redis.core import RedisChannelLayer
+    except ImportError:
+        RedisChannelLayer = None
+    if RedisChannelLayer is not None and isinstance(layer, RedisChannelLayer):
+        return RedisPresenceStore(layer)
+    return LocalPresenceStore()
+
+
+class PresenceRegistry:
+    """Users online on any worker, plus the sockets this worker serves."""
+
+    def __init__(self, heartbeat_timeout=HEARTBEAT_TIMEOUT, flush_interval=FLUSH_INTERVAL, store=None):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.flush_interval = flush_interval
+        self.store = store
+        self.users = {}  # user_id -> {'username', 'channels': {name: last_seen}, 'rooms': set()}
+        self.pending = {}  # user_id -> status not yet written to UserStatus
+        self.task = None
+
+    def get_store(self):
+        if self.store is None:
+            self.store = presence_store()
+        return self.store
+
+    def deadline(self):
+        # Wall clock, shared with the other workers
+        return time.time() + self.heartbeat_timeout
+
+    async def connect(self, user, channel_name):
+        entry = self.users.get(user.id)
+        if entry is None:
+            entry = self.users[user.id] = {
+                'username': user.username,
+                'channels': {},
+                'rooms': set(),
+            }
+        entry['channels'][channel_name] = time.monotonic()
+        if await self.get_store().add_socket(user.id, channel_name, self.deadline()):
+            self.pending[user.id] = 'online'
+        self.ensure_flusher()
+
+    async def join(self, user, room):
+        """Announce the user in a room unless that room already knows."""
+        entry = self.users.get(user.id)
+        if entry is None or room['id'] in entry['rooms']:
+            return
+        entry['rooms'].add(room['id'])
+        if await self.get_store().add_room(user.id, room['id'], self.deadline()):
+            await self.publish(user.id, entry['username'], [room['id']], 'online')
+
+    async def disconnect(self, user_id, channel_name):
+        entry = self.users.get(user_id)
+        if entry is None or entry['channels'].pop(channel_name, None) is None:
+            return
+        if not entry['channels']:
+            del self.users[user_id]
+
+        rooms = await self.get_store().remove_socket(user_id, channel_name)
+        if rooms is None:
+            return
+        # Last socket on any worker closed: the user really went offline
+        self.pending[user_id] = 'offline'
+        await self.publish(user_id, entry['username'], rooms, 'offline')
+        self.ensure_flusher()
+
+    def heartbeat(self, user_id, channel_name):
+        entry = self.users.get(user_id)
+        if entry is not None and channel_name in entry['channels']:
+            entry['channels'][channel_name] = time.monotonic()
+
+    async def publish(self, user_id, username, room_ids, status):
+        channel_layer = get_channel_layer()
+        for room_id in room_ids:
+            await channel_layer.group_send(f'chat_{room_id}', build_event(
+                'user_status',
+                room_id=room_id,
+                user_id=user_id,
+                username=username,
+                status=status
+            ))
+
+    async def refresh(self):
+        """Keep this worker's sockets alive in the shared store."""
+        sockets = {user_id: list(entry['channels']) for user_id, entry in self.users.items()}
+        if sockets:
+            await self.get_store().refresh(sockets, self.deadline())
+
+    async def reap(self):
+        """Drop sockets that stopped sending heartbeats and tell them to close."""
+        cutoff = time.monotonic() - self.heartbeat_timeout
+        channel_layer = get_channel_layer()
+        for user_id, entry in list(self.users.items()):
+            for channel_name, last_seen in list(entry['channels'].items()):
+                if last_seen < cutoff:
+                    await self.disconnect(user_id, channel_name)
+                    await channel_layer.send(channel_name, {'type': 'presence_expired'})
+
+    def take_pending(self):
+        pending, self.pending = self.pending, {}
+        return pending
+
+    @database_sync_to_async
+    def write_statuses(self, pending):
+        """Persist a batch of transitions with one UPDATE per status."""
+        now = timezone.now()
+        existing = set(
+            UserStatus.objects.filter(user_id__in=pending).values_list('user_id', flat=True)
+        )
+        UserStatus.objects.bulk_create(
+            [
+                UserStatus(user_id=user_id, status=status)
+                for user_id, status in pending.items() if user_id not in existing
+            ],
+            ignore_conflicts=True
+        )
+        for status in ('online', 'offline'):
+            user_ids = [
+                user_id for user_id, user_status in pending.items()
+                if user_status == status and user_id in existing
+            ]
+            if user_ids:
+                UserStatus.objects.filter(user_id__in=user_ids).update(
+                    status=status,
+                    last_seen=now
+                )
+
+    async def flush(self):
+        pending = self.take_pending()
+        if not pending:
+            return
+        try:
+            await self.write_statuses(pending)
+        except DatabaseError:
+            # Presence itself is in memory, a lost status write is not fatal
+            logger.exception('Error writing user statuses')
+
+    def ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while self.users or self.pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.reap()
+                await self.refresh()
+                await self.flush()
+            except Exception:
+                # E.g. ChannelFull from a busy layer; try again next round
+                logger.exception('Error reaping or flushing presence')
+
+
+presence = PresenceRegistry()
@@ -0,0 +1,52 @@
+"""
+Reconnect catch-up for room sockets.
+
+Every message carries its room's ``seq``. A client that reconnects sends
+``{"type": "resume", "last_seq": N}`` with the highest seq it has seen and
+gets only the messages after it, in ``resume_batch`` frames of at most
+``RESUME_BATCH_SIZE`` messages, followed by ``resume_done``. When more than
+``RESUME_MAX_MESSAGES`` were missed, ``resume_done`` says ``complete: false``
+and the client reloads the history over HTTP as before.
+"""
+
+from django.db.models import prefetch_related_objects
+from .models import Message, RoomReadState
+from .serializers import MessageSerializer
+
+RESUME_BATCH_SIZE = 100
+RESUME_MAX_MESSAGES = 1000
+
+
+def messages_after(room_id, after_seq, user, limit=RESUME_BATCH_SIZE, buffered=()):
+    """
+    Serialized messages of a room with a seq above ``after_seq``, oldest
+    first and at most ``limit`` of them, with ``is_read_by_user`` set for
+    ``user``.
+
+    ``buffered`` are write-behind messages that were broadcast but possibly
+    not inserted yet; they are merged in by seq.
+    """
+    messages = list(
+        Message.objects.filter(
+            room_id=room_id,
+            seq__gt=after_seq
+        ).select_related('sender', 'sender__chat_status').order_by('seq')[:limit]
+    )
+
+    # A full page only covers seqs up to its last row
+    upper = messages[-1].seq if len(messages) == limit else None
+    stored_ids = {message.id for message in messages}
+    messages.extend(
+        message for message in buffered
+        if message.id not in stored_ids
+        and message.seq > after_seq
+        and (upper is None or message.seq <= upper)
+    )
+    messages.sort(key=lambda message: message.seq)
+    messages = messages[:limit]
+
+    prefetch_related_objects(messages, 'attachments', 'sender__chat_status')
+    return MessageSerializer(messages, many=True, context={
+        'user': user,
+        'read_watermarks': RoomReadState.watermarks_for(user.id, [room_id]),
+    }).data
@@ -4,4 +4,5 @@ from . import consumers
 websocket_urlpatterns = [
     path('ws/chat/<str:room_id>/', consumers.ChatConsumer.as_asgi()),
     path('ws/chat/', consumers.ChatListConsumer.as_asgi()),
+    path('ws/multiplex/', consumers.MultiplexChatConsumer.as_asgi()),
 ]
@@ -0,0 +1,278 @@
+"""
+Full-text search over the messages of a room, and prefix search over users.
+
+Two interchangeable backends, picked by ``CHAT_SEARCH_BACKEND``:
+
+* ``fulltext``: a MySQL FULLTEXT index on ``chat_message.content`` queried
+  with ``MATCH ... AGAINST`` in boolean mode.
+* ``index``: a local inverted index of message words kept in
+  ``MessageSearchToken``, for SQLite and other databases.
+
+``auto`` (the default) uses ``fulltext`` on MySQL and ``index`` elsewhere.
+Both return a plain ``Message`` queryset that every query word must match,
+so results are paged by ``MessageKeysetPagination`` like the room history.
+
+New messages reach the ``index`` backend through ``search_index_queue``, so
+sending a message does not also insert its words: a worker serving sockets
+writes the words of everything sent in an interval with one INSERT, and a
+message can be found up to ``SEARCH_INDEX_INTERVAL`` seconds after it was
+sent.
+
+User search only matches prefixes, so every lookup is a range scan on the
+username, first name or last name index instead of an ``icontains`` scan of
+the whole table.
+"""
+
+import asyncio
+import atexit
+import hashlib
+import logging
+import re
+import threading
+from functools import partial
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import Count, FloatField
+from django.db.models.expressions import RawSQL
+from .models import Message, MessageSearchToken
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+# Seconds new messages may wait before their words are indexed
+SEARCH_INDEX_INTERVAL = 1
+
+TOKEN_RE = re.compile(r'\w+')
+MIN_TOKEN_LENGTH = 2
+MAX_TOKEN_LENGTH = 64  # MessageSearchToken.token max_length
+MAX_QUERY_TERMS = 8
+
+USER_SEARCH_FIELDS = ('id', 'username', 'first_name', 'last_name', 'email')
+USER_SEARCH_LIMIT = 10
+USER_SEARCH_MAX_LENGTH = 64
+
+
+def tokenize(text, limit=None):
+    """Distinct lowercase words of ``text`` in order of first appearance."""
+    tokens = []
+    for token in TOKEN_RE.findall((text or '').lower()):
+        token = token[:MAX_TOKEN_LENGTH]
+        if len(token) >= MIN_TOKEN_LENGTH and token not in tokens:
+            tokens.append(token)
+            if limit and len(tokens) >= limit:
+                break
+    return tokens
+
+
+class FullTextSearchBackend:
+    """MATCH ... AGAINST on the FULLTEXT index added by migration 0006."""
+    # InnoDB does not index shorter words (innodb_ft_min_token_size)
+    min_token_length = 3
+
+    def search(self, room_id, terms):
+        terms = [term for term in terms if len(term) >= self.min_token_length]
+        if not terms:
+            # Only words the index skips; MATCH would silently find nothing
+            return None
+        # Every word is required; tokenize() already stripped boolean operators
+        against = ' '.join(f'+{term}' for term in terms)
+        match = RawSQL(
+            f'MATCH ({Message._meta.db_table}.content) AGAINST (%s IN BOOLEAN MODE)',
+            [against],
+            output_field=FloatField()
+        )
+        return Message.objects.filter(room_id=room_id).alias(relevance=match).filter(relevance__gt=0)
+
+    def index_messages(self, messages, replace=False):
+        # MySQL maintains the FULLTEXT index itself
+        pass
+
+
+class InvertedIndexSearchBackend:
+    """Word lookups on the (room, token, message) index of MessageSearchToken."""
+
+    def search(self, room_id, terms):
+        matching = MessageSearchToken.objects.filter(
+            room_id=room_id,
+            token__in=terms
+        ).values('message_id').annotate(
+            matched=Count('token')
+        ).filter(
+            matched=len(terms)
+        ).values('message_id')
+        return Message.objects.filter(room_id=room_id, id__in=matching)
+
+    def index_messages(self, messages, replace=False):
+        if replace:
+            MessageSearchToken.objects.filter(message__in=messages).delete()
+        MessageSearchToken.objects.bulk_create(
+            [
+                MessageSearchToken(room_id=message.room_id, message_id=message.id, token=token)
+                for message in messages
+                for token in tokenize(message.content)
+            ],
+            ignore_conflicts=True
+        )
+
+
+BACKENDS = {
+    'fulltext': FullTextSearchBackend,
+    'index': InvertedIndexSearchBackend,
+}
+
+
+def backend_name(vendor=None):
+    name = settings.CHAT_SEARCH_BACKEND
+    if name == 'auto':
+        name = 'fulltext' if (vendor or connection.vendor) == 'mysql' else 'index'
+    return name
+
+
+def get_search_backend():
+    return BACKENDS[backend_name()]()
+
+
+def search_messages(room_id, query):
+    """Messages of the room matching every word of ``query``, or None if it has no searchable words."""
+    terms = tokenize(query, limit=MAX_QUERY_TERMS)
+    if not terms:
+        return None
+    return get_search_backend().search(room_id, terms)
+
+
+def index_messages(messages, replace=False):
+    """Add saved messages to the search index (replacing their old words if asked)."""
+    get_search_backend().index_messages(messages, replace=replace)
+
+
+class SearchIndexQueue:
+    """
+    New messages whose words are not indexed yet. Consumers bind the
+    server's event loop, where a flusher task indexes each interval's
+    messages in one batch; without a bound loop (management commands,
+    tests, WSGI) messages are indexed straight away.
+    """
+
+    def __init__(self, interval=SEARCH_INDEX_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pending = []
+        self.loop = None
+        self.task = None
+
+    def bind(self):
+        """Index on the running loop from now on; called by consumers on connect."""
+        self.loop = asyncio.get_running_loop()
+
+    def add(self, messages):
+        """Index saved messages; call inside the transaction that inserted them."""
+        loop = self.loop
+        if loop is None or not loop.is_running():
+            index_messages(messages)
+            return
+        # The flusher uses another connection, which must see the rows
+        transaction.on_commit(partial(self.enqueue, loop, messages))
+
+    def enqueue(self, loop, messages):
+        with self.lock:
+            self.pending.extend(messages)
+        loop.call_soon_threadsafe(self.ensure_flusher)
+
+    def take_batch(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        return batch
+
+    def write(self, batch):
+        try:
+            with transaction.atomic():
+                index_messages(batch)
+        except IntegrityError:
+            # Some of the messages were deleted meanwhile
+            existing = set(Message.objects.filter(
+                pk__in=[message.id for message in batch]
+            ).values_list('id', flat=True))
+            index_messages([message for message in batch if message.id in existing])
+
+    async def flush(self):
+        batch = self.take_batch()
+        if not batch:
+            return
+        try:
+            await database_sync_to_async(self.write)(batch)
+        except DatabaseError:
+            with self.lock:
+                self.pending[:0] = batch
+            logger.exception('Error indexing messages')
+
+    def drain(self):
+        """Index whatever is still queued; runs at interpreter exit."""
+        batch = self.take_batch()
+        if batch:
+            self.write(batch)
+
+    def ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while self.pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+search_index_queue = SearchIndexQueue()
+atexit.register(search_index_queue.drain)
+
+
+def user_search_lookups(words):
+    """Indexed prefix lookups in rank order, each with the column it scans."""
+    if len(words) == 1:
+        prefix = words[0]
+        return [
+            ({'username__istartswith': prefix}, 'username'),
+            ({'first_name__istartswith': prefix}, 'first_name'),
+            ({'last_name__istartswith': prefix}, 'last_name'),
+        ]
+    # "ada love" finds Ada Lovelace
+    return [
+        ({'username__istartswith': ' '.join(words)}, 'username'),
+        ({'first_name__istartswith': words[0], 'last_name__istartswith': ' '.join(words[1:])}, 'first_name'),
+    ]
+
+
+def find_users(words, limit):
+    users = {}
+    for filters, column in user_search_lookups(words):
+        if len(users) >= limit:
+            break
+        matches = User.objects.filter(**filters).order_by(column).values(*USER_SEARCH_FIELDS)
+        for user in matches[:limit]:
+            users.setdefault(user['id'], user)
+    return list(users.values())[:limit]
+
+
+def search_users(query, limit=USER_SEARCH_LIMIT):
+    """
+    Users whose username, first name or last name starts with ``query``.
+
+    Username matches rank first, then first name, then last name. Results
+    are cached for a few seconds per normalized query, so the short and
+    popular prefixes typed by many clients are served from the cache.
+    """
+    words = query.lower().split()[:MAX_QUERY_TERMS]
+    normalized = ' '.join(words)[:USER_SEARCH_MAX_LENGTH]
+    if not normalized:
+        return []
+
+    key = f"user_search:{limit}:{hashlib.md5(normalized.encode('utf-8')).hexdigest()}"
+    users = cache.get(key)
+    if users is None:
+        users = find_users(normalized.split(), limit)
+        cache.set(key, users, settings.USER_SEARCH_CACHE_TTL)
+    return users
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import ChatRoom, Message, FileAttachment, UserStatus
+from .models import ChatRoom, Message, FileAttachment, UserStatus, RoomReadState
 
 User = get_user_model()
 
@@ -34,15 +34,21 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = [
-            'id', 'room', 'sender', 'message_type', 'content', 'timestamp',
+            'id', 'room', 'sender', 'message_type', 'content', 'timestamp', 'seq',
             'is_edited', 'edited_at', 'attachments', 'is_read_by_user'
         ]
-        read_only_fields = ['room', 'sender', 'timestamp', 'is_edited', 'edited_at']
+        read_only_fields = ['room', 'sender', 'timestamp', 'seq', 'is_edited', 'edited_at']
     
     def get_is_read_by_user(self, obj):
         request = self.context.get('request')
-        if request and request.user.is_authenticated:
-            return obj.read_by.filter(id=request.user.id).exists()
+        # Sockets have no request and pass their user instead
+        user = request.user if request else self.context.get('user')
+        if user and user.is_authenticated:
+            # Views resolve the watermarks of a whole page up front
+            read_watermarks = self.context.get('read_watermarks')
+            if read_watermarks is None:
+                read_watermarks = RoomReadState.watermarks_for(user.id, [obj.room_id])
+            return obj.id <= read_watermarks.get(obj.room_id, 0)
         return False
     
     def validate(self, data):
@@ -74,13 +80,17 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         read_only_fields = ['created_by', 'created_at', 'updated_at']
     
     def get_unread_count(self, obj):
+        # Rooms listed by the API carry the counter as an annotation
+        if hasattr(obj, 'user_unread_count'):
+            return obj.user_unread_count or 0
+        
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            return obj.messages.exclude(
-                read_by=request.user
-            ).exclude(
-                sender=request.user
-            ).count()
+            unread_count = RoomReadState.objects.filter(
+                room=obj,
+                user=request.user
+            ).values_list('unread_count', flat=True).first()
+            return unread_count or 0
         return 0
     
     def get_other_participant(self, obj):
@@ -102,10 +112,27 @@ class CreateChatRoomSerializer(serializers.ModelSerializer):
         model = ChatRoom
         fields = ['name', 'room_type', 'participant_ids']
     
+    def validate(self, data):
+        if data.get('room_type', 'private') == 'private':
+            user = self.context['request'].user
+            other_ids = set(data.get('participant_ids', [])) - {user.id}
+            other_users = list(User.objects.filter(id__in=other_ids))
+            if len(other_ids) != 1 or len(other_users) != 1:
+                raise serializers.ValidationError({
+                    'participant_ids': 'A private chat needs exactly one other existing user.'
+                })
+            data['other_user'] = other_users[0]
+        return data
+    
     def create(self, validated_data):
         participant_ids = validated_data.pop('participant_ids', [])
         user = self.context['request'].user
         
+        if 'other_user' in validated_data:
+            # Same room as POST rooms/private/, one per pair of users
+            chat_room, _ = ChatRoom.get_or_create_private(user, validated_data['other_user'])
+            return chat_room
+        
         # Create the chat room
         chat_room = ChatRoom.objects.create(
             created_by=user,
@@ -113,12 +140,12 @@ class CreateChatRoomSerializer(serializers.ModelSerializer):
         )
         
         # Add creator to participants
-        chat_room.participants.add(user)
+        chat_room.add_participants(user)
         
         # Add other participants
         if participant_ids:
             participants = User.objects.filter(id__in=participant_ids)
-            chat_room.participants.add(*participants)
+            chat_room.add_participants(*participants)
         
         return chat_room
 
@@ -0,0 +1,32 @@
+"""
+Dedicated executor for attachment storage writes.
+
+Writing files to disk or an object store can take far longer than a chat
+message insert. Running those writes on the ``database_sync_to_async`` thread
+would queue message inserts behind them, so they get a pool of their own.
+Chunked uploads (chat/uploads.py) write their temporary files here as well.
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.files.storage import default_storage
+from .models import FileAttachment
+
+storage_executor = ThreadPoolExecutor(
+    max_workers=settings.CHAT_STORAGE_WORKERS,
+    thread_name_prefix='chat-storage'
+)
+
+
+async def run_in_storage_executor(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(storage_executor, functools.partial(func, *args, **kwargs))
+
+
+def store_attachment_file(message, django_file, file_name):
+    """Write an attachment's content to storage and return its stored name."""
+    attachment = FileAttachment(message=message)
+    name = FileAttachment._meta.get_field('file').generate_filename(attachment, file_name)
+    return default_storage.save(name, django_file)
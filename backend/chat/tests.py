@@ -0,0 +1,1055 @@
+import asyncio
+import base64
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APITestCase, APITransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from core.asgi import application
+from core.testing import QueryBudgetMixin
+from accounts.views import ProfileImageUploadView
+from .consumers import ChatConsumer, MultiplexChatConsumer
+from .fanout import room_contacts
+from .ids import message_ids
+from .models import ChatRoom, Message, MessageSearchToken, RoomReadState
+from .middleware import UserCache
+from .outbound import OutboundQueue, write_backlog
+from .presence import LocalPresenceStore, PresenceRegistry, RedisPresenceStore
+from .resume import messages_after
+from .uploads import UploadError, UploadRegistry, discard_uploads
+from .search import FullTextSearchBackend, SearchIndexQueue, search_index_queue
+from .typing_indicators import TypingTracker, typing_tracker
+from .writebehind import MessageWriteBuffer, SeqReservations, message_buffer
+
+User = get_user_model()
+
+class MessageListQueryTests(QueryBudgetMixin, APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        other_user = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+        self.room, _ = ChatRoom.get_or_create_private(self.user, other_user)
+        for i in range(60):
+            Message.objects.create(
+                room=self.room,
+                sender=other_user if i % 2 else self.user,
+                content=f'message {i}'
+            )
+        RoomReadState.mark_read(self.room.id, self.user.id, Message.objects.order_by('id')[30].id)
+        self.client.force_authenticate(self.user)
+    
+    def get_page(self, page_size):
+        return self.client.get(f'/api/chat/rooms/{self.room.id}/messages/', {'page_size': page_size})
+    
+    def test_page_queries_do_not_grow_with_page_size(self):
+        # Room check, page, attachments and the read watermarks of the page
+        for page_size in (5, 40):
+            response = self.assertEndpointQueries(
+                f'/api/chat/rooms/{self.room.id}/messages/', 4, max_repeats=1,
+                data={'page_size': page_size}
+            )
+            self.assertEqual(len(response.data['results']), page_size)
+    
+    def test_read_state_follows_watermark(self):
+        watermark = RoomReadState.watermarks_for(self.user.id)[self.room.id]
+        response = self.get_page(50)
+        for message in response.data['results']:
+            self.assertEqual(message['is_read_by_user'], message['id'] <= watermark)
+
+class MessagePaginationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        other_user = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+        self.room, _ = ChatRoom.get_or_create_private(self.user, other_user)
+        # Pairs of messages share a timestamp, so pages split ties
+        start = timezone.now() - timedelta(minutes=10)
+        for i in range(9):
+            Message.objects.create(
+                room=self.room,
+                sender=self.user,
+                content=f'message {i}',
+                timestamp=start + timedelta(seconds=i // 2)
+            )
+        self.newest_first = list(
+            Message.objects.order_by('-timestamp', '-id').values_list('id', flat=True)
+        )
+        self.client.force_authenticate(self.user)
+    
+    def ids(self, response):
+        return [message['id'] for message in response.data['results']]
+    
+    def test_before_cursor_walks_back_through_ties(self):
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/messages/', {'page_size': 2})
+        self.assertIsNone(response.data['previous'])
+        seen = self.ids(response)
+        while response.data['next']:
+            self.assertIn('before=', response.data['next'])
+            response = self.client.get(response.data['next'])
+            seen.extend(self.ids(response))
+        
+        self.assertEqual(seen, self.newest_first)
+    
+    def test_after_cursor_returns_newer_messages(self):
+        first = self.client.get(f'/api/chat/rooms/{self.room.id}/messages/', {'page_size': 3})
+        second = self.client.get(first.data['next'])
+        self.assertEqual(self.ids(second), self.newest_first[3:6])
+        
+        newer = self.client.get(second.data['previous'])
+        self.assertEqual(self.ids(newer), self.newest_first[:3])
+        self.assertIsNone(newer.data['previous'])
+    
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(f'/api/chat/rooms/{self.room.id}/messages/', {'before': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+class RoomListQueryTests(QueryBudgetMixin, APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        self.client.force_authenticate(self.user)
+    
+    def add_rooms(self, count):
+        for _ in range(count):
+            other_user = User.objects.create_user(
+                username=f'user{User.objects.count()}',
+                email=f'user{User.objects.count()}@example.com',
+                password='password'
+            )
+            room, _ = ChatRoom.get_or_create_private(self.user, other_user)
+            Message.objects.create(room=room, sender=other_user, content='hello')
+    
+    def test_room_list_queries_do_not_grow_with_room_count(self):
+        # Rooms, participants, last messages, their attachments and the read watermarks
+        for count in (2, 10):
+            self.add_rooms(count)
+            response = self.assertEndpointQueries('/api/chat/rooms/', 5, max_repeats=1)
+            self.assertEqual(len(response.data), ChatRoom.objects.count())
+
+class MessageSearchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        other_user = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+        self.room, _ = ChatRoom.get_or_create_private(self.user, other_user)
+        self.both = Message.objects.create(room=self.room, sender=other_user, content='Lunch at noon?')
+        Message.objects.create(room=self.room, sender=self.user, content='Lunch sounds good')
+        Message.objects.create(room=self.room, sender=other_user, content='See you at noon')
+        self.client.force_authenticate(self.user)
+    
+    def search(self, query, room=None):
+        return self.client.get(f'/api/chat/rooms/{(room or self.room).id}/messages/search/', {'q': query})
+    
+    def test_every_word_must_match(self):
+        response = self.search('noon LUNCH')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([message['id'] for message in response.data['results']], [self.both.id])
+        self.assertEqual(len(self.search('noon').data['results']), 2)
+        self.assertEqual(self.search('noon dinner').data['results'], [])
+    
+    def test_edited_message_is_reindexed(self):
+        self.both.content = 'Dinner at eight?'
+        self.both.save()
+        self.assertEqual(self.search('lunch noon').data['results'], [])
+        self.assertEqual([message['id'] for message in self.search('dinner').data['results']], [self.both.id])
+    
+    def test_only_participants_can_search(self):
+        outsider = User.objects.create_user(username='carol', email='carol@example.com', password='password')
+        self.client.force_authenticate(outsider)
+        self.assertEqual(self.search('lunch').status_code, 404)
+    
+    def test_query_without_words_is_rejected(self):
+        for query in ('', '  ', '?!', 'a'):
+            response = self.search(query)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('q', response.data)
+    
+    def test_fulltext_backend_rejects_words_shorter_than_the_index_keeps(self):
+        backend = FullTextSearchBackend()
+        self.assertIsNone(backend.search(self.room.id, ['at', 'ok']))
+        sql = str(backend.search(self.room.id, ['at', 'noon']).query)
+        self.assertIn('MATCH', sql)
+        self.assertIn('+noon', sql)
+        self.assertNotIn('+at', sql)
+
+class UserSearchTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='adam', email='adam@example.com', password='password')
+        User.objects.create_user(
+            username='bob_adams', email='bob@example.com', password='password', first_name='Adalyn', last_name='Smith'
+        )
+        User.objects.create_user(
+            username='zed', email='zed@example.com', password='password', first_name='Zed', last_name='Adams'
+        )
+        User.objects.create_user(
+            username='ada', email='ada@example.com', password='password', first_name='Ada', last_name='Lovelace'
+        )
+        User.objects.create_user(username='xadx', email='xadx@example.com', password='password')
+        self.client.force_authenticate(self.user)
+    
+    def search(self, query):
+        return self.client.get('/api/chat/users/search/', {'q': query})
+    
+    def usernames(self, response):
+        return [user['username'] for user in response.data['users']]
+    
+    def test_prefix_matches_rank_username_then_first_then_last_name(self):
+        response = self.search(' Ad ')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'query', 'users'})
+        # The query is echoed stripped, and the searching user is left out
+        self.assertEqual(response.data['query'], 'Ad')
+        self.assertEqual(self.usernames(response), ['ada', 'bob_adams', 'zed'])
+        self.assertEqual(
+            set(response.data['users'][0]), {'id', 'username', 'first_name', 'last_name', 'email'}
+        )
+    
+    def test_several_words_match_first_and_last_name(self):
+        self.assertEqual(self.usernames(self.search('ada love')), ['ada'])
+        self.assertEqual(self.usernames(self.search('ada smith')), ['bob_adams'])
+        self.assertEqual(self.usernames(self.search('ada jones')), [])
+    
+    def test_empty_query_finds_nobody(self):
+        response = self.search('  ')
+        self.assertEqual(response.data, {'query': '', 'users': []})
+    
+    def test_repeated_prefix_is_served_from_cache(self):
+        self.search('ad')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.usernames(self.search('AD')), ['ada', 'bob_adams', 'zed'])
+        self.assertFalse([query for query in queries.captured_queries if 'LIKE' in query['sql']])
+
+class PrivateRoomTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        self.other_user = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+        self.client.force_authenticate(self.user)
+    
+    def private_rooms(self):
+        return ChatRoom.objects.filter(room_type='private')
+    
+    def test_one_room_per_pair_of_users(self):
+        first = self.client.post('/api/chat/rooms/private/', {'user_id': self.other_user.id})
+        second = self.client.post('/api/chat/rooms/private/', {'user_id': self.other_user.id})
+        self.assertEqual((first.status_code, second.status_code), (201, 200))
+        self.assertEqual(first.data['id'], second.data['id'])
+        
+        # From the other side, and through the generic room endpoint
+        self.client.force_authenticate(self.other_user)
+        response = self.client.post('/api/chat/rooms/private/', {'user_id': self.user.id})
+        self.assertEqual(response.data['id'], first.data['id'])
+        response = self.client.post(
+            '/api/chat/rooms/', {'room_type': 'private', 'participant_ids': [self.user.id]}, format='json'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.private_rooms().count(), 1)
+    
+    def test_concurrent_creation_returns_the_winning_room(self):
+        winner, _ = ChatRoom.get_or_create_private(self.other_user, self.user)
+        real_filter = ChatRoom.objects.filter
+        lookups = []
+        
+        def miss_first_lookup(*args, **kwargs):
+            # The other request inserts between our lookup and our insert
+            lookups.append(kwargs)
+            queryset = real_filter(*args, **kwargs)
+            return queryset.none() if len(lookups) == 1 else queryset
+        
+        with mock.patch.object(ChatRoom.objects, 'filter', side_effect=miss_first_lookup):
+            room, created = ChatRoom.get_or_create_private(self.user, self.other_user)
+        
+        self.assertEqual((room, created), (winner, False))
+        self.assertEqual(self.private_rooms().count(), 1)
+        self.assertEqual(set(room.participants.all()), {self.user, self.other_user})
+    
+    def test_deactivated_room_is_not_handed_back(self):
+        old_room, _ = ChatRoom.get_or_create_private(self.user, self.other_user)
+        old_room.is_active = False
+        old_room.save(update_fields=['is_active'])
+        
+        room, created = ChatRoom.get_or_create_private(self.other_user, self.user)
+        self.assertTrue(created)
+        self.assertNotEqual(room, old_room)
+        self.assertTrue(room.is_active)
+        old_room.refresh_from_db()
+        self.assertFalse(old_room.is_active)
+        self.assertIsNone(old_room.pair_key)
+    
+    def test_private_room_needs_exactly_one_other_user(self):
+        carol = User.objects.create_user(username='carol', email='carol@example.com', password='password')
+        for participant_ids in ([], [self.user.id], [self.other_user.id, carol.id], [0]):
+            with self.subTest(participant_ids=participant_ids):
+                response = self.client.post(
+                    '/api/chat/rooms/', {'room_type': 'private', 'participant_ids': participant_ids}, format='json'
+                )
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('participant_ids', response.data)
+        self.assertFalse(self.private_rooms().exists())
+        
+        # Listing yourself as well is allowed
+        response = self.client.post(
+            '/api/chat/rooms/', {'room_type': 'private', 'participant_ids': [self.user.id, carol.id]}, format='json'
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.private_rooms().get().pair_key, ChatRoom.pair_key_for(self.user.id, carol.id))
+
+class MessageSeqTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        other_user = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+        self.rooms = []
+        for i in range(2):
+            room = ChatRoom.objects.create(room_type='group', name=f'room {i}', created_by=self.user)
+            room.add_participants(self.user, other_user)
+            self.rooms.append(room)
+    
+    def test_save_writes_seq_message_and_unread_counters_only(self):
+        index_queue = SearchIndexQueue(interval=0.01)
+        
+        def create():
+            with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+                message = Message.objects.create(room=self.rooms[0], sender=self.user, content='hello world')
+            return message, [query['sql'] for query in queries]
+        
+        async def send():
+            # As on a worker serving sockets, where words are indexed in batches
+            index_queue.bind()
+            result = await sync_to_async(create)()
+            await asyncio.sleep(0.1)
+            return result
+        
+        with mock.patch('chat.search.search_index_queue', index_queue):
+            message, statements = async_to_sync(send)()
+        
+        writes = [sql.split()[0] for sql in statements if not sql.startswith(('SAVEPOINT', 'RELEASE'))]
+        self.assertEqual(writes, ['UPDATE', 'INSERT', 'UPDATE'])
+        self.assertEqual(message.seq, 1)
+        # The flusher indexed it afterwards
+        self.assertEqual(
+            set(MessageSearchToken.objects.filter(message=message).values_list('token', flat=True)),
+            {'hello', 'world'}
+        )
+    
+    def test_concurrent_reservations_share_one_transaction(self):
+        reservations = SeqReservations()
+        room_ids = [self.rooms[0].id, self.rooms[1].id, self.rooms[0].id, 0, self.rooms[0].id, self.rooms[1].id]
+        
+        async def reserve_all():
+            return await asyncio.gather(*(reservations.reserve(room_id) for room_id in room_ids))
+        
+        # One UPDATE per distinct count and one SELECT
+        with self.assertNumQueries(4):
+            seqs = async_to_sync(reserve_all)()
+        self.assertEqual(seqs, [1, 1, 2, None, 3, 2])
+        
+        Message.objects.create(room=self.rooms[0], sender=self.user, content='next')
+        self.assertEqual(Message.objects.get(content='next').seq, 4)
+
+class WriteBehindReadStateTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        self.other_user = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+        self.room, _ = ChatRoom.get_or_create_private(self.user, self.other_user)
+        Message.objects.create(room=self.room, sender=self.other_user, content='stored')
+        
+        # Broadcast but not written yet
+        self.buffer = MessageWriteBuffer(interval=60, batch_size=100)
+        first_seq = ChatRoom.reserve_seqs([self.room.id], count=5)[self.room.id]
+        for i in range(5):
+            self.buffer.pending.append(Message(
+                id=message_ids.next_id(),
+                room_id=self.room.id,
+                sender=self.other_user,
+                content=f'buffered {i}',
+                seq=first_seq + i
+            ))
+    
+    def read_state_after_flush(self, message_id):
+        RoomReadState.mark_read(
+            self.room.id, self.user.id, message_id, buffered=self.buffer.buffered(self.room.id)
+        )
+        self.buffer.drain()
+        return RoomReadState.objects.get(room=self.room, user=self.user)
+    
+    def test_read_of_buffered_message_survives_flush(self):
+        last_id = self.buffer.pending[-1].id
+        state = self.read_state_after_flush(last_id)
+        self.assertEqual(state.last_read_message_id, last_id)
+        self.assertEqual(state.unread_count, 0)
+    
+    def test_messages_after_watermark_stay_unread(self):
+        third_id = self.buffer.pending[2].id
+        state = self.read_state_after_flush(third_id)
+        self.assertEqual(state.last_read_message_id, third_id)
+        self.assertEqual(state.unread_count, 2)
+        # The sender's own messages never count
+        self.assertEqual(RoomReadState.objects.get(room=self.room, user=self.other_user).unread_count, 0)
+    
+    def test_resume_batch_reports_read_state_of_the_user(self):
+        buffered = self.buffer.buffered(self.room.id)
+        RoomReadState.mark_read(self.room.id, self.user.id, self.buffer.pending[2].id, buffered=buffered)
+        
+        messages = messages_after(self.room.id, 0, self.user, buffered=buffered)
+        self.assertEqual([message['content'] for message in messages][:2], ['stored', 'buffered 0'])
+        self.assertEqual(
+            [message['is_read_by_user'] for message in messages],
+            [True, True, True, True, False, False]
+        )
+
+class ConsumerTestMixin:
+    """Websocket clients against the ASGI application, in one event loop per test."""
+    
+    def tearDown(self):
+        # Write what the consumers buffered before the tables are flushed
+        message_buffer.drain()
+        search_index_queue.drain()
+        super().tearDown()
+    
+    def communicator(self, user, path):
+        return WebsocketCommunicator(
+            application, f'{path}?token={AccessToken.for_user(user)}',
+            headers=[(b'origin', b'http://localhost')]
+        )
+    
+    async def connect(self, user, path):
+        communicator = self.communicator(user, path)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+    
+    async def receive_type(self, communicator, event_type, limit=20):
+        seen = []
+        for _ in range(limit):
+            event = await communicator.receive_json_from(timeout=2)
+            if event.get('type') == event_type:
+                return event
+            seen.append(event)
+        self.fail(f'No {event_type} event in {seen}')
+
+class MultiplexConsumerTests(ConsumerTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        self.other_user = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+        self.rooms = []
+        for i in range(2):
+            room = ChatRoom.objects.create(room_type='group', name=f'room {i}', created_by=self.user)
+            room.add_participants(self.user, self.other_user)
+            self.rooms.append(room)
+        self.foreign_room = ChatRoom.objects.create(room_type='group', name='foreign', created_by=self.other_user)
+        self.foreign_room.add_participants(self.other_user)
+    
+    def test_subscribe_and_unsubscribe(self):
+        async def scenario():
+            multiplex = await self.connect(self.user, '/ws/multiplex/')
+            for room in self.rooms:
+                await multiplex.send_json_to({'type': 'subscribe', 'room_id': room.id})
+                event = await self.receive_type(multiplex, 'subscribed')
+                self.assertEqual(event['room_id'], room.id)
+            
+            single = await self.connect(self.other_user, f'/ws/chat/{self.rooms[1].id}/')
+            await single.send_json_to({'type': 'chat_message', 'message': 'hey'})
+            event = await self.receive_type(multiplex, 'chat_message')
+            self.assertEqual((event['room_id'], event['message']), (self.rooms[1].id, 'hey'))
+            
+            await multiplex.send_json_to({'type': 'chat_message', 'room_id': self.rooms[1].id, 'message': 'back'})
+            event = await self.receive_type(single, 'chat_message')
+            while event['message'] != 'back':
+                event = await self.receive_type(single, 'chat_message')
+            self.assertEqual(event['sender'], 'alice')
+            
+            await multiplex.send_json_to({'type': 'unsubscribe', 'room_id': self.rooms[1].id})
+            await self.receive_type(multiplex, 'unsubscribed')
+            await single.send_json_to({'type': 'chat_message', 'message': 'gone'})
+            await self.receive_type(single, 'chat_message')
+            await multiplex.send_json_to({'type': 'chat_message', 'room_id': self.rooms[1].id, 'message': 'x'})
+            event = await self.receive_type(multiplex, 'error')
+            self.assertEqual(event['message'], 'Not subscribed to room')
+            
+            await multiplex.disconnect()
+            await single.disconnect()
+        
+        async_to_sync(scenario)()
+        self.assertEqual(
+            list(Message.objects.filter(room=self.rooms[1]).order_by('id').values_list('content', flat=True)),
+            ['hey', 'back', 'gone']
+        )
+    
+    def test_subscribe_requires_membership(self):
+        async def scenario():
+            multiplex = await self.connect(self.user, '/ws/multiplex/')
+            await multiplex.send_json_to({'type': 'subscribe', 'room_id': self.foreign_room.id})
+            event = await self.receive_type(multiplex, 'error')
+            self.assertEqual((event['room_id'], event['message']), (self.foreign_room.id, 'Room not found'))
+            
+            await multiplex.send_json_to({'type': 'chat_message', 'room_id': self.foreign_room.id, 'message': 'x'})
+            event = await self.receive_type(multiplex, 'error')
+            self.assertEqual(event['message'], 'Not subscribed to room')
+            await multiplex.disconnect()
+        
+        async_to_sync(scenario)()
+        self.assertFalse(Message.objects.filter(room=self.foreign_room).exists())
+
+class UserFanoutTests(ConsumerTestMixin, APITransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        self.bob = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+        self.carol = User.objects.create_user(username='carol', email='carol@example.com', password='password')
+        self.rooms = []
+        for others in ([self.bob], [self.bob, self.carol], [self.carol]):
+            room = ChatRoom.objects.create(room_type='group', name=f'room {len(self.rooms)}', created_by=self.user)
+            room.add_participants(self.user, *others)
+            self.rooms.append(room)
+        self.client.force_authenticate(self.user)
+    
+    def test_rename_reaches_each_contact_once(self):
+        async def scenario():
+            room_socket = await self.connect(self.bob, f'/ws/chat/{self.rooms[0].id}/')
+            chat_list = await self.connect(self.carol, '/ws/chat/')
+            response = await sync_to_async(self.client.post)(
+                '/api/auth/profile/update-username/', {'username': 'alice_new'}, format='json'
+            )
+            self.assertEqual(response.status_code, 200)
+            
+            # One event on the user group, covering both rooms shared with bob
+            event = await self.receive_type(room_socket, 'user_update')
+            self.assertEqual(sorted(event['room_ids']), [self.rooms[0].id, self.rooms[1].id])
+            self.assertEqual(
+                sorted(message['room_id'] for message in event['system_messages']),
+                [self.rooms[0].id, self.rooms[1].id]
+            )
+            self.assertEqual(event['message'], 'alice is now known as alice_new')
+            
+            event = await self.receive_type(chat_list, 'user_update')
+            self.assertEqual(event['user']['username'], 'alice_new')
+            self.assertEqual(sorted(event['room_ids']), [self.rooms[1].id, self.rooms[2].id])
+            
+            await sync_to_async(ProfileImageUploadView().broadcast_user_update)(self.user)
+            event = await self.receive_type(chat_list, 'user_profile_update')
+            self.assertEqual(event['user']['profile_image'], None)
+            
+            await self.receive_type(room_socket, 'user_profile_update')
+            self.assertTrue(await room_socket.receive_nothing(0.3))
+            await room_socket.disconnect()
+            await chat_list.disconnect()
+        
+        async_to_sync(scenario)()
+        self.assertEqual(Message.objects.filter(message_type='system').count(), 3)
+        self.assertEqual(RoomReadState.objects.get(room=self.rooms[1], user=self.carol).unread_count, 1)
+        self.assertEqual(RoomReadState.objects.get(room=self.rooms[1], user=self.user).unread_count, 0)
+    
+    def test_contacts_map_to_shared_rooms(self):
+        contacts = room_contacts([room.id for room in self.rooms])
+        self.assertEqual(
+            {user_id: sorted(room_ids) for user_id, room_ids in contacts.items()},
+            {
+                self.user.id: [room.id for room in self.rooms],
+                self.bob.id: [self.rooms[0].id, self.rooms[1].id],
+                self.carol.id: [self.rooms[1].id, self.rooms[2].id],
+            }
+        )
+
+class TypingDigestTests(ConsumerTestMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+        self.other_user = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+        self.room, _ = ChatRoom.get_or_create_private(self.user, self.other_user)
+    
+    def test_keystrokes_coalesce_into_digests(self):
+        async def scenario():
+            listener = await self.connect(self.user, f'/ws/chat/{self.room.id}/')
+            typist = await self.connect(self.other_user, f'/ws/chat/{self.room.id}/')
+            for _ in range(50):
+                await typist.send_json_to({'type': 'typing_start'})
+            event = await self.receive_type(listener, 'typing_digest')
+            self.assertEqual(event['typing'], [{'user_id': self.other_user.id, 'username': 'bob'}])
+            self.assertEqual(event['stopped'], [])
+            
+            await typist.send_json_to({'type': 'typing_stop'})
+            event = await self.receive_type(listener, 'typing_digest')
+            self.assertEqual(event['typing'], [])
+            self.assertEqual(event['stopped'], [{'user_id': self.other_user.id, 'username': 'bob'}])
+            # Nothing changed since, so nothing more is published
+            self.assertTrue(await listener.receive_nothing(0.3))
+            
+            await listener.disconnect()
+            await typist.disconnect()
+        
+        with mock.patch.object(typing_tracker, 'interval', 0.1):
+            async_to_sync(scenario)()
+
+class TypingTrackerTests(SimpleTestCase):
+    def setUp(self):
+        self.tracker = TypingTracker(expiry=60)
+        patcher = mock.patch.object(self.tracker, 'ensure_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.alice = mock.Mock(id=1, username='alice')
+        self.bob = mock.Mock(id=2, username='bob')
+    
+    def collect(self):
+        return [(room_id, json.loads(event['text'])) for room_id, event in self.tracker.collect()]
+    
+    def test_one_digest_per_room_and_tick(self):
+        for _ in range(10):
+            self.tracker.start(7, self.alice)
+        self.tracker.start(7, self.bob)
+        self.tracker.start(8, self.bob)
+        
+        digests = dict(self.collect())
+        self.assertEqual(sorted(digests), [7, 8])
+        self.assertEqual([user['username'] for user in digests[7]['typing']], ['alice', 'bob'])
+        # Still typing, but nothing changed
+        self.tracker.start(7, self.alice)
+        self.assertEqual(self.collect(), [])
+    
+    def expire(self, room_id, user):
+        self.tracker.typing[room_id][user.id] = (user.username, time.monotonic() - 1)
+    
+    def test_typists_expire(self):
+        self.tracker.start(7, self.alice)
+        self.tracker.start(7, self.bob)
+        self.tracker.collect()
+        
+        self.expire(7, self.alice)
+        [(room_id, digest)] = self.collect()
+        self.assertEqual(room_id, 7)
+        self.assertEqual(digest['typing'], [{'user_id': 2, 'username': 'bob'}])
+        self.assertEqual(digest['stopped'], [{'user_id': 1, 'username': 'alice'}])
+        
+        self.expire(7, self.bob)
+        [(_, digest)] = self.collect()
+        self.assertEqual((digest['typing'], digest['stopped']), ([], [{'user_id': 2, 'username': 'bob'}]))
+        self.assertEqual(self.tracker.typing, {})
+
+class UploadRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = UploadRegistry()
+    
+    def chunk(self, data):
+        return base64.b64encode(data).decode()
+    
+    def test_temp_file_is_created_by_the_first_chunk(self):
+        upload = self.registry.start(1, 'a', 'notes.txt', 'text/plain', 10)
+        self.assertIsNone(upload.path)
+        
+        upload.write_chunk(0, self.chunk(b'hello'))
+        self.addCleanup(upload.discard)
+        self.assertTrue(os.path.exists(upload.path))
+    
+    def test_resume_compares_the_converted_file_size(self):
+        upload = self.registry.start(1, 'a', 'notes.txt', 'text/plain', '10')
+        upload.write_chunk(0, self.chunk(b'hello'))
+        self.addCleanup(upload.discard)
+        
+        resumed = self.registry.start(1, 'a', 'notes.txt', 'text/plain', '10')
+        self.assertIs(resumed, upload)
+        self.assertEqual(resumed.received, 5)
+        with self.assertRaises(UploadError):
+            self.registry.start(1, 'a', 'notes.txt', 'text/plain', 11)
+    
+    def test_released_uploads_are_forgotten_and_discarded(self):
+        upload = self.registry.start(1, 'a', 'notes.txt', 'text/plain', 10)
+        upload.write_chunk(0, self.chunk(b'hello'))
+        untouched = self.registry.start(1, 'b', 'other.txt', 'text/plain', 10)
+        
+        released = self.registry.release(1, ['a', 'b', 'unknown'])
+        self.assertEqual(released, [upload, untouched])
+        discard_uploads(released)
+        self.assertFalse(os.path.exists(upload.path))
+        with self.assertRaises(UploadError):
+            self.registry.get(1, 'a')
+    
+    def test_purge_returns_expired_uploads_without_touching_files(self):
+        self.registry.expiry = -1
+        upload = self.registry.start(1, 'a', 'notes.txt', 'text/plain', 10)
+        upload.write_chunk(0, self.chunk(b'hello'))
+        self.addCleanup(upload.discard)
+        
+        self.assertEqual(self.registry.purge_expired(), [upload])
+        self.assertTrue(os.path.exists(upload.path))
+        self.assertEqual(self.registry.uploads, {})
+
+class PresenceRegistryTests(SimpleTestCase):
+    def test_layer_error_does_not_stop_the_background_task(self):
+        registry = PresenceRegistry(flush_interval=0.01)
+        registry.users[1] = {'username': 'alice', 'channels': {'specific.abc': 0}, 'rooms': set()}
+        rounds = []
+        
+        async def reap():
+            rounds.append(len(rounds))
+            if len(rounds) == 1:
+                raise RuntimeError('channel full')
+        
+        registry.reap = reap
+        
+        async def run():
+            with self.assertLogs('chat.presence', 'ERROR'):
+                registry.ensure_flusher()
+                await asyncio.sleep(0.1)
+            registry.users.clear()
+            await asyncio.wait_for(registry.task, 1)
+        
+        async_to_sync(run)()
+        self.assertGreater(len(rounds), 1)
+    
+    def test_user_goes_offline_with_their_last_socket(self):
+        registry = PresenceRegistry(store=LocalPresenceStore())
+        published = []
+        
+        async def publish(user_id, username, room_ids, status):
+            published.append((set(room_ids), status))
+        
+        registry.publish = publish
+        user = mock.Mock(id=1, username='alice')
+        
+        async def run():
+            await registry.connect(user, 'specific.a')
+            await registry.join(user, {'id': 7})
+            await registry.connect(user, 'specific.b')
+            await registry.join(user, {'id': 7})
+            await registry.disconnect(1, 'specific.a')
+            self.assertEqual(published, [({7}, 'online')])
+            await registry.disconnect(1, 'specific.b')
+            registry.task.cancel()
+        
+        async_to_sync(run)()
+        self.assertEqual(published, [({7}, 'online'), ({7}, 'offline')])
+        self.assertEqual(registry.pending, {1: 'offline'})
+
+class UserCacheTests(SimpleTestCase):
+    def test_invalidate_user_drops_only_their_entries(self):
+        cache = UserCache(maxsize=10, ttl=60)
+        cache.set((1, 'a'), 'alice')
+        cache.set((1, 'b'), 'alice')
+        cache.set((2, 'c'), 'bob')
+        cache.invalidate_user(1)
+        self.assertIsNone(cache.get((1, 'a')))
+        self.assertIsNone(cache.get((1, 'b')))
+        self.assertEqual(cache.get((2, 'c')), 'bob')
+    
+    def test_invalidate_from_another_thread_while_in_use(self):
+        cache = UserCache(maxsize=50, ttl=60)
+        errors = []
+        stop = threading.Event()
+        
+        def invalidate():
+            try:
+                while not stop.is_set():
+                    cache.invalidate_user(1)
+            except Exception as e:
+                errors.append(e)
+        
+        thread = threading.Thread(target=invalidate)
+        thread.start()
+        try:
+            for i in range(20000):
+                cache.set((i % 3, i), 'user')
+                cache.get((i % 3, i - 1))
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(errors, [])
+
+class TwistedTransportStub:
+    """The write buffer attributes of a Twisted TCP transport."""
+    bufferSize = 65536
+    
+    def __init__(self):
+        self.dataBuffer = b''
+        self._tempDataLen = 0
+
+class OutboundQueueTests(SimpleTestCase):
+    def test_consumers_keep_the_base_send(self):
+        # Queued frames go through enqueue_send, so bytes_data and close still work
+        self.assertIs(ChatConsumer.send, AsyncWebsocketConsumer.send)
+        self.assertIs(MultiplexChatConsumer.send, AsyncWebsocketConsumer.send)
+    
+    def test_write_backlog_without_private_counter(self):
+        transport = TwistedTransportStub()
+        transport.dataBuffer = b'x' * 10
+        transport._tempDataLen = 5
+        self.assertEqual(write_backlog(transport), 15)
+        del transport._tempDataLen
+        self.assertEqual(write_backlog(transport), 10)
+    
+    def test_full_transport_holds_frames_until_drained(self):
+        transport = TwistedTransportStub()
+        sent = []
+        
+        async def send(text):
+            sent.append(text)
+            transport._tempDataLen += len(text)
+        
+        async def run():
+            queue = OutboundQueue(send, limit=4, max_lag=30)
+            queue.attach(transport)
+            self.assertTrue(queue.put('x' * 70000))
+            await asyncio.sleep(0)
+            self.assertEqual(len(sent), 1)
+            
+            # The client stopped reading, so frames queue up to the limit
+            results = [queue.put(f'frame {i}') for i in range(5)]
+            await asyncio.sleep(0.1)
+            self.assertEqual(results, [True] * 4 + [False])
+            self.assertEqual(len(sent), 1)
+            
+            transport._tempDataLen = 0
+            await asyncio.sleep(0.1)
+            self.assertEqual(sent[1:], [f'frame {i}' for i in range(4)])
+            queue.close()
+        
+        async_to_sync(run)()
+
+try:
+    import channels_redis.core
+    import fakeredis
+    import websocket
+except ImportError:
+    fakeredis = None
+
+# Creates two users sharing a few group rooms in a fresh database, prints ids and tokens
+FANOUT_SETUP = """
+import json
+from django.contrib.auth import get_user_model
+from rest_framework_simplejwt.tokens import AccessToken
+from chat.models import ChatRoom
+User = get_user_model()
+alice = User.objects.create_user(username='alice', email='alice@example.com', password='password')
+bob = User.objects.create_user(username='bob', email='bob@example.com', password='password')
+rooms = []
+for i in range(8):
+    room = ChatRoom.objects.create(room_type='group', name=f'room {i}', created_by=alice)
+    room.add_participants(alice, bob)
+    rooms.append(room.id)
+print(json.dumps({'rooms': rooms, 'alice': str(AccessToken.for_user(alice)), 'bob': str(AccessToken.for_user(bob))}))
+"""
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise AssertionError(f'Nothing listening on port {port}')
+
+class FakeRedisLayer:
+    """The parts of RedisChannelLayer the presence store uses, on one fakeredis server."""
+    prefix = 'asgi'
+    
+    def __init__(self):
+        self.redis = fakeredis.FakeAsyncRedis()
+    
+    def consistent_hash(self, value):
+        return 0
+    
+    def connection(self, index):
+        return self.redis
+
+@unittest.skipIf(fakeredis is None, 'needs channels-redis, fakeredis and websocket-client (requirements-dev.txt)')
+class RedisPresenceStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.store = RedisPresenceStore(FakeRedisLayer())
+    
+    def test_sockets_on_different_workers_share_one_presence(self):
+        async def run():
+            deadline = time.time() + 60
+            self.assertTrue(await self.store.add_socket(1, 'worker-a.x', deadline))
+            self.assertTrue(await self.store.add_room(1, 7, deadline))
+            self.assertFalse(await self.store.add_socket(1, 'worker-b.y', deadline))
+            self.assertFalse(await self.store.add_room(1, 7, deadline))
+            self.assertTrue(await self.store.add_room(1, 8, deadline))
+            
+            self.assertIsNone(await self.store.remove_socket(1, 'worker-a.x'))
+            self.assertEqual(await self.store.remove_socket(1, 'worker-b.y'), {7, 8})
+            # Nothing left behind for the next session
+            self.assertTrue(await self.store.add_socket(1, 'worker-a.z', deadline))
+            self.assertTrue(await self.store.add_room(1, 7, deadline))
+        
+        async_to_sync(run)()
+    
+    def test_sockets_past_their_deadline_do_not_count(self):
+        async def run():
+            # A worker that died without disconnecting its socket
+            await self.store.add_socket(1, 'dead.x', time.time() - 1)
+            await self.store.add_room(1, 7, time.time() - 1)
+            self.assertTrue(await self.store.add_socket(1, 'worker-a.y', time.time() + 60))
+            self.assertTrue(await self.store.add_room(1, 7, time.time() + 60))
+            
+            await self.store.add_socket(1, 'dying.z', time.time() + 60)
+            await self.store.refresh({1: ['dying.z']}, time.time() - 1)
+            self.assertEqual(await self.store.remove_socket(1, 'worker-a.y'), {7})
+        
+        async_to_sync(run)()
+    
+    def test_refresh_does_not_bring_back_removed_sockets(self):
+        async def run():
+            await self.store.add_socket(1, 'worker-a.x', time.time() + 60)
+            await self.store.remove_socket(1, 'worker-a.x')
+            await self.store.refresh({1: ['worker-a.x']}, time.time() + 60)
+            self.assertTrue(await self.store.add_socket(1, 'worker-a.y', time.time() + 60))
+        
+        async_to_sync(run)()
+
+@unittest.skipIf(fakeredis is None, 'needs channels-redis, fakeredis and websocket-client (requirements-dev.txt)')
+class ShardedChannelLayerTests(SimpleTestCase):
+    """
+    Two Daphne worker processes on CHANNEL_LAYER=redis with two fakeredis
+    shards: a message sent to one worker reaches a socket on the other.
+    """
+    
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.processes = []
+        cls.redis_servers = []
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        try:
+            cls.start_cluster()
+        except Exception:
+            cls.tearDownClass()
+            raise
+    
+    @classmethod
+    def start_cluster(cls):
+        for _ in range(2):
+            server = fakeredis.TcpFakeServer(('127.0.0.1', free_port()), server_type='redis')
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            cls.redis_servers.append(server)
+        cls.redis_hosts = [f'redis://127.0.0.1:{server.server_address[1]}' for server in cls.redis_servers]
+        
+        env = dict(
+            os.environ,
+            DB_ENGINE='django.db.backends.sqlite3',
+            DB_NAME=os.path.join(cls.tmpdir.name, 'db.sqlite3'),
+            CHANNEL_LAYER='redis',
+            REDIS_HOSTS=','.join(cls.redis_hosts),
+            CHAT_WRITE_BEHIND='False',
+        )
+        manage = [sys.executable, 'manage.py']
+        subprocess.run(manage + ['migrate', '--run-syncdb', '-v0'], cwd=settings.BASE_DIR, env=env, check=True)
+        output = subprocess.run(
+            manage + ['shell', '-c', FANOUT_SETUP],
+            cwd=settings.BASE_DIR, env=env, check=True, capture_output=True, text=True
+        ).stdout
+        cls.fixtures = json.loads(output.strip().splitlines()[-1])
+        
+        cls.worker_ports = []
+        for _ in range(2):
+            port = free_port()
+            # Daphne's runserver, one process per worker
+            cls.processes.append(subprocess.Popen(
+                manage + ['runserver', '--noreload', f'127.0.0.1:{port}'],
+                cwd=settings.BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            ))
+            cls.worker_ports.append(port)
+        for port in cls.worker_ports:
+            wait_for_port(port)
+    
+    @classmethod
+    def tearDownClass(cls):
+        for process in cls.processes:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                # Daphne waits for consumers blocked in a layer receive
+                process.kill()
+                process.wait()
+        for server in cls.redis_servers:
+            server.shutdown()
+            server.server_close()
+        cls.tmpdir.cleanup()
+        super().tearDownClass()
+    
+    def connect(self, worker, room_id, user):
+        url = f'ws://127.0.0.1:{self.worker_ports[worker]}/ws/chat/{room_id}/?token={self.fixtures[user]}'
+        client = websocket.create_connection(url, timeout=10)
+        self.addCleanup(client.close)
+        return client
+    
+    def receive_message(self, client, content):
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            frame = json.loads(client.recv())
+            if frame.get('type') == 'chat_message' and frame.get('message') == content:
+                return frame
+        self.fail(f'{content!r} was not delivered')
+    
+    def rooms_by_shard(self):
+        """One room whose group lives on each shard."""
+        layer = channels_redis.core.RedisChannelLayer(hosts=self.redis_hosts)
+        rooms_by_shard = {}
+        for room_id in self.fixtures['rooms']:
+            rooms_by_shard.setdefault(layer.consistent_hash(f'chat_{room_id}'), room_id)
+        return rooms_by_shard
+    
+    def test_group_send_reaches_sockets_on_other_worker(self):
+        rooms_by_shard = self.rooms_by_shard()
+        self.assertEqual(len(rooms_by_shard), 2)
+        
+        for shard, room_id in sorted(rooms_by_shard.items()):
+            with self.subTest(shard=shard):
+                sender = self.connect(0, room_id, 'alice')
+                receiver = self.connect(1, room_id, 'bob')
+                # The sender's own echo means its worker is subscribed too
+                content = f'hello from worker 0 via shard {shard}'
+                sender.send(json.dumps({'type': 'chat_message', 'message': content}))
+                
+                frame = self.receive_message(receiver, content)
+                self.assertEqual(frame['room_id'], room_id)
+                self.assertEqual(frame['sender'], 'alice')
+                self.receive_message(sender, content)
+    
+    def receive_until(self, client, predicate):
+        """Frames received up to and including the first one matching ``predicate``."""
+        frames = []
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            frames.append(json.loads(client.recv()))
+            if predicate(frames[-1]):
+                return frames
+        self.fail(f'No matching frame, got {frames}')
+    
+    def test_user_stays_online_while_connected_to_any_worker(self):
+        # Not one of the rooms other tests connect to
+        room_id = max(set(self.fixtures['rooms']) - set(self.rooms_by_shard().values()))
+        watcher = self.connect(0, room_id, 'alice')
+        first = self.connect(0, room_id, 'bob')
+        second = self.connect(1, room_id, 'bob')
+        
+        def bob_status(frame):
+            return (frame.get('type'), frame.get('username'), frame.get('status'))
+        
+        first.close()
+        # The closed consumer may have been blocked in BZPOPMIN for worker 0. Unlike
+        # Redis, fakeredis keeps serving that command after the client is gone and
+        # would pop (and lose) the next message for worker 0 until it times out.
+        time.sleep(channels_redis.core.RedisChannelLayer.brpop_timeout + 0.5)
+        second.send(json.dumps({'type': 'chat_message', 'message': 'still here'}))
+        frames = self.receive_until(watcher, lambda frame: frame.get('message') == 'still here')
+        self.assertNotIn(('user_status', 'bob', 'offline'), [bob_status(frame) for frame in frames])
+        
+        second.close()
+        self.receive_until(watcher, lambda frame: bob_status(frame) == ('user_status', 'bob', 'offline'))
@@ -0,0 +1,108 @@
+"""
+Coalesced ``ChatRoom.updated_at`` bumps.
+
+Every chat message moves its room to the top of the room list by bumping
+``updated_at``. A busy room would rewrite its row on every message, so this
+worker writes each room at most once per ``ROOM_TOUCH_INTERVAL``:
+
+* The first bump of a quiet room is written straight away, on the database
+  thread of the message insert that caused it.
+* Later bumps within the interval only remember their newest timestamp,
+  which a flusher task writes once the interval is over. A busy room
+  therefore never stays below a quieter one for longer than that.
+
+Rooms that stayed quiet for a whole interval are forgotten again.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from channels.db import database_sync_to_async
+from django.db import DatabaseError
+from django.db.models import Value
+from django.db.models.functions import Greatest
+from .models import ChatRoom
+
+logger = logging.getLogger(__name__)
+
+# Minimum seconds between updated_at bumps of the same room from one worker
+ROOM_TOUCH_INTERVAL = 5
+
+
+def write_touch(room_id, timestamp):
+    # Never move a room back, another worker may have bumped it later
+    ChatRoom.objects.filter(pk=room_id).update(updated_at=Greatest('updated_at', Value(timestamp)))
+
+
+class RoomTouches:
+    """Rooms bumped by this worker in the current interval, and deferred bumps."""
+
+    def __init__(self, interval=ROOM_TOUCH_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.touched_at = {}  # room_id -> monotonic time of its last write
+        self.pending = {}  # room_id -> newest timestamp not written yet
+        self.task = None
+
+    def touch(self, room_id, timestamp):
+        """
+        Bump a room now, or defer the bump to the end of the interval. Runs
+        on a database thread; the caller then starts the flusher with
+        ``ensure_flusher()``.
+        """
+        now = time.monotonic()
+        with self.lock:
+            touched_at = self.touched_at.get(room_id)
+            if touched_at is not None and now - touched_at < self.interval:
+                pending = self.pending.get(room_id)
+                if pending is None or timestamp > pending:
+                    self.pending[room_id] = timestamp
+                return
+            self.touched_at[room_id] = now
+            self.pending.pop(room_id, None)
+        write_touch(room_id, timestamp)
+
+    def take_due(self):
+        """Deferred bumps whose interval is over; forgets rooms that stayed quiet."""
+        now = time.monotonic()
+        due = {}
+        with self.lock:
+            for room_id, touched_at in list(self.touched_at.items()):
+                if now - touched_at < self.interval:
+                    continue
+                if room_id in self.pending:
+                    due[room_id] = self.pending.pop(room_id)
+                    self.touched_at[room_id] = now
+                else:
+                    del self.touched_at[room_id]
+        return due
+
+    @database_sync_to_async
+    def write(self, due):
+        for room_id, timestamp in due.items():
+            write_touch(room_id, timestamp)
+
+    async def flush(self):
+        due = self.take_due()
+        if not due:
+            return
+        try:
+            await self.write(due)
+        except DatabaseError:
+            # Only the room list order suffers, the next message bumps it again
+            logger.exception('Error writing room updated_at bumps')
+
+    def ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while self.touched_at:
+            # A fraction of the interval, so deferred bumps are not held much longer
+            await asyncio.sleep(self.interval / 5)
+            await self.flush()
+
+
+room_touches = RoomTouches()
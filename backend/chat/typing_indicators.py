@@ -0,0 +1,99 @@
+"""
+Server-side coalescing of typing indicators.
+
+Clients may send ``typing_start``/``typing_stop`` as often as they like;
+those frames only update in-memory state. Each room gets at most one
+``typing_digest`` per interval, and only when someone started or stopped
+typing, so the fan-out cost no longer follows keystrokes. Users who stop
+sending ``typing_start`` expire on their own.
+
+Digests are deltas (``typing`` and ``stopped``) so that digests published by
+different worker processes for the same room can be merged by clients.
+"""
+
+import asyncio
+import time
+from channels.layers import get_channel_layer
+from .events import build_event
+
+# Seconds after the last typing_start before a user counts as stopped
+TYPING_EXPIRY = 6
+# Seconds between digests of the same room
+DIGEST_INTERVAL = 1.0
+
+
+class TypingTracker:
+    """Typing state of the rooms served by this worker process."""
+
+    def __init__(self, expiry=TYPING_EXPIRY, interval=DIGEST_INTERVAL):
+        self.expiry = expiry
+        self.interval = interval
+        self.typing = {}  # room_id -> {user_id: (username, expires_at)}
+        self.stopped = {}  # room_id -> {user_id: username}
+        self.changed = set()
+        self.task = None
+
+    def start(self, room_id, user):
+        users = self.typing.setdefault(room_id, {})
+        if user.id not in users:
+            self.changed.add(room_id)
+        users[user.id] = (user.username, time.monotonic() + self.expiry)
+        self.stopped.get(room_id, {}).pop(user.id, None)
+        self.ensure_flusher()
+
+    def stop(self, room_id, user):
+        users = self.typing.get(room_id)
+        if not users or user.id not in users:
+            return
+        del users[user.id]
+        if not users:
+            del self.typing[room_id]
+        self.stopped.setdefault(room_id, {})[user.id] = user.username
+        self.changed.add(room_id)
+        self.ensure_flusher()
+
+    def collect(self):
+        """Expire stale typists and return the digests due for this tick."""
+        now = time.monotonic()
+        for room_id, users in list(self.typing.items()):
+            for user_id, (username, expires_at) in list(users.items()):
+                if expires_at < now:
+                    del users[user_id]
+                    self.stopped.setdefault(room_id, {})[user_id] = username
+                    self.changed.add(room_id)
+            if not users:
+                del self.typing[room_id]
+
+        digests = []
+        for room_id in self.changed:
+            typing = self.typing.get(room_id, {})
+            stopped = self.stopped.pop(room_id, {})
+            digests.append((room_id, build_event(
+                'typing_digest',
+                room_id=room_id,
+                typing=[
+                    {'user_id': user_id, 'username': username}
+                    for user_id, (username, _) in typing.items()
+                ],
+                stopped=[
+                    {'user_id': user_id, 'username': username}
+                    for user_id, username in stopped.items()
+                ],
+            )))
+        self.changed.clear()
+        return digests
+
+    def ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        channel_layer = get_channel_layer()
+        while self.typing or self.changed:
+            await asyncio.sleep(self.interval)
+            for room_id, digest in self.collect():
+                await channel_layer.group_send(f'chat_{room_id}', digest)
+
+
+typing_tracker = TypingTracker()
@@ -0,0 +1,157 @@
+"""
+Chunked file uploads streamed over a WebSocket connection.
+
+A client announces a file with ``file_start``, sends it as ``file_chunk``
+frames at explicit byte offsets and commits it with ``file_end``. Chunks are
+appended to a temporary file as they arrive, so memory held per connection
+is bounded by a single chunk regardless of the file size. Consumers call the
+file methods of ``ChunkedUpload`` and ``discard_uploads`` on the storage
+executor (chat/storage.py), never on the event loop; the registry itself
+only does bookkeeping. Uploads live in a per-process registry keyed by user,
+so a client can resume from the last acknowledged offset, until the
+connection that started the upload closes and its partial files are
+discarded.
+"""
+
+import base64
+import binascii
+import os
+import tempfile
+import time
+import uuid
+
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB, same limit as the REST upload
+MAX_CHUNK_SIZE = 256 * 1024
+MAX_UPLOADS_PER_USER = 3
+UPLOAD_EXPIRY_SECONDS = 10 * 60
+
+
+class UploadError(Exception):
+    """Raised when a chunked upload breaks the protocol or the size limit."""
+
+
+class ChunkedUpload:
+    """One in-progress upload backed by a temporary file."""
+
+    def __init__(self, upload_id, file_name, file_type, file_size):
+        self.upload_id = upload_id
+        self.file_name = file_name
+        self.file_type = file_type or 'application/octet-stream'
+        self.file_size = file_size
+        self.received = 0
+        self.touched_at = time.monotonic()
+        # Created by the first chunk, on the storage executor
+        self.temp_file = None
+
+    @property
+    def path(self):
+        return self.temp_file.name if self.temp_file else None
+
+    def write_chunk(self, offset, encoded_data):
+        """Append a base64 encoded chunk that must start at ``offset``."""
+        if offset != self.received:
+            raise UploadError(f'Expected offset {self.received}')
+        # Reject oversized frames before decoding them
+        if len(encoded_data) > (MAX_CHUNK_SIZE * 4) // 3 + 4:
+            raise UploadError('Chunk exceeds 256KB limit')
+        try:
+            data = base64.b64decode(encoded_data, validate=True)
+        except (binascii.Error, ValueError):
+            raise UploadError('Chunk is not valid base64')
+        if self.received + len(data) > self.file_size:
+            raise UploadError('Upload exceeds declared file size')
+
+        if self.temp_file is None:
+            self.temp_file = tempfile.NamedTemporaryFile(prefix='chat-upload-', delete=False)
+        self.temp_file.write(data)
+        self.received += len(data)
+        self.touched_at = time.monotonic()
+        return self.received
+
+    def finish(self):
+        """Close the temporary file once every declared byte has arrived."""
+        if self.received != self.file_size:
+            raise UploadError(f'Upload incomplete: {self.received} of {self.file_size} bytes received')
+        self.temp_file.close()
+        return self.path
+
+    def discard(self):
+        if self.temp_file is None:
+            return
+        self.temp_file.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadRegistry:
+    """In-progress uploads of this worker process, keyed by user."""
+
+    def __init__(self, max_per_user=MAX_UPLOADS_PER_USER, expiry=UPLOAD_EXPIRY_SECONDS):
+        self.max_per_user = max_per_user
+        self.expiry = expiry
+        self.uploads = {}
+
+    def start(self, user_id, upload_id, file_name, file_type, file_size):
+        """Begin a new upload, or return the existing one to resume it."""
+        if not file_name:
+            raise UploadError('file_name is required')
+        try:
+            file_size = int(file_size)
+        except (TypeError, ValueError):
+            raise UploadError('file_size is required')
+
+        if upload_id and (user_id, upload_id) in self.uploads:
+            upload = self.uploads[(user_id, upload_id)]
+            if upload.file_name != file_name or upload.file_size != file_size:
+                raise UploadError('Upload id already used for a different file')
+            upload.touched_at = time.monotonic()
+            return upload
+
+        if file_size <= 0:
+            raise UploadError('File is empty')
+        if file_size > MAX_UPLOAD_SIZE:
+            raise UploadError('File size exceeds 10MB limit')
+        if sum(1 for key in self.uploads if key[0] == user_id) >= self.max_per_user:
+            raise UploadError('Too many uploads in progress')
+
+        upload_id = str(upload_id or uuid.uuid4())
+        upload = ChunkedUpload(upload_id, file_name, file_type, file_size)
+        self.uploads[(user_id, upload_id)] = upload
+        return upload
+
+    def get(self, user_id, upload_id):
+        try:
+            return self.uploads[(user_id, upload_id)]
+        except KeyError:
+            raise UploadError('Unknown upload')
+
+    def pop(self, user_id, upload_id):
+        try:
+            return self.uploads.pop((user_id, upload_id))
+        except KeyError:
+            raise UploadError('Unknown upload')
+
+    def release(self, user_id, upload_ids):
+        """Forget the given uploads and return the ones that were in progress."""
+        uploads = [self.uploads.pop((user_id, upload_id), None) for upload_id in upload_ids]
+        return [upload for upload in uploads if upload]
+
+    def purge_expired(self):
+        """Forget uploads nobody touched within ``expiry`` and return them."""
+        cutoff = time.monotonic() - self.expiry
+        expired = []
+        for key, upload in list(self.uploads.items()):
+            if upload.touched_at < cutoff:
+                del self.uploads[key]
+                expired.append(upload)
+        return expired
+
+
+def discard_uploads(uploads):
+    for upload in uploads:
+        upload.discard()
+
+
+upload_registry = UploadRegistry()
@@ -12,6 +12,7 @@ urlpatterns = [
     # Messages
     path('rooms/<int:room_id>/messages/', views.MessageListView.as_view(), name='message-list'),
     path('rooms/<int:room_id>/messages/read/', views.mark_messages_read, name='mark-messages-read'),
+    path('rooms/<int:room_id>/messages/search/', views.MessageSearchView.as_view(), name='message-search'),
     
     # File uploads
     path('rooms/<int:room_id>/upload/', views.upload_file, name='upload-file'),
@@ -19,4 +20,7 @@ urlpatterns = [
     
     # User search
     path('users/search/', views.search_users, name='search-users'),
+    
+    # Operations
+    path('stats/outbound/', views.outbound_queue_stats, name='outbound-queue-stats'),
 ]
@@ -1,18 +1,74 @@
 from rest_framework import generics, status, permissions
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
-from django.db.models import Q, Max
+from django.db.models import Max, OuterRef, Prefetch, Subquery
 from django.shortcuts import get_object_or_404
-from .models import ChatRoom, Message, FileAttachment
+from .models import ChatRoom, Message, FileAttachment, RoomReadState
+from .outbound import outbound_stats
+from .pagination import MessageKeysetPagination
+from .search import USER_SEARCH_LIMIT, search_messages, search_users as search_users_by_prefix
 from .serializers import (
     ChatRoomSerializer, CreateChatRoomSerializer, MessageSerializer,
     FileAttachmentSerializer, UserSearchSerializer
 )
+from .writebehind import message_buffer
 
 User = get_user_model()
 
+def annotate_unread_count(queryset, user):
+    """Attach the user's maintained unread counter to each room in one query."""
+    return queryset.annotate(
+        user_unread_count=Subquery(
+            RoomReadState.objects.filter(
+                room=OuterRef('pk'),
+                user=user
+            ).values('unread_count')[:1]
+        )
+    )
+
+def annotate_last_message_id(queryset):
+    """Annotate each room with the id of its newest message."""
+    # One (room, timestamp, id) index seek per room, independent of history size
+    return queryset.annotate(
+        latest_message_id=Subquery(
+            Message.objects.filter(
+                room=OuterRef('pk')
+            ).order_by('-timestamp', '-id').values('id')[:1]
+        )
+    )
+
+def attach_last_messages(rooms):
+    """Load the annotated last messages of many rooms with a single query."""
+    message_ids = [room.latest_message_id for room in rooms if room.latest_message_id]
+    messages = Message.objects.filter(
+        id__in=message_ids
+    ).select_related('sender', 'sender__chat_status').prefetch_related('attachments')
+    messages_by_id = {message.id: message for message in messages}
+    
+    for room in rooms:
+        room._last_message = messages_by_id.get(room.latest_message_id)
+    return rooms
+
+def prefetch_participants(queryset):
+    """Load every room's participants and their statuses in one query."""
+    return queryset.prefetch_related(
+        Prefetch('participants', queryset=User.objects.select_related('chat_status'))
+    )
+
+def notify_room_changed(room_id):
+    """Tell connected consumers to drop their cached copy of a room."""
+    channel_layer = get_channel_layer()
+    if channel_layer:
+        async_to_sync(channel_layer.group_send)(f'chat_{room_id}', {
+            'type': 'room_invalidate',
+            'room_id': room_id
+        })
+
 class ChatRoomListView(generics.ListCreateAPIView):
     """List user's chat rooms or create a new chat room."""
     permission_classes = [permissions.IsAuthenticated]
@@ -23,12 +79,22 @@ class ChatRoomListView(generics.ListCreateAPIView):
         return ChatRoomSerializer
     
     def get_queryset(self):
-        return ChatRoom.objects.filter(
+        queryset = prefetch_participants(ChatRoom.objects.filter(
             participants=self.request.user,
             is_active=True
-        ).prefetch_related(
-            'participants', 'messages', 'messages__sender'
-        ).order_by('-updated_at')
+        )).order_by('-updated_at')
+        queryset = annotate_last_message_id(queryset)
+        return annotate_unread_count(queryset, self.request.user)
+    
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['read_watermarks'] = RoomReadState.watermarks_for(self.request.user.id)
+        return context
+    
+    def list(self, request, *args, **kwargs):
+        rooms = attach_last_messages(list(self.filter_queryset(self.get_queryset())))
+        serializer = self.get_serializer(rooms, many=True)
+        return Response(serializer.data)
 
 class ChatRoomDetailView(generics.RetrieveUpdateDestroyAPIView):
     """Retrieve, update or delete a chat room."""
@@ -36,15 +102,26 @@ class ChatRoomDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [permissions.IsAuthenticated]
     
     def get_queryset(self):
-        return ChatRoom.objects.filter(
+        queryset = prefetch_participants(ChatRoom.objects.filter(
             participants=self.request.user,
             is_active=True
-        ).prefetch_related('participants', 'messages')
+        ))
+        return annotate_unread_count(queryset, self.request.user)
+    
+    def perform_update(self, serializer):
+        room = serializer.save()
+        notify_room_changed(room.id)
+    
+    def perform_destroy(self, instance):
+        room_id = instance.id
+        instance.delete()
+        notify_room_changed(room_id)
 
 class MessageListView(generics.ListCreateAPIView):
     """List messages in a chat room or send a new message."""
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageKeysetPagination
     
     def get_queryset(self):
         room_id = self.kwargs['room_id']
@@ -57,9 +134,20 @@ class MessageListView(generics.ListCreateAPIView):
         
         return Message.objects.filter(
             room=room
-        ).select_related('sender').prefetch_related(
-            'attachments', 'read_by'
-        ).order_by('-timestamp')[:50]  # Limit to last 50 messages
+        ).select_related(
+            'sender', 'sender__chat_status'
+        ).prefetch_related(
+            'attachments'
+        )  # Ordering and page slicing are applied by the keyset paginator
+    
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        # Resolve read state once for the whole page
+        context['read_watermarks'] = RoomReadState.watermarks_for(
+            self.request.user.id,
+            [self.kwargs['room_id']]
+        )
+        return context
     
     def perform_create(self, serializer):
         room_id = self.kwargs['room_id']
@@ -70,6 +158,38 @@ class MessageListView(generics.ListCreateAPIView):
         )
         serializer.save(sender=self.request.user, room=room)
 
+class MessageSearchView(generics.ListAPIView):
+    """Search a chat room's messages; every word of ``q`` must match."""
+    serializer_class = MessageSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageKeysetPagination
+    
+    def get_queryset(self):
+        # Verify user is participant in the room
+        room = get_object_or_404(
+            ChatRoom,
+            id=self.kwargs['room_id'],
+            participants=self.request.user
+        )
+        
+        messages = search_messages(room.id, self.request.query_params.get('q', ''))
+        if messages is None:
+            raise ValidationError({'q': 'Enter at least one word to search for.'})
+        
+        return messages.select_related(
+            'sender', 'sender__chat_status'
+        ).prefetch_related(
+            'attachments'
+        )  # Newest matches first, paged by the keyset paginator
+    
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['read_watermarks'] = RoomReadState.watermarks_for(
+            self.request.user.id,
+            [self.kwargs['room_id']]
+        )
+        return context
+
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def create_private_chat(request):
@@ -90,27 +210,13 @@ def create_private_chat(request):
             status=status.HTTP_404_NOT_FOUND
         )
     
-    # Check if private chat already exists
-    existing_room = ChatRoom.objects.filter(
-        room_type='private',
-        participants=request.user
-    ).filter(
-        participants=other_user
-    ).first()
-    
-    if existing_room:
-        serializer = ChatRoomSerializer(existing_room, context={'request': request})
-        return Response(serializer.data)
-    
-    # Create new private chat
-    chat_room = ChatRoom.objects.create(
-        room_type='private',
-        created_by=request.user
-    )
-    chat_room.participants.add(request.user, other_user)
+    # Single lookup on the unique pair key, safe against concurrent requests
+    chat_room, created = ChatRoom.get_or_create_private(request.user, other_user)
     
     serializer = ChatRoomSerializer(chat_room, context={'request': request})
-    return Response(serializer.data, status=status.HTTP_201_CREATED)
+    if created:
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+    return Response(serializer.data)
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
@@ -163,23 +269,18 @@ def upload_file(request, room_id):
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def search_users(request):
-    """Search for users by username or name."""
+    """Search for users by username or name prefix."""
     query = request.GET.get('q', '').strip()
     
-    if not query:
-        return Response({'users': []})
-    
-    # Exclude current user from search results
-    users = User.objects.filter(
-        Q(username__icontains=query) |
-        Q(first_name__icontains=query) |
-        Q(last_name__icontains=query)
-    ).exclude(
-        id=request.user.id
-    )[:10]  # Limit to 10 results
+    # Fetch one spare result in case the current user is among the matches
+    users = [
+        user for user in search_users_by_prefix(query, limit=USER_SEARCH_LIMIT + 1)
+        if user['id'] != request.user.id
+    ][:USER_SEARCH_LIMIT]
     
     serializer = UserSearchSerializer(users, many=True)
-    return Response({'users': serializer.data})
+    # Echo the query so debounced clients can drop out-of-order responses
+    return Response({'query': query, 'users': serializer.data})
 
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
@@ -191,21 +292,17 @@ def mark_messages_read(request, room_id):
         participants=request.user
     )
     
-    # Get all unread messages in the room
-    unread_messages = Message.objects.filter(
-        room=room
-    ).exclude(
-        sender=request.user
-    ).exclude(
-        read_by=request.user
-    )
-    
-    # Mark all as read
-    for message in unread_messages:
-        message.mark_as_read(request.user)
+    # Move the user's read watermark to the newest message in the room
+    RoomReadState.mark_read(room.id, request.user.id, buffered=message_buffer.buffered(room.id))
     
     return Response({'status': 'Messages marked as read'})
 
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def outbound_queue_stats(request):
+    """WebSocket send queue depths and slow client counters of this process."""
+    return Response(outbound_stats())
+
 class FileAttachmentView(generics.RetrieveAPIView):
     """Retrieve file attachment details."""
     serializer_class = FileAttachmentSerializer
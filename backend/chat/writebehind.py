@@ -0,0 +1,219 @@
+"""
+Write-behind buffer for chat messages sent over WebSockets.
+
+With ``CHAT_WRITE_BEHIND`` on, a consumer gives a text message its id and
+timestamp in memory, broadcasts it straight away and leaves the INSERT to
+this buffer. Everything the worker queued during an interval is written
+with one ``bulk_create``, together with the unread counters, search index
+entries and room ``updated_at`` bumps that ``Message.save`` would have done
+row by row.
+
+A failed batch stays queued and is retried on the next interval, and
+whatever is still queued when the process exits (e.g. on SIGTERM) is
+written by an ``atexit`` hook. Messages are only lost if the process is
+killed outright.
+
+Sequence numbers are reserved in the room before the broadcast, so a row
+can reach the table after later ones of the same room. Reconnect catch-up
+(chat/resume.py) therefore also looks at what is still queued here.
+
+``SeqReservations`` reserves them for every message that arrives while a
+reservation is in flight with one transaction. Handing out blocks kept in
+memory would save that too, but then another worker's later message could
+get a lower seq than one a client already saw, and resume would skip it.
+"""
+
+import asyncio
+import atexit
+import logging
+from collections import Counter
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError, IntegrityError, transaction
+from django.utils import timezone
+from .ids import message_ids
+from .models import ChatRoom, Message, RoomReadState
+from .search import index_messages
+from .touches import room_touches
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+
+class SeqReservations:
+    """Reserves the seqs of this worker's messages, one transaction per batch."""
+
+    def __init__(self):
+        self.waiting = {}  # room_id -> futures, in arrival order
+        self.task = None
+
+    async def reserve(self, room_id):
+        """The next seq of a room, or None if the room was deleted."""
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(room_id, []).append(future)
+        self.ensure_reserver()
+        return await future
+
+    def ensure_reserver(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while self.waiting:
+            waiting, self.waiting = self.waiting, {}
+            try:
+                first_seqs = await database_sync_to_async(ChatRoom.reserve_seqs)({
+                    room_id: len(futures) for room_id, futures in waiting.items()
+                })
+            except DatabaseError as e:
+                for futures in waiting.values():
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                continue
+
+            for room_id, futures in waiting.items():
+                first_seq = first_seqs.get(room_id)
+                for offset, future in enumerate(futures):
+                    # A cancelled sender leaves a gap, which resume tolerates
+                    if not future.done():
+                        future.set_result(None if first_seq is None else first_seq + offset)
+
+
+class MessageWriteBuffer:
+    """Messages of this worker that were broadcast but not inserted yet."""
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending = []
+        # Batch being inserted right now, still visible to buffered()
+        self.writing = []
+        self.task = None
+
+    def add(self, room_id, sender, content, seq, message_type='text'):
+        """Queue a new message and return it with its final id and timestamp."""
+        message = Message(
+            id=message_ids.next_id(),
+            room_id=room_id,
+            sender=sender,
+            content=content,
+            message_type=message_type,
+            timestamp=timezone.now(),
+            seq=seq
+        )
+        self.pending.append(message)
+        self.ensure_flusher()
+        return message
+
+    def take_batch(self):
+        batch, self.pending = self.pending, []
+        return batch
+
+    def buffered(self, room_id):
+        """Messages of a room that may not be in the table yet."""
+        return [
+            message for message in self.writing + self.pending
+            if message.room_id == room_id
+        ]
+
+    def write(self, batch):
+        with transaction.atomic():
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create(batch, batch_size=self.batch_size)
+            except IntegrityError:
+                # A room or sender was deleted meanwhile, or an id is taken
+                batch = self.without_deleted_references(batch)
+                for message in batch:
+                    self.write_one(message)
+
+            first_ids = {}
+            for message in batch:
+                first_ids[message.room_id] = min(message.id, first_ids.get(message.room_id, message.id))
+            unread = Counter((message.room_id, message.sender_id) for message in batch)
+            for (room_id, sender_id), count in unread.items():
+                RoomReadState.increment_unread(room_id, sender_id, count, read_below=first_ids[room_id])
+            # Reads that arrived while the batch was buffered already cover part of it
+            for room_id, first_id in first_ids.items():
+                RoomReadState.recount_unread(room_id, first_id)
+            index_messages(batch)
+
+        for message in batch:
+            room_touches.touch(message.room_id, message.timestamp)
+
+    def without_deleted_references(self, batch):
+        """Drop messages whose room or sender no longer exists."""
+        room_ids = set(ChatRoom.objects.filter(
+            pk__in={message.room_id for message in batch}
+        ).values_list('id', flat=True))
+        sender_ids = set(User.objects.filter(
+            pk__in={message.sender_id for message in batch}
+        ).values_list('id', flat=True))
+        return [
+            message for message in batch
+            if message.room_id in room_ids and message.sender_id in sender_ids
+        ]
+
+    def write_one(self, message):
+        """
+        Insert a message the batch insert rejected. A second failure raises,
+        so the batch stays queued instead of losing the row.
+        """
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create([message])
+            return
+        except IntegrityError:
+            # Its id is taken, so two workers share a CHAT_WORKER_ID
+            logger.error(
+                'Message id %s is already taken, CHAT_WORKER_ID %s is not unique',
+                message.id, message_ids.worker_id
+            )
+
+        # Clients saw the old id in the broadcast, but a renumbered row beats a lost one
+        message.id = message_ids.next_id()
+        with transaction.atomic():
+            Message.objects.bulk_create([message])
+
+    async def flush(self):
+        batch = self.take_batch()
+        if not batch:
+            return
+        self.writing = batch
+        try:
+            await database_sync_to_async(self.write)(batch)
+            room_touches.ensure_flusher()
+        except DatabaseError:
+            # Retry on the next interval, ahead of anything queued since
+            self.pending[:0] = batch
+            logger.exception('Error writing buffered messages')
+        finally:
+            self.writing = []
+
+    def drain(self):
+        """Write whatever is still queued; runs at interpreter exit."""
+        batch = self.take_batch()
+        if batch:
+            self.write(batch)
+
+    def ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self.task is None or self.task.done() or self.task.get_loop() is not loop:
+            self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while self.pending:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+message_buffer = MessageWriteBuffer(
+    settings.CHAT_WRITE_BEHIND_INTERVAL,
+    settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+)
+atexit.register(message_buffer.drain)
+seq_reservations = SeqReservations()
@@ -0,0 +1,274 @@
+"""
+In-process metrics registry, exposed in Prometheus text format on /metrics.
+
+Off unless ``METRICS_ENABLED`` is set. Hot paths check ``metrics.enabled``
+before taking any timing, and the channel layer, database_sync_to_async and
+REST hooks are only installed when it is on, so a disabled registry costs a
+single attribute lookup per event.
+
+Every worker process keeps its own registry; scrape each worker separately.
+"""
+
+import bisect
+import contextvars
+import inspect
+import logging
+import threading
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from well under a millisecond up to slow outliers
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+enabled = settings.METRICS_ENABLED
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            lines.extend(self.samples(key, value))
+        return lines
+
+    def samples(self, key, value):
+        return [f'{self.name}{format_labels(self.labels, key)} {value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set_total(self, value, **labels):
+        """Mirror a total that is counted elsewhere."""
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket counts (the last one is +Inf), sum
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            labels = format_labels(self.labels, key, [('le', bound)])
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = format_labels(self.labels, key)
+        lines.append(f'{self.name}_sum{labels} {total}')
+        lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # Called at scrape time to refresh gauges owned by other modules
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        for collect in self.collectors:
+            collect()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+EVENT_SECONDS = registry.histogram(
+    'chat_event_seconds',
+    'Time from receiving a client frame to finishing its handling and broadcast.',
+    ['event']
+)
+GROUP_SEND_SECONDS = registry.histogram(
+    'channel_layer_group_send_seconds',
+    'Duration of channel layer group_send calls.',
+    ['event']
+)
+DB_WAIT_SECONDS = registry.histogram(
+    'db_sync_to_async_wait_seconds',
+    'Time database_sync_to_async calls spend waiting for their worker thread.',
+    ['func']
+)
+DB_RUN_SECONDS = registry.histogram(
+    'db_sync_to_async_run_seconds',
+    'Time database_sync_to_async calls spend running on their worker thread.',
+    ['func']
+)
+ROOM_CONNECTIONS = registry.gauge(
+    'chat_room_connections',
+    'Room subscriptions of open sockets, by consumer.',
+    ['consumer']
+)
+VIEW_QUERIES = registry.histogram(
+    'http_view_db_queries',
+    'Database queries per request, by URL name.',
+    ['view'],
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100, 250)
+)
+
+
+def instrument_channel_layers():
+    """Time ``group_send`` on every channel layer created from now on."""
+    from channels.layers import channel_layers
+
+    make_backend = channel_layers._make_backend
+
+    def make_timed_backend(name, config):
+        layer = make_backend(name, config)
+        group_send = layer.group_send
+
+        async def timed_group_send(group, message):
+            started = time.perf_counter()
+            try:
+                return await group_send(group, message)
+            finally:
+                GROUP_SEND_SECONDS.observe(
+                    time.perf_counter() - started,
+                    event=message.get('type', 'unknown')
+                )
+
+        layer.group_send = timed_group_send
+        return layer
+
+    channel_layers._make_backend = make_timed_backend
+    channel_layers.backends = {}
+
+
+# The asgiref internals timed_thread_handler relies on: the sync call comes
+# last among the positional arguments
+THREAD_HANDLER_PARAMETERS = ['self', 'loop', 'exc_info', 'task_context', 'func', 'args', 'kwargs']
+
+
+def instrument_database_sync_to_async():
+    """Split database_sync_to_async calls into thread wait and run time."""
+    import asgiref
+    from asgiref.sync import SyncToAsync
+    from channels.db import DatabaseSyncToAsync
+
+    if list(inspect.signature(SyncToAsync.thread_handler).parameters) != THREAD_HANDLER_PARAMETERS:
+        logger.warning(
+            'SyncToAsync.thread_handler of asgiref %s is not the one known here, '
+            'database_sync_to_async calls are not timed', asgiref.__version__
+        )
+        return
+
+    queued_at = contextvars.ContextVar('db_call_queued_at')
+    call = DatabaseSyncToAsync.__call__
+    thread_handler = DatabaseSyncToAsync.thread_handler
+
+    async def timed_call(self, *args, **kwargs):
+        # The call's context is copied to the worker thread along with this
+        token = queued_at.set(time.perf_counter())
+        try:
+            return await call(self, *args, **kwargs)
+        finally:
+            queued_at.reset(token)
+
+    def timed_thread_handler(self, loop, *args, **kwargs):
+        *args, child = args
+        name = getattr(self.func, '__qualname__', 'unknown')
+
+        def timed_child():
+            started = time.perf_counter()
+            DB_WAIT_SECONDS.observe(started - queued_at.get(started), func=name)
+            try:
+                return child()
+            finally:
+                DB_RUN_SECONDS.observe(time.perf_counter() - started, func=name)
+
+        return thread_handler(self, loop, *args, timed_child, **kwargs)
+
+    DatabaseSyncToAsync.__call__ = timed_call
+    DatabaseSyncToAsync.thread_handler = timed_thread_handler
+
+
+installed = False
+
+
+def install():
+    """Hook the instrumentation in; does nothing while metrics are disabled."""
+    global installed
+    if not enabled or installed:
+        return
+    installed = True
+    instrument_channel_layers()
+    instrument_database_sync_to_async()
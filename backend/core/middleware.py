@@ -1,8 +1,19 @@
 """
 Custom middleware for handling Cross-Origin-Opener-Policy and security headers
-specifically for Google OAuth integration.
+specifically for Google OAuth integration, and for request metrics and query
+profiling.
 """
 
+import json
+import logging
+import time
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from . import metrics
+from .queries import record_queries
+
+profiler_logger = logging.getLogger('core.queries')
+
 class SecurityHeadersMiddleware:
     """
     Middleware to add security headers that allow Google OAuth to work properly.
@@ -24,4 +35,75 @@ class SecurityHeadersMiddleware:
         if hasattr(response, 'get') and response.get('Access-Control-Allow-Origin'):
             response['Cross-Origin-Resource-Policy'] = 'cross-origin'
             
+        return response
+
+class MetricsMiddleware:
+    """
+    Count the database queries of each request by URL name. Removed from the
+    middleware chain entirely while metrics are disabled.
+    """
+    
+    def __init__(self, get_response):
+        if not metrics.enabled:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        with record_queries() as queries:
+            response = self.get_response(request)
+        
+        match = request.resolver_match
+        if match is not None:
+            metrics.VIEW_QUERIES.observe(queries.count, view=match.view_name or match._func_path)
+        return response
+
+class QueryProfilerMiddleware:
+    """
+    Profile each request's database work: query count, time spent in the
+    database and statements repeated within the request, the usual sign of
+    an N+1 in a serializer. Reported in a ``Server-Timing`` header, and for
+    slow, query-heavy or repetitive requests as one JSON line on the
+    ``core.queries`` logger.
+    """
+    
+    def __init__(self, get_response):
+        if not settings.QUERY_PROFILER_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+    
+    def __call__(self, request):
+        started = time.perf_counter()
+        with record_queries() as queries:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+        
+        repeated = queries.repeated(settings.QUERY_PROFILER_REPEAT_LIMIT)
+        timings = [
+            f'total;dur={elapsed * 1000:.1f}',
+            f'db;dur={queries.duration * 1000:.1f};desc="{queries.count} queries"',
+        ]
+        if repeated:
+            timings.append(f'db-repeated;desc="{len(repeated)} statements, worst x{repeated[0][1]}"')
+        response['Server-Timing'] = ', '.join(timings)
+        
+        if (
+            elapsed * 1000 >= settings.QUERY_PROFILER_SLOW_MS
+            or queries.count > settings.QUERY_PROFILER_MAX_QUERIES
+            or repeated
+        ):
+            match = request.resolver_match
+            profiler_logger.warning(json.dumps({
+                'method': request.method,
+                'path': request.path,
+                'view': match.view_name if match is not None else None,
+                'status': response.status_code,
+                'duration_ms': round(elapsed * 1000, 1),
+                'db_ms': round(queries.duration * 1000, 1),
+                'queries': queries.count,
+                'repeated': [
+                    {'sql': sql[:300], 'count': count}
+                    for sql, count in repeated[:5]
+                ],
+            }))
+        
         return response
\ No newline at end of file
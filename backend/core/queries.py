@@ -0,0 +1,54 @@
+"""
+Recording of the database queries run by a block of code.
+
+Used by the request profiling middleware and by the query budget helpers
+in core/testing.py.
+"""
+
+import contextlib
+import re
+import time
+from collections import Counter
+from django.db import connections
+
+# "IN (%s, %s, %s)" lists of any length count as the same statement
+PLACEHOLDER_LIST = re.compile(r'\((?:%s, )+%s\)')
+
+
+def query_signature(sql):
+    return PLACEHOLDER_LIST.sub('(%s, ...)', sql)
+
+
+class QueryRecorder:
+    """``execute_wrapper`` that counts, times and groups the queries it sees."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.signatures = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.signatures[query_signature(sql)] += 1
+
+    def repeated(self, min_count=2):
+        """Statements run at least ``min_count`` times, most frequent first."""
+        return [
+            (sql, count) for sql, count in self.signatures.most_common()
+            if count >= min_count
+        ]
+
+
+@contextlib.contextmanager
+def record_queries():
+    """Record the queries of every database connection of this thread."""
+    recorder = QueryRecorder()
+    with contextlib.ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
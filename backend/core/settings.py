@@ -1,7 +1,7 @@
 import os
 from datetime import timedelta
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -43,6 +43,8 @@ MIDDLEWARE = [
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'core.middleware.SecurityHeadersMiddleware',  # Custom middleware for OAuth
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.QueryProfilerMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -72,22 +74,44 @@ WSGI_APPLICATION = 'core.wsgi.application'
 ASGI_APPLICATION = 'core.asgi.application'
 
 # Channels configuration
-# Using in-memory channel layer for development (single-server only)
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
-}
+# 'memory' keeps the layer in-process (development and tests, single worker only).
+# 'redis' lets any number of ASGI workers share groups; channels and groups are
+# sharded by consistent hashing across every host listed in REDIS_HOSTS.
+CHANNEL_LAYER = config('CHANNEL_LAYER', default='memory')
+
+if CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                # channels-redis blocks for up to 5 seconds in BZPOPMIN while
+                # waiting for messages, and recent redis-py releases default to a
+                # 5 second socket timeout, which would kill idle consumers.
+                'hosts': [
+                    {'address': address, 'socket_timeout': 15}
+                    for address in config(
+                        'REDIS_HOSTS',
+                        default=config('REDIS_URL', default='redis://localhost:6379'),
+                        cast=Csv()
+                    )
+                ],
+                'capacity': config('CHANNEL_LAYER_CAPACITY', default=1500, cast=int),
+                'expiry': config('CHANNEL_LAYER_EXPIRY', default=60, cast=int),
+                'group_expiry': config('CHANNEL_LAYER_GROUP_EXPIRY', default=86400, cast=int),
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
 
-# For production with Redis 5.0+, use:
-# CHANNEL_LAYERS = {
-#     'default': {
-#         'BACKEND': 'channels_redis.core.RedisChannelLayer',
-#         'CONFIG': {
-#             "hosts": [config('REDIS_URL', default='redis://localhost:6379')],
-#         },
-#     },
-# }
+# WebSocket handshakes cache authenticated users for a few seconds
+# (set WS_USER_CACHE_TTL=0 to disable)
+WS_USER_CACHE_TTL = config('WS_USER_CACHE_TTL', default=30, cast=int)
+WS_USER_CACHE_SIZE = config('WS_USER_CACHE_SIZE', default=1024, cast=int)
 
 # Database
 DATABASES = {
@@ -133,6 +157,42 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 
+# Threads reserved for writing chat attachments to storage
+CHAT_STORAGE_WORKERS = config('CHAT_STORAGE_WORKERS', default=4, cast=int)
+
+# Write-behind for WebSocket chat messages: broadcast first, insert in batches
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', default=False, cast=bool)
+CHAT_WRITE_BEHIND_INTERVAL = config('CHAT_WRITE_BEHIND_INTERVAL', default=0.2, cast=float)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', default=500, cast=int)
+# 0-63, required with CHAT_WRITE_BEHIND and unique per worker process
+CHAT_WORKER_ID = config('CHAT_WORKER_ID', default=None, cast=lambda value: None if value is None else int(value))
+
+# Per-connection WebSocket send queue: frames held for a slow client, and
+# seconds its oldest frame may wait, before the socket is closed
+CHAT_OUTBOUND_QUEUE_LIMIT = config('CHAT_OUTBOUND_QUEUE_LIMIT', default=256, cast=int)
+CHAT_OUTBOUND_MAX_LAG = config('CHAT_OUTBOUND_MAX_LAG', default=30, cast=float)
+
+# Message search: auto (FULLTEXT on MySQL, token index elsewhere), fulltext or index
+CHAT_SEARCH_BACKEND = config('CHAT_SEARCH_BACKEND', default='auto')
+
+# Seconds a user search result is reused for the same prefix
+USER_SEARCH_CACHE_TTL = config('USER_SEARCH_CACHE_TTL', default=30, cast=int)
+
+# Collect latency and query metrics and serve them on /metrics (Prometheus
+# text format). Only staff users and clients in METRICS_ALLOWED_NETWORKS
+# may read /metrics.
+METRICS_ENABLED = config('METRICS_ENABLED', default=False, cast=bool)
+METRICS_ALLOWED_NETWORKS = config('METRICS_ALLOWED_NETWORKS', default='127.0.0.1/32,::1/128', cast=Csv())
+
+# Per-request query profiling: Server-Timing headers, plus a JSON log line on
+# the core.queries logger for requests that are slow, run more than
+# QUERY_PROFILER_MAX_QUERIES queries or repeat one statement
+# QUERY_PROFILER_REPEAT_LIMIT times (a likely N+1)
+QUERY_PROFILER_ENABLED = config('QUERY_PROFILER_ENABLED', default=DEBUG, cast=bool)
+QUERY_PROFILER_SLOW_MS = config('QUERY_PROFILER_SLOW_MS', default=500, cast=int)
+QUERY_PROFILER_MAX_QUERIES = config('QUERY_PROFILER_MAX_QUERIES', default=30, cast=int)
+QUERY_PROFILER_REPEAT_LIMIT = config('QUERY_PROFILER_REPEAT_LIMIT', default=5, cast=int)
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
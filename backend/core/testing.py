@@ -0,0 +1,51 @@
+"""
+Query budget assertions for tests.
+
+    class RoomListTests(QueryBudgetMixin, APITestCase):
+        def test_room_list_queries(self):
+            self.client.force_authenticate(self.user)
+            self.assertEndpointQueries('/api/chat/rooms/', 6)
+
+Unlike ``assertNumQueries`` a budget is an upper bound, so an endpoint that
+gets cheaper keeps passing, and a failure lists the repeated statements that
+point at an N+1.
+"""
+
+import contextlib
+from .queries import record_queries
+
+
+@contextlib.contextmanager
+def query_budget(max_queries, max_repeats=None):
+    """
+    Fail if the block runs more than ``max_queries`` queries, or any single
+    statement more than ``max_repeats`` times.
+    """
+    with record_queries() as queries:
+        yield queries
+
+    problems = []
+    if queries.count > max_queries:
+        problems.append(f'{queries.count} queries, budget is {max_queries}')
+    if max_repeats is not None:
+        worst = queries.repeated(max_repeats + 1)
+        if worst:
+            problems.append(f'a statement ran {worst[0][1]} times, at most {max_repeats} allowed')
+    if problems:
+        repeated = ''.join(
+            f'\n  x{count}: {sql}' for sql, count in queries.repeated()[:10]
+        )
+        raise AssertionError('; '.join(problems) + (f'\nRepeated statements:{repeated}' if repeated else ''))
+
+
+class QueryBudgetMixin:
+    """TestCase mixin with query budget assertions."""
+
+    def assertQueryBudget(self, max_queries, max_repeats=None):
+        return query_budget(max_queries, max_repeats)
+
+    def assertEndpointQueries(self, path, max_queries, max_repeats=None, method='get', **kwargs):
+        """Request ``path`` with ``self.client`` within a query budget and return the response."""
+        with query_budget(max_queries, max_repeats):
+            response = getattr(self.client, method)(path, **kwargs)
+        return response
@@ -0,0 +1,51 @@
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from . import metrics
+from .testing import QueryBudgetMixin, query_budget
+
+User = get_user_model()
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    def test_within_budget_passes(self):
+        with self.assertQueryBudget(2, max_repeats=1) as queries:
+            User.objects.count()
+            User.objects.exists()
+        self.assertEqual(queries.count, 2)
+    
+    def test_overrun_fails(self):
+        with self.assertRaisesMessage(AssertionError, '3 queries, budget is 2'):
+            with query_budget(2):
+                for _ in range(3):
+                    User.objects.count()
+    
+    def test_repeated_statement_fails_and_is_listed(self):
+        with self.assertRaises(AssertionError) as failure:
+            with query_budget(10, max_repeats=1):
+                for username in ('alice', 'bob'):
+                    User.objects.filter(username=username).first()
+        message = str(failure.exception)
+        self.assertIn('a statement ran 2 times, at most 1 allowed', message)
+        self.assertIn('x2: SELECT', message)
+
+@mock.patch.object(metrics, 'enabled', True)
+class MetricsViewTests(TestCase):
+    def test_served_to_allowed_networks(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE chat_room_connections gauge', response.content)
+    
+    def test_refused_to_other_addresses(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(response.status_code, 403)
+    
+    def test_served_to_staff_from_anywhere(self):
+        staff = User.objects.create_user(username='admin', email='admin@example.com', password='password', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.7')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_room_connections_are_not_labeled_per_room(self):
+        metrics.ROOM_CONNECTIONS.inc(consumer='chat')
+        self.addCleanup(metrics.ROOM_CONNECTIONS.dec, consumer='chat')
+        self.assertIn('chat_room_connections{consumer="chat"}', metrics.registry.render())
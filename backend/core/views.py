@@ -0,0 +1,31 @@
+import ipaddress
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
+from . import metrics
+
+
+def is_metrics_client(request):
+    """Staff users, or scrapers connecting from METRICS_ALLOWED_NETWORKS."""
+    if request.user.is_staff:
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(network, strict=False)
+        for network in settings.METRICS_ALLOWED_NETWORKS
+    )
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint, only served while METRICS_ENABLED is on."""
+    if not metrics.enabled:
+        raise Http404
+    if not is_metrics_client(request):
+        raise PermissionDenied
+    return HttpResponse(
+        metrics.registry.render(),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
@@ -1,10 +1,20 @@
-import React, { createContext, useContext, useState, useEffect } from 'react';
+import React, { createContext, useContext, useState, useEffect, useRef } from 'react';
 import chatService from '../services/chat';
 import websocketService from '../services/websocket';
 import { useAuth } from './AuthContext';
 
 const ChatContext = createContext();
 
+const compareKeys = (a, b) => (a > b) - (a < b);
+
+// Newest first: by seq within a room, by (timestamp, id) when a message has no seq
+const newestFirst = (a, b) => {
+  if (typeof a.seq === 'number' && typeof b.seq === 'number') {
+    return b.seq - a.seq;
+  }
+  return compareKeys(Date.parse(b.timestamp), Date.parse(a.timestamp)) || compareKeys(b.id, a.id);
+};
+
 export const useChatContext = () => {
   const context = useContext(ChatContext);
   if (!context) {
@@ -25,6 +35,7 @@ export const ChatProvider = ({ children }) => {
   const [searchResults, setSearchResults] = useState([]);
   const [searchLoading, setSearchLoading] = useState(false);
   const [wsConnected, setWsConnected] = useState(false);
+  const latestSearchRef = useRef('');
 
   // Load chat rooms on mount
   useEffect(() => {
@@ -53,10 +64,13 @@ export const ChatProvider = ({ children }) => {
     const unsubscribers = [
       websocketService.addEventListener('chat_message', handleNewMessage),
       websocketService.addEventListener('file_message', handleNewMessage),
+      websocketService.addEventListener('file_message_update', handleFileMessageUpdate),
       websocketService.addEventListener('user_status', handleUserStatus),
       websocketService.addEventListener('user_update', handleUserUpdate),
       websocketService.addEventListener('user_profile_update', handleUserUpdate),
-      websocketService.addEventListener('typing_indicator', handleTypingIndicator),
+      websocketService.addEventListener('typing_digest', handleTypingDigest),
+      websocketService.addEventListener('resume_batch', handleResumeBatch),
+      websocketService.addEventListener('resume_done', handleResumeDone),
       websocketService.addEventListener('error', handleWebSocketError)
     ];
 
@@ -81,13 +95,18 @@ export const ChatProvider = ({ children }) => {
     }
   };
 
-  const loadMessages = async (roomId, page = 1) => {
+  const loadMessages = async (roomId, before = null) => {
     try {
-      setLoading(page === 1);
-      const response = await chatService.getMessages(roomId, page);
+      setLoading(!before);
+      const response = await chatService.getMessages(roomId, before);
       
-      if (page === 1) {
-        setMessages(response.results || response);
+      if (!before) {
+        const loaded = response.results || response;
+        setMessages(loaded);
+        // Newest first; a reconnect resumes after this one
+        if (loaded.length) {
+          websocketService.noteSeq(loaded[0].seq);
+        }
       } else {
         setMessages(prev => [...prev, ...(response.results || response)]);
       }
@@ -152,9 +171,8 @@ export const ChatProvider = ({ children }) => {
 
     try {
       if (websocketService.isConnected()) {
-        // Send via WebSocket for real-time delivery
-        const base64Data = await chatService.fileToBase64(file);
-        websocketService.sendFileMessage(base64Data, file.name, file.type);
+        // Stream via WebSocket in chunks for real-time delivery
+        await websocketService.sendFileChunked(file);
       } else {
         // Fallback to HTTP upload
         const message = await chatService.uploadFile(currentRoom.id, file);
@@ -167,6 +185,7 @@ export const ChatProvider = ({ children }) => {
   };
 
   const searchUsers = async (query) => {
+    latestSearchRef.current = query.trim();
     if (!query.trim()) {
       setSearchResults([]);
       return;
@@ -174,7 +193,11 @@ export const ChatProvider = ({ children }) => {
 
     try {
       setSearchLoading(true);
-      const result = await chatService.searchUsers(query);
+      const result = await chatService.searchUsers(query.trim());
+      // Ignore responses that arrive after a newer search was started
+      if (result.query !== latestSearchRef.current) {
+        return;
+      }
       setSearchResults(result.users || []);
     } catch (error) {
       setError('Failed to search users');
@@ -264,12 +287,20 @@ export const ChatProvider = ({ children }) => {
       },
       message_type: data.message_type,
       timestamp: data.timestamp,
+      seq: data.seq,
       attachments: data.file_url ? [{
         file: data.file_url,
         file_name: data.file_name,
         file_size: data.file_size,
         file_type: data.file_type
-      }] : []
+      }] : [],
+      // File messages arrive before storage finishes; see handleFileMessageUpdate
+      upload_status: data.upload_status,
+      pending_file: data.upload_status === 'uploading' ? {
+        file_name: data.file_name,
+        file_size: data.file_size,
+        file_type: data.file_type
+      } : null
     };
 
     setMessages(prev => [newMessage, ...prev]);
@@ -287,20 +318,57 @@ export const ChatProvider = ({ children }) => {
     }));
   };
 
+  // Messages missed while reconnecting, oldest first in each batch
+  const handleResumeBatch = (data) => {
+    setMessages(prev => {
+      const known = new Set(prev.map(message => message.id));
+      const missed = data.messages.filter(message => !known.has(message.id));
+      // Live messages may already have arrived on the new socket
+      return [...missed, ...prev].sort(newestFirst);
+    });
+  };
+
+  const handleResumeDone = (data) => {
+    // Too much was missed to replay, reload the history instead
+    if (!data.complete && currentRoom) {
+      loadMessages(currentRoom.id);
+    }
+  };
+
+  const handleFileMessageUpdate = (data) => {
+    setMessages(prev => prev.map(message => {
+      if (message.id !== data.message_id) return message;
+      return {
+        ...message,
+        upload_status: data.upload_status,
+        attachments: data.file_url && message.pending_file ? [{
+          id: data.attachment_id,
+          file: data.file_url,
+          ...message.pending_file
+        }] : message.attachments,
+        pending_file: null
+      };
+    }));
+  };
+
   const handleUserUpdate = (data) => {
     updateUserInChatData(data.user);
     
-    // Add system message if provided
-    if (data.system_message) {
+    // One event covers every shared room; only the open room's notice is shown
+    const roomSystemMessage = (data.system_messages || []).find(
+      message => message.room_id === currentRoom?.id
+    );
+    if (roomSystemMessage) {
       const systemMessage = {
-        id: data.system_message.id,
-        content: data.system_message.content,
+        id: roomSystemMessage.id,
+        content: roomSystemMessage.content,
         sender: {
           id: data.user.id,
           username: data.user.username
         },
         message_type: 'system',
-        timestamp: data.system_message.timestamp,
+        timestamp: roomSystemMessage.timestamp,
+        seq: roomSystemMessage.seq,
         attachments: []
       };
       
@@ -320,27 +388,16 @@ export const ChatProvider = ({ children }) => {
     });
   };
 
-  const handleTypingIndicator = (data) => {
+  // Digests are deltas; the server expires users who stop sending typing_start
+  const handleTypingDigest = (data) => {
     setTypingUsers(prev => {
       const newSet = new Set(prev);
-      if (data.is_typing) {
-        newSet.add(data.username);
-      } else {
-        newSet.delete(data.username);
-      }
+      data.stopped.forEach(entry => newSet.delete(entry.username));
+      data.typing
+        .filter(entry => entry.user_id !== user?.id)
+        .forEach(entry => newSet.add(entry.username));
       return newSet;
     });
-
-    // Auto-remove typing indicator after 3 seconds
-    if (data.is_typing) {
-      setTimeout(() => {
-        setTypingUsers(prev => {
-          const newSet = new Set(prev);
-          newSet.delete(data.username);
-          return newSet;
-        });
-      }, 3000);
-    }
   };
 
   const handleWebSocketError = (data) => {
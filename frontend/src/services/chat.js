@@ -27,9 +27,12 @@ const chatService = {
   },
 
   // Messages
-  getMessages: async (roomId, page = 1) => {
+  // Pass the `before` cursor from a page's `next` link to load older messages
+  getMessages: async (roomId, before = null) => {
+    const params = before ? { before } : {};
     const response = await axios.get(
-      `${API_URL}/chat/rooms/${roomId}/messages/?page=${page}`
+      `${API_URL}/chat/rooms/${roomId}/messages/`,
+      { params }
     );
     return response.data;
   },
@@ -42,6 +45,14 @@ const chatService = {
     return response.data;
   },
 
+  searchMessages: async (roomId, query, before = null) => {
+    const response = await axios.get(
+      `${API_URL}/chat/rooms/${roomId}/messages/search/`,
+      { params: before ? { q: query, before } : { q: query } }
+    );
+    return response.data;
+  },
+
   markMessagesAsRead: async (roomId) => {
     const response = await axios.post(
       `${API_URL}/chat/rooms/${roomId}/messages/read/`
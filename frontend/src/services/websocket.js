@@ -1,3 +1,18 @@
+const FILE_CHUNK_SIZE = 192 * 1024;
+// The server drops sockets that stay silent for 90 seconds
+const HEARTBEAT_INTERVAL = 25000;
+// Closed by the server because we fell too far behind; reconnect and resume
+const SLOW_CONSUMER_CLOSE_CODE = 4008;
+
+const blobToBase64 = (blob) => {
+  return new Promise((resolve, reject) => {
+    const reader = new FileReader();
+    reader.readAsDataURL(blob);
+    reader.onload = () => resolve(reader.result.split(',')[1]);
+    reader.onerror = reject;
+  });
+};
+
 class WebSocketService {
   constructor() {
     this.ws = null;
@@ -7,6 +22,29 @@ class WebSocketService {
     this.listeners = new Map();
     this.isConnecting = false;
     this.shouldReconnect = true;
+    this.heartbeatTimer = null;
+    // Highest room sequence number seen, sent back to catch up after a reconnect
+    this.lastSeq = null;
+  }
+
+  noteSeq(seq) {
+    if (typeof seq === 'number' && (this.lastSeq === null || seq > this.lastSeq)) {
+      this.lastSeq = seq;
+    }
+  }
+
+  startHeartbeat() {
+    this.stopHeartbeat();
+    this.heartbeatTimer = setInterval(() => {
+      this.send({ type: 'heartbeat' });
+    }, HEARTBEAT_INTERVAL);
+  }
+
+  stopHeartbeat() {
+    if (this.heartbeatTimer) {
+      clearInterval(this.heartbeatTimer);
+      this.heartbeatTimer = null;
+    }
   }
 
   connect(roomId, token) {
@@ -41,6 +79,7 @@ class WebSocketService {
           console.log('WebSocket connected');
           this.reconnectAttempts = 0;
           this.isConnecting = false;
+          this.startHeartbeat();
           
           // Send authentication if token is provided
           if (token) {
@@ -49,6 +88,14 @@ class WebSocketService {
               token: token
             });
           }
+
+          // Only fetch what was missed while the socket was down
+          if (this.lastSeq !== null) {
+            this.send({
+              type: 'resume',
+              last_seq: this.lastSeq
+            });
+          }
           
           resolve();
         };
@@ -65,13 +112,15 @@ class WebSocketService {
         this.ws.onclose = (event) => {
           console.log('WebSocket disconnected:', event.code, event.reason);
           this.isConnecting = false;
+          this.stopHeartbeat();
           
           if (this.shouldReconnect && this.reconnectAttempts < this.maxReconnectAttempts) {
             this.reconnectAttempts++;
             console.log(`Attempting to reconnect... (${this.reconnectAttempts}/${this.maxReconnectAttempts})`);
+            const delay = event.code === SLOW_CONSUMER_CLOSE_CODE ? 0 : this.reconnectInterval;
             setTimeout(() => {
               this.connect(roomId, token);
-            }, this.reconnectInterval);
+            }, delay);
           }
         };
 
@@ -89,6 +138,8 @@ class WebSocketService {
 
   disconnect() {
     this.shouldReconnect = false;
+    this.stopHeartbeat();
+    this.lastSeq = null;
     if (this.ws) {
       this.ws.close();
       this.ws = null;
@@ -120,6 +171,70 @@ class WebSocketService {
     });
   }
 
+  // Stream a file in chunks, sending each one after the previous is acknowledged
+  async sendFileChunked(file) {
+    const uploadId = crypto.randomUUID();
+    // The server discards the upload when this socket closes
+    const ws = this.ws;
+    if (!ws || ws.readyState !== WebSocket.OPEN) {
+      throw new Error('WebSocket is not connected');
+    }
+
+    const waitForAck = () => new Promise((resolve, reject) => {
+      const onClose = () => {
+        cleanup();
+        reject(new Error('Connection closed during upload'));
+      };
+      const cleanup = () => {
+        unsubscribeAck();
+        unsubscribeError();
+        ws.removeEventListener('close', onClose);
+      };
+      const unsubscribeAck = this.addEventListener('file_ack', (data) => {
+        if (data.upload_id !== uploadId) return;
+        cleanup();
+        resolve(data.offset);
+      });
+      const unsubscribeError = this.addEventListener('error', (data) => {
+        if (data.upload_id !== uploadId) return;
+        cleanup();
+        reject(new Error(data.message));
+      });
+      if (ws.readyState !== WebSocket.OPEN) {
+        onClose();
+        return;
+      }
+      ws.addEventListener('close', onClose);
+    });
+
+    let ack = waitForAck();
+    this.send({
+      type: 'file_start',
+      upload_id: uploadId,
+      file_name: file.name,
+      file_type: file.type,
+      file_size: file.size
+    });
+    let offset = await ack;
+
+    while (offset < file.size) {
+      const data = await blobToBase64(file.slice(offset, offset + FILE_CHUNK_SIZE));
+      ack = waitForAck();
+      this.send({
+        type: 'file_chunk',
+        upload_id: uploadId,
+        offset: offset,
+        data: data
+      });
+      offset = await ack;
+    }
+
+    this.send({
+      type: 'file_end',
+      upload_id: uploadId
+    });
+  }
+
   sendTypingStart() {
     this.send({
       type: 'typing_start'
@@ -141,6 +256,11 @@ class WebSocketService {
 
   handleMessage(data) {
     const { type } = data;
+
+    this.noteSeq(data.seq);
+    if (type === 'resume_batch' && data.messages.length) {
+      this.noteSeq(data.messages[data.messages.length - 1].seq);
+    }
     
     // Notify all listeners for this message type
     if (this.listeners.has(type)) {